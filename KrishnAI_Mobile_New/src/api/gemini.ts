@@ -0,0 +1,62 @@
+// Cliente de la API de Krishna AI (servidor_api.py).
+//
+// El móvil ya no llama a Gemini directamente: la recuperación de versos, la
+// rotación de claves y la anti-repetición se hacen en el servidor, y las
+// claves API no salen de él. La URL se configura con EXPO_PUBLIC_API_URL.
+
+const API_URL = (process.env.EXPO_PUBLIC_API_URL ?? 'http://localhost:8080').replace(/\/$/, '');
+
+export interface HistoryMessage {
+  user: 'user' | 'bot';
+  text: string;
+}
+
+interface ChatResponse {
+  sesion: string;
+  texto: string;
+  citas: string[];
+}
+
+interface ChatError {
+  nivel?: string;
+  mensaje?: string;
+  error?: string;
+}
+
+// Sesión del servidor; si la réplica que atiende no la conoce, la reconstruye con el historial
+let sesionId: string | null = null;
+
+export async function getBotResponse(
+  message: string,
+  nombre: string,
+  history: HistoryMessage[] = [],
+): Promise<string> {
+  // Conversación nueva: la app vacía el historial al pulsar "Nueva Conversación"
+  if (history.length === 0) {
+    sesionId = null;
+  }
+
+  const response = await fetch(`${API_URL}/v1/chat`, {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json', Accept: 'application/json'},
+    body: JSON.stringify({
+      pregunta: message,
+      nombre,
+      sesion: sesionId,
+      historial: history.map(msg => ({
+        role: msg.user === 'user' ? 'user' : 'assistant',
+        content: msg.text,
+      })),
+    }),
+  });
+
+  const data = (await response.json()) as ChatResponse & ChatError;
+  if (!response.ok) {
+    if (data.sesion) {
+      sesionId = data.sesion;
+    }
+    throw new Error(data.mensaje ?? data.error ?? `HTTP ${response.status}`);
+  }
+  sesionId = data.sesion;
+  return data.texto;
+}
@@ -0,0 +1,178 @@
+"""
+Almacén de sesiones en dos niveles con retención acotada.
+
+- Nivel caliente: LRU en memoria con las Sesion en uso (como máximo
+  max_sesiones); las que exceden el límite se descartan de memoria.
+- Nivel frío (opcional): SQLite en disco, una fila por sesión. Cada turno se
+  escribe en él, así que una sesión expulsada del LRU, o creada en otro
+  proceso que comparta el fichero, se rehidrata en obtener().
+
+La memoria por sesión está acotada: retener() deja solo los últimos
+`retencion` mensajes y, de los anteriores a los últimos `con_texto`, solo las
+claves de cita (lo único que necesita la ventana de versos prohibidos). En
+disco los mensajes se guardan como registros compactos:
+    {"r": "u"|"a", "t": texto?, "c": ["2:47", ...]?, "s": [[inicio, fin, verso], ...]?}
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import metrics
+from krishna_engine import Sesion
+
+logger = logging.getLogger(__name__)
+
+MAX_SESIONES = 10_000
+TTL_SESION_S = 6 * 3600
+MENSAJES_RETENIDOS = 16     # mensajes que se conservan por sesión
+MENSAJES_CON_TEXTO = 6      # de ellos, los últimos que conservan el texto (historial del prompt)
+PURGAR_CADA = 500           # escrituras entre purgas de sesiones caducadas en disco
+
+_ROLES = {"user": "u", "assistant": "a"}
+_ROLES_INVERSO = {v: k for k, v in _ROLES.items()}
+
+
+def compactar(mensaje: dict, con_texto: bool = True) -> dict:
+    """Registro compacto de un mensaje; sin texto si con_texto es False."""
+    registro = {"r": _ROLES.get(mensaje["role"], "u")}
+    if con_texto:
+        registro["t"] = mensaje.get("content", "")
+    if mensaje.get("citas") is not None:
+        registro["c"] = list(mensaje["citas"])
+    if con_texto and mensaje.get("tramos"):
+        registro["s"] = [list(tramo) for tramo in mensaje["tramos"]]
+    return registro
+
+
+def expandir(registro: dict) -> dict:
+    """Mensaje del motor a partir de su registro compacto."""
+    mensaje = {"role": _ROLES_INVERSO[registro["r"]], "content": registro.get("t", "")}
+    if "c" in registro:
+        mensaje["citas"] = registro["c"]
+    if "s" in registro:
+        mensaje["tramos"] = [tuple(tramo) for tramo in registro["s"]]
+    return mensaje
+
+
+def retener(mensajes: list, retencion: int = MENSAJES_RETENIDOS, con_texto: int | None = MENSAJES_CON_TEXTO) -> int:
+    """
+    Recorta el historial en sitio: los últimos `retencion` mensajes, y de los
+    anteriores a los últimos `con_texto` solo rol y citas (con_texto=None
+    conserva todos los textos). Devuelve cuántos mensajes se descartaron.
+    """
+    sobran = max(0, len(mensajes) - retencion)
+    del mensajes[:sobran]
+    if con_texto is not None:
+        for i in range(max(0, len(mensajes) - con_texto)):
+            if mensajes[i].get("content") or mensajes[i].get("tramos"):
+                mensajes[i] = expandir(compactar(mensajes[i], con_texto=False))
+    return sobran
+
+
+class AlmacenSesiones:
+    """Sesiones en memoria (LRU acotado y caducidad por inactividad) con nivel frío opcional en SQLite."""
+
+    def __init__(self, max_sesiones: int = MAX_SESIONES, ttl: float = TTL_SESION_S, path: str | None = None,
+                 retencion: int = MENSAJES_RETENIDOS, con_texto: int | None = MENSAJES_CON_TEXTO):
+        self.max_sesiones = max_sesiones
+        self.ttl = ttl
+        self.retencion = retencion
+        self.con_texto = con_texto
+        self._sesiones = OrderedDict()      # id → (Sesion, último uso)
+        self._lock = threading.Lock()
+        self._escrituras = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS sesiones "
+                             "(id TEXT PRIMARY KEY, actualizada REAL NOT NULL, datos TEXT NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS sesiones_actualizada ON sesiones (actualizada)")
+            self.purgar()
+
+    # --- Nivel frío ----------------------------------------------------------
+
+    def _serializar(self, sesion: Sesion) -> str:
+        corte = len(sesion.mensajes) - self.con_texto if self.con_texto is not None else 0
+        return json.dumps({
+            "nombre": sesion.nombre_usuario,
+            "genero": sesion.genero_usuario,
+            "temperatura": sesion.temperatura,
+            "mensajes": [compactar(m, con_texto=i >= corte) for i, m in enumerate(sesion.mensajes)],
+        }, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def _deserializar(datos: str) -> Sesion:
+        datos = json.loads(datos)
+        return Sesion(mensajes=[expandir(r) for r in datos["mensajes"]], nombre_usuario=datos["nombre"],
+                      genero_usuario=datos["genero"], temperatura=datos["temperatura"])
+
+    def _leer_fria(self, sesion_id: str, ahora: float) -> Sesion | None:
+        fila = self._db.execute("SELECT actualizada, datos FROM sesiones WHERE id = ?", (sesion_id,)).fetchone()
+        if fila is None or ahora - fila[0] > self.ttl:
+            return None
+        try:
+            return self._deserializar(fila[1])
+        except (ValueError, KeyError) as e:
+            logger.warning("Sesión %s ilegible en el almacén frío, se descarta: %s", sesion_id, e)
+            return None
+
+    def purgar(self) -> int:
+        """Borra del nivel frío las sesiones caducadas; devuelve cuántas."""
+        if self._db is None:
+            return 0
+        with self._lock:
+            return self._db.execute("DELETE FROM sesiones WHERE actualizada < ?",
+                                    (time.time() - self.ttl,)).rowcount
+
+    # --- API -----------------------------------------------------------------
+
+    def obtener(self, sesion_id: str | None) -> tuple[str, Sesion | None]:
+        ahora = time.time()
+        with self._lock:
+            entrada = self._sesiones.get(sesion_id) if sesion_id else None
+            if entrada is not None and ahora - entrada[1] <= self.ttl:
+                self._sesiones[sesion_id] = (entrada[0], ahora)
+                self._sesiones.move_to_end(sesion_id)
+                return sesion_id, entrada[0]
+            sesion = self._leer_fria(sesion_id, ahora) if sesion_id and self._db is not None else None
+            if sesion is not None:
+                self._insertar(sesion_id, sesion, ahora)
+        if sesion is not None:
+            metrics.contar("krishnai_sesiones_rehidratadas_total", "Sesiones recuperadas del almacén en disco")
+            return sesion_id, sesion
+        return sesion_id or uuid.uuid4().hex, None
+
+    def _insertar(self, sesion_id: str, sesion: Sesion, ahora: float):
+        self._sesiones[sesion_id] = (sesion, ahora)
+        self._sesiones.move_to_end(sesion_id)
+        while len(self._sesiones) > self.max_sesiones:
+            self._sesiones.popitem(last=False)
+
+    def guardar(self, sesion_id: str, sesion: Sesion):
+        retener(sesion.mensajes, self.retencion, self.con_texto)
+        ahora = time.time()
+        with self._lock:
+            self._insertar(sesion_id, sesion, ahora)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO sesiones (id, actualizada, datos) VALUES (?, ?, ?)",
+                                 (sesion_id, ahora, self._serializar(sesion)))
+                self._escrituras += 1
+        if self._db is not None and self._escrituras % PURGAR_CADA == 0:
+            self.purgar()
+        metrics.REGISTRO.indicador("krishnai_api_sesiones", "Sesiones activas en memoria").set(len(self._sesiones))
+
+    def eliminar(self, sesion_id: str) -> bool:
+        with self._lock:
+            eliminada = self._sesiones.pop(sesion_id, None) is not None
+            if self._db is not None:
+                eliminada = self._db.execute("DELETE FROM sesiones WHERE id = ?", (sesion_id,)).rowcount > 0 or eliminada
+        return eliminada
+
+    def __len__(self) -> int:
+        return len(self._sesiones)
@@ -0,0 +1 @@
+"""Benchmarks y utilidades de carga de Krishna AI."""
@@ -0,0 +1,167 @@
+"""
+Generador de carga: muchas sesiones de chat de Streamlit concurrentes en un proceso.
+
+Cada sesión es un AppTest de Streamlit que ejecuta app.py y reproduce un
+guion de varios turnos (preguntas, cambio de nombre, ajuste de temperatura).
+El LLM se sustituye por el Gemini falso de benchmarks/fake_gemini.py
+inyectando el rotador global antes de la primera ejecución.
+
+Informa de latencia por turno, CPU total del proceso (y su media por rerun),
+memoria por sesión, número de reruns y de ejecuciones completas del script,
+junto con la latencia por etapa de metrics.py, para localizar dónde deja de
+escalar el trabajo a nivel de módulo de app.py.
+
+Uso (desde la raíz del repositorio):
+    python -m benchmarks.carga --sesiones 20 --concurrencia 10 --turnos 5
+"""
+
+import argparse
+import json
+import os
+import pickle
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import metrics  # noqa: E402
+from benchmarks.e2e import PREGUNTAS, _percentiles, crear_rotador  # noqa: E402
+from benchmarks.fake_gemini import ConfigFalsa, GeminiFalso  # noqa: E402
+
+NOMBRES = ["Lucía", "Arjuna", "Carmen", "Mikel", "Sofía", "Jon"]
+
+
+def guion(indice: int, turnos: int) -> list[tuple[str, object]]:
+    """Guion de una sesión: alterna preguntas con cambios de barra lateral."""
+    pasos = [("nombre", NOMBRES[indice % len(NOMBRES)])]
+    for t in range(turnos):
+        pasos.append(("pregunta", PREGUNTAS[(indice + t) % len(PREGUNTAS)]))
+        if t == 1:
+            pasos.append(("temperatura", 0.3))
+    return pasos
+
+
+def _tamano_sesion(at) -> int:
+    """Bytes serializados del estado de sesión (aproximación de su memoria)."""
+    estado = {}
+    for clave in at.session_state.filtered_state:
+        try:
+            estado[clave] = at.session_state[clave]
+        except Exception:
+            continue
+    try:
+        return len(pickle.dumps(estado))
+    except Exception:
+        return 0
+
+
+def ejecutar_sesion(indice: int, args, secrets: dict) -> dict:
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(RAIZ, "app.py"), default_timeout=args.timeout)
+    for seccion, valores in secrets.items():
+        at.secrets[seccion] = valores
+
+    turnos = []
+    reruns = 0
+    errores = []
+
+    def rerun(accion, etiqueta):
+        nonlocal reruns
+        inicio = time.perf_counter()
+        accion()
+        reruns += 1
+        # Sin CPU por turno: process_time() es de todo el proceso y los turnos van en paralelo
+        turnos.append({"paso": etiqueta, "latencia_ms": (time.perf_counter() - inicio) * 1000})
+        if at.exception:
+            errores.append(str(at.exception[0].value))
+
+    rerun(at.run, "carga_inicial")
+    for tipo, valor in guion(indice, args.turnos):
+        if tipo == "pregunta":
+            rerun(lambda v=valor: at.chat_input[0].set_value(v).run(), "pregunta")
+        elif tipo == "nombre":
+            rerun(lambda v=valor: at.text_input(key="nombre_input").input(v).run(), "nombre")
+        elif tipo == "temperatura":
+            rerun(lambda v=valor: at.slider[0].set_value(v).run(), "temperatura")
+
+    return {
+        "turnos": turnos,
+        "reruns": reruns,
+        "bytes_sesion": _tamano_sesion(at),
+        "mensajes": len(at.session_state["messages"]) if "messages" in at.session_state else 0,
+        "errores": errores,
+    }
+
+
+def ejecutar(args) -> dict:
+    import rotacion_claves
+
+    falso = GeminiFalso(ConfigFalsa(latencia_media=args.latencia, jitter=args.latencia / 4, semilla=args.semilla))
+    rotacion_claves.api_rotator = crear_rotador(falso, args.claves)
+    secrets = {"google": {"api_keys": [{"key": f"clave-falsa-{i}", "name": f"falsa_{i}"} for i in range(args.claves)]}}
+
+    rss_inicial = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu_inicial = time.process_time()
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as pool:
+        sesiones = list(pool.map(lambda i: ejecutar_sesion(i, args, secrets), range(args.sesiones)))
+    duracion = time.perf_counter() - inicio
+    cpu_total = time.process_time() - cpu_inicial
+    rss_final = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    pasos = [t for s in sesiones for t in s["turnos"]]
+    preguntas = [t for t in pasos if t["paso"] == "pregunta"]
+    otros = [t for t in pasos if t["paso"] != "pregunta"]
+    # app.py cuenta cada ejecución completa; los reruns de fragmentos no la incrementan
+    ejecuciones_script = int(metrics.REGISTRO.contador("krishnai_ejecuciones_script_total").valor)
+    return {
+        "config": {
+            "sesiones": args.sesiones, "concurrencia": args.concurrencia, "turnos": args.turnos,
+            "latencia_llm_s": args.latencia, "claves": args.claves, "hilos_activos": threading.active_count(),
+        },
+        "duracion_s": round(duracion, 3),
+        "reruns": sum(s["reruns"] for s in sesiones),
+        "ejecuciones_script": ejecuciones_script,
+        "latencia_turno_ms": _percentiles([t["latencia_ms"] for t in preguntas]),
+        "latencia_rerun_sin_llm_ms": _percentiles([t["latencia_ms"] for t in otros]),
+        "cpu_total_s": round(cpu_total, 3),
+        "cpu_ms_por_rerun": round(cpu_total * 1000 / len(pasos), 2) if pasos else 0.0,
+        "memoria": {
+            # ru_maxrss está en KB en Linux
+            "rss_crecimiento_kb": rss_final - rss_inicial,
+            "rss_por_sesion_kb": round((rss_final - rss_inicial) / args.sesiones, 1),
+            "estado_sesion_bytes": _percentiles([s["bytes_sesion"] for s in sesiones]),
+        },
+        "llamadas_llm": falso.estadisticas.llamadas,
+        "errores": sorted({e for s in sesiones for e in s["errores"]}),
+        "etapas_ms": metrics.REGISTRO.resumen_etapas(),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Prueba de carga de sesiones Streamlit concurrentes")
+    parser.add_argument("--sesiones", type=int, default=10)
+    parser.add_argument("--concurrencia", type=int, default=5)
+    parser.add_argument("--turnos", type=int, default=4)
+    parser.add_argument("--claves", type=int, default=3)
+    parser.add_argument("--latencia", type=float, default=0.3, help="latencia media del LLM falso (s)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="timeout por rerun de AppTest (s)")
+    parser.add_argument("--semilla", type=int, default=1234)
+    parser.add_argument("--salida", default="carga_output.json")
+    args = parser.parse_args(argv)
+
+    os.chdir(RAIZ)  # app.py usa rutas relativas (.streamlit/, JSON del corpus)
+    informe = ejecutar(args)
+    with open(args.salida, "w", encoding="utf-8") as f:
+        json.dump(informe, f, ensure_ascii=False, indent=2)
+    print(json.dumps({k: v for k, v in informe.items() if k != "etapas_ms"}, ensure_ascii=False, indent=2))
+    return 1 if informe["errores"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+"""
+Benchmark de extremo a extremo del turno de Krishna AI contra el Gemini falso.
+
+Recorre el pipeline completo de KrishnaEngine.respond (contexto → prompt →
+rotador → guardia anti-repetición → análisis de citas) con sesiones
+concurrentes y escribe throughput, percentiles de latencia, tamaño de prompt
+y reintentos en un JSON comparable con una línea base.
+
+Por defecto el motor no degrada: un turno sin respuesta del modelo cuenta como
+fallo. Con --degradar las respuestas guardadas o compuestas localmente se
+cuentan aparte ("degradados") y no entran en throughput ni en latencias.
+
+Uso (desde la raíz del repositorio):
+    python -m benchmarks.e2e --sesiones 8 --turnos 4 --concurrencia 4
+    python -m benchmarks.e2e --prob-429 0.1 --prob-timeout 0.05 --http --stream
+    python -m benchmarks.e2e --prob-429 0.9 --degradar   # con la escalera de degradación del motor
+    python -m benchmarks.e2e --guardar-base     # escribe benchmarks/baseline_e2e.json
+    python -m benchmarks.e2e --comparar         # sale con código 1 si hay regresión
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics  # noqa: E402
+from benchmarks.fake_gemini import ClienteGeminiHTTP, ConfigFalsa, GeminiFalso, servir_http  # noqa: E402
+
+BASE_POR_DEFECTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_e2e.json")
+SALIDA_POR_DEFECTO = "bench_output.json"
+
+PREGUNTAS = [
+    "Hola Krishna",
+    "¿Cuál es mi dharma en esta batalla?",
+    "¿Cómo actuar sin apego a los frutos de la acción?",
+    "¿Qué es el yoga de la devoción?",
+    "¿Qué ocurre con el alma cuando el cuerpo muere?",
+    "¿Cómo puedo dominar la mente inquieta?",
+    "¿Qué diferencia hay entre conocimiento y sabiduría?",
+    "¿Cómo reconozco a quien ha alcanzado la paz?",
+]
+
+METRICAS_COMPARADAS = {
+    # métrica: True si mayor es mejor
+    "throughput_turnos_s": True,
+    "latencia_ms.p50": False,
+    "latencia_ms.p95": False,
+    "prompt_caracteres.media": False,
+    "reintentos_por_turno": False,
+}
+
+
+def _percentiles(valores: list) -> dict:
+    ordenados = sorted(valores)
+    if not ordenados:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    return {
+        "p50": round(metrics.cuantil(ordenados, 0.5), 2),
+        "p95": round(metrics.cuantil(ordenados, 0.95), 2),
+        "p99": round(metrics.cuantil(ordenados, 0.99), 2),
+        "max": round(ordenados[-1], 2),
+    }
+
+
+def cargar_corpus() -> tuple[dict, float]:
+    """Carga el corpus como lo hace la app, procesando el TXT si aún no existe el JSON."""
+    from gita_loader import cargar_bhagavad_gita
+    if not os.path.exists("bhagavad_gita_txt_corregido.json"):
+        from procesado_bhagavad_gita_txt_corregido import procesar_bhagavad_gita_txt
+        procesar_bhagavad_gita_txt("Bhagavad-Gita-Anonimo.txt", "bhagavad_gita_txt_corregido.json")
+    inicio = time.perf_counter()
+    bhagavad_gita = cargar_bhagavad_gita()
+    return bhagavad_gita, (time.perf_counter() - inicio) * 1000
+
+
+def crear_rotador(generador, num_claves: int):
+    from rotacion_claves import APIKeyInfo, GeminiAPIRotator
+    claves = [APIKeyInfo(f"clave-falsa-{i}", f"falsa_{i}") for i in range(num_claves)]
+    return GeminiAPIRotator(api_keys=claves, generador=generador)
+
+
+def ejecutar_turno(motor, sesion, pregunta, args) -> dict:
+    """Un turno completo con el mismo motor que app.py. Devuelve las medidas del turno."""
+    inicio = time.perf_counter()
+    ttft_ms = None
+
+    def al_fragmento(_texto):
+        nonlocal ttft_ms
+        if ttft_ms is None:
+            ttft_ms = (time.perf_counter() - inicio) * 1000
+
+    respuesta = motor.respond(sesion, pregunta, al_fragmento=al_fragmento, stream=args.stream)
+    return {
+        "latencia_ms": (time.perf_counter() - inicio) * 1000,
+        "ttft_ms": ttft_ms if args.stream else None,
+        "prompt_caracteres": respuesta.prompt_caracteres,
+        "degradacion": respuesta.degradacion,
+    }
+
+
+def ejecutar_sesion(motor, indice: int, args) -> list[dict]:
+    from krishna_engine import Sesion
+
+    sesion = Sesion(nombre_usuario="Arjuna", genero_usuario="Masculino")
+    resultados = []
+    for t in range(args.turnos):
+        pregunta = PREGUNTAS[(indice + t) % len(PREGUNTAS)]
+        try:
+            resultados.append(ejecutar_turno(motor, sesion, pregunta, args))
+        except Exception as e:
+            resultados.append({"error": str(e)})
+            sesion.mensajes.append({"role": "assistant", "content": "❌ Error"})
+    return resultados
+
+
+def ejecutar(args) -> dict:
+    config = ConfigFalsa(
+        latencia_media=args.latencia,
+        jitter=args.jitter,
+        prob_429=args.prob_429,
+        prob_timeout=args.prob_timeout,
+        duracion_timeout=args.timeout_intento * 3,
+        semilla=args.semilla,
+    )
+    falso = GeminiFalso(config)
+    servidor = None
+    generador = falso
+    if args.http:
+        servidor = servir_http(falso)
+        generador = ClienteGeminiHTTP(f"http://127.0.0.1:{servidor.server_address[1]}")
+
+    from krishna_engine import KrishnaEngine
+
+    bhagavad_gita, carga_ms = cargar_corpus()
+    motor = KrishnaEngine(bhagavad_gita, crear_rotador(generador, args.claves), timeout_seconds=args.timeout_intento,
+                          degradar=args.degradar)
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as pool:
+        futuros = [pool.submit(ejecutar_sesion, motor, i, args) for i in range(args.sesiones)]
+        turnos = [r for f in futuros for r in f.result()]
+    duracion = time.perf_counter() - inicio
+    if servidor is not None:
+        servidor.shutdown()
+
+    # Solo las respuestas del modelo cuentan como correctas: las degradadas ocultan fallos reales
+    correctos = [t for t in turnos if "error" not in t and t["degradacion"] is None]
+    degradados = sum(1 for t in turnos if t.get("degradacion") is not None)
+    prompts = [t["prompt_caracteres"] for t in correctos]
+    # Sin --degradar cada turno llama al modelo hasta responder o fallar; con --degradar
+    # también cuentan los intentos de los turnos degradados y de la cola de reintentos
+    reintentos = max(0, falso.estadisticas.llamadas - len(turnos))
+    informe = {
+        "config": {
+            "sesiones": args.sesiones, "turnos": args.turnos, "concurrencia": args.concurrencia,
+            "claves": args.claves, "latencia_s": args.latencia, "prob_429": args.prob_429,
+            "prob_timeout": args.prob_timeout, "http": args.http, "stream": args.stream,
+            "degradar": args.degradar,
+        },
+        "turnos": len(turnos),
+        "fallos": len(turnos) - len(correctos) - degradados,
+        "degradados": degradados,
+        "duracion_s": round(duracion, 3),
+        "throughput_turnos_s": round(len(correctos) / duracion, 3) if duracion else 0.0,
+        "carga_corpus_ms": round(carga_ms, 2),
+        "latencia_ms": _percentiles([t["latencia_ms"] for t in correctos]),
+        "prompt_caracteres": {
+            "media": round(sum(prompts) / len(prompts), 1) if prompts else 0.0,
+            "p95": metrics.cuantil(sorted(prompts), 0.95),
+            "max": max(prompts, default=0),
+        },
+        "llamadas_llm": falso.estadisticas.llamadas,
+        "reintentos": reintentos,
+        "reintentos_por_turno": round(reintentos / len(turnos), 3) if turnos else 0.0,
+        "errores_429": falso.estadisticas.errores_429,
+        "timeouts": falso.estadisticas.timeouts,
+        "etapas_ms": metrics.REGISTRO.resumen_etapas(),
+    }
+    if args.stream:
+        informe["ttft_ms"] = _percentiles([t["ttft_ms"] for t in correctos if t["ttft_ms"] is not None])
+    return informe
+
+
+def _valor(informe: dict, ruta: str):
+    for parte in ruta.split("."):
+        informe = informe[parte]
+    return informe
+
+
+def comparar(informe: dict, base: dict, tolerancia: float) -> list[str]:
+    """Devuelve las regresiones que superan la tolerancia relativa."""
+    regresiones = []
+    for ruta, mayor_es_mejor in METRICAS_COMPARADAS.items():
+        try:
+            actual, referencia = _valor(informe, ruta), _valor(base, ruta)
+        except KeyError:
+            continue
+        if not referencia:
+            continue
+        cambio = (actual - referencia) / referencia
+        if (mayor_es_mejor and cambio < -tolerancia) or (not mayor_es_mejor and cambio > tolerancia):
+            regresiones.append(f"{ruta}: {referencia} → {actual} ({cambio:+.1%})")
+    return regresiones
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark E2E de Krishna AI con Gemini falso")
+    parser.add_argument("--sesiones", type=int, default=8)
+    parser.add_argument("--turnos", type=int, default=4)
+    parser.add_argument("--concurrencia", type=int, default=4)
+    parser.add_argument("--claves", type=int, default=3)
+    parser.add_argument("--latencia", type=float, default=0.3, help="latencia media del LLM falso (s)")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--prob-429", type=float, default=0.0)
+    parser.add_argument("--prob-timeout", type=float, default=0.0)
+    parser.add_argument("--timeout-intento", type=int, default=2, help="timeout por intento del rotador (s)")
+    parser.add_argument("--semilla", type=int, default=1234)
+    parser.add_argument("--http", action="store_true", help="usar el servidor HTTP falso en lugar del generador en proceso")
+    parser.add_argument("--stream", action="store_true", help="pedir respuestas en streaming y medir el primer fragmento")
+    parser.add_argument("--degradar", action="store_true",
+                        help="responder desde la caché o localmente sin claves (se cuentan en 'degradados')")
+    parser.add_argument("--salida", default=SALIDA_POR_DEFECTO)
+    parser.add_argument("--base", default=BASE_POR_DEFECTO)
+    parser.add_argument("--guardar-base", action="store_true")
+    parser.add_argument("--comparar", action="store_true")
+    parser.add_argument("--tolerancia", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    informe = ejecutar(args)
+    with open(args.salida, "w", encoding="utf-8") as f:
+        json.dump(informe, f, ensure_ascii=False, indent=2)
+    print(json.dumps({k: v for k, v in informe.items() if k != "etapas_ms"}, ensure_ascii=False, indent=2))
+
+    if args.guardar_base:
+        with open(args.base, "w", encoding="utf-8") as f:
+            json.dump(informe, f, ensure_ascii=False, indent=2)
+        print(f"Línea base guardada en {args.base}")
+
+    if args.comparar:
+        if not os.path.exists(args.base):
+            print(f"No existe la línea base {args.base}; ejecuta con --guardar-base")
+            return 2
+        with open(args.base, encoding="utf-8") as f:
+            regresiones = comparar(informe, json.load(f), args.tolerancia)
+        for r in regresiones:
+            print(f"REGRESIÓN {r}")
+        return 1 if regresiones else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
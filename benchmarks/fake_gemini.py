@@ -0,0 +1,259 @@
+"""
+Servicio Gemini falso para benchmarks sin red ni claves reales.
+
+Ofrece dos modos:
+- GeminiFalso: generador en proceso con la firma que acepta
+  GeminiAPIRotator(generador=...).
+- servir_http(): servidor local que imita los endpoints REST
+  :generateContent y :streamGenerateContent?alt=sse, junto con
+  ClienteGeminiHTTP, un generador que habla con él por HTTP.
+
+Ambos simulan latencia configurable, errores 429, timeouts y streaming.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROMANOS = ['', 'I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X',
+           'XI', 'XII', 'XIII', 'XIV', 'XV', 'XVI', 'XVII', 'XVIII']
+
+_PATRON_VERSO_CONTEXTO = re.compile(r"Capítulo (\d+), Verso (\d+)")
+
+MENSAJE_429 = "429 Resource has been exhausted (e.g. check quota)."
+
+
+@dataclass
+class ConfigFalsa:
+    """Comportamiento del servicio falso."""
+    latencia_media: float = 0.3        # segundos hasta la respuesta (o primer fragmento)
+    jitter: float = 0.1                # desviación uniforme +/- sobre la latencia
+    prob_429: float = 0.0              # probabilidad de responder con error de cuota
+    prob_timeout: float = 0.0          # probabilidad de colgarse más que el timeout del cliente
+    duracion_timeout: float = 30.0     # cuánto "se cuelga" una llamada que hace timeout
+    fragmentos: int = 8                # fragmentos en modo streaming
+    retardo_fragmento: float = 0.02    # segundos entre fragmentos
+    citas_por_respuesta: int = 3
+    semilla: int | None = None
+
+
+@dataclass
+class EstadisticasFalsas:
+    llamadas: int = 0
+    errores_429: int = 0
+    timeouts: int = 0
+    caracteres_prompt: list = field(default_factory=list)
+
+
+class FragmentoFalso:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class RespuestaFalsa:
+    """Imita GenerateContentResponse: .text y, en streaming, iterable de fragmentos."""
+
+    def __init__(self, fragmentos: list[str], retardo_fragmento: float = 0.0, stream: bool = False):
+        self._fragmentos = fragmentos
+        self._retardo = retardo_fragmento
+        self._stream = stream
+        self._consumidos = 0
+
+    def __iter__(self):
+        for i, texto in enumerate(self._fragmentos):
+            if self._stream and i > 0 and self._retardo:
+                time.sleep(self._retardo)
+            self._consumidos = i + 1
+            yield FragmentoFalso(texto)
+
+    @property
+    def text(self) -> str:
+        if self._stream and self._consumidos < len(self._fragmentos):
+            for _ in self:
+                pass
+        return "".join(self._fragmentos)
+
+
+def componer_respuesta(prompt: str, citas: int, rng: random.Random) -> str:
+    """Respuesta con el registro de Krishna que cita versos presentes en el contexto del prompt."""
+    candidatos = _PATRON_VERSO_CONTEXTO.findall(prompt)
+    elegidos = rng.sample(candidatos, min(citas, len(candidatos))) if candidatos else []
+    partes = ["Mi querido Arjuna, escucha con atención."]
+    for cap, verso in elegidos:
+        cap_romano = ROMANOS[int(cap)] if int(cap) < len(ROMANOS) else cap
+        partes.append(f"Sabe que quien actúa sin apego alcanza lo Supremo [C. {cap_romano} - {verso}].")
+    partes.append("Por ello, cumple tu deber y refúgiate en Mí.")
+    return " ".join(partes)
+
+
+def _trocear(texto: str, n: int) -> list[str]:
+    if n <= 1 or len(texto) < n:
+        return [texto]
+    tam = -(-len(texto) // n)
+    return [texto[i:i + tam] for i in range(0, len(texto), tam)]
+
+
+class GeminiFalso:
+    """Generador en proceso compatible con GeminiAPIRotator(generador=...)."""
+
+    def __init__(self, config: ConfigFalsa | None = None):
+        self.config = config or ConfigFalsa()
+        self.estadisticas = EstadisticasFalsas()
+        self._rng = random.Random(self.config.semilla)
+        self._lock = threading.Lock()
+
+    def _decidir(self, prompt: str):
+        with self._lock:
+            self.estadisticas.llamadas += 1
+            self.estadisticas.caracteres_prompt.append(len(prompt))
+            r = self._rng.random()
+            latencia = max(0.0, self.config.latencia_media + self._rng.uniform(-self.config.jitter, self.config.jitter))
+            texto = componer_respuesta(prompt, self.config.citas_por_respuesta, self._rng)
+            if r < self.config.prob_429:
+                self.estadisticas.errores_429 += 1
+                return "429", latencia, texto
+            if r < self.config.prob_429 + self.config.prob_timeout:
+                self.estadisticas.timeouts += 1
+                return "timeout", latencia, texto
+            return "ok", latencia, texto
+
+    def __call__(self, model_name: str, prompt: str, generation_config: dict, stream: bool = False):
+        resultado, latencia, texto = self._decidir(prompt)
+        if resultado == "timeout":
+            time.sleep(self.config.duracion_timeout)
+        time.sleep(latencia)
+        if resultado == "429":
+            raise Exception(MENSAJE_429)
+        fragmentos = _trocear(texto, self.config.fragmentos if stream else 1)
+        return RespuestaFalsa(fragmentos, self.config.retardo_fragmento, stream)
+
+
+# --- Modo HTTP -------------------------------------------------------------
+
+def _cuerpo_candidato(texto: str) -> dict:
+    return {
+        "candidates": [{"content": {"parts": [{"text": texto}], "role": "model"}, "finishReason": "STOP"}],
+    }
+
+
+def _crear_manejador(falso: GeminiFalso):
+    class Manejador(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _json(self, estado: int, cuerpo: dict):
+            datos = json.dumps(cuerpo).encode("utf-8")
+            self.send_response(estado)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+
+        def do_POST(self):
+            ruta = self.path.split("?", 1)[0]
+            stream = ruta.endswith(":streamGenerateContent")
+            if not (stream or ruta.endswith(":generateContent")):
+                self._json(404, {"error": {"code": 404, "message": "Not found"}})
+                return
+            longitud = int(self.headers.get("Content-Length", "0"))
+            peticion = json.loads(self.rfile.read(longitud) or b"{}")
+            prompt = "".join(
+                p.get("text", "") for c in peticion.get("contents", []) for p in c.get("parts", [])
+            )
+            resultado, latencia, texto = falso._decidir(prompt)
+            if resultado == "timeout":
+                time.sleep(falso.config.duracion_timeout)
+            time.sleep(latencia)
+            if resultado == "429":
+                self._json(429, {"error": {"code": 429, "message": MENSAJE_429, "status": "RESOURCE_EXHAUSTED"}})
+                return
+            if not stream:
+                self._json(200, _cuerpo_candidato(texto))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for i, fragmento in enumerate(_trocear(texto, falso.config.fragmentos)):
+                if i > 0:
+                    time.sleep(falso.config.retardo_fragmento)
+                self.wfile.write(f"data: {json.dumps(_cuerpo_candidato(fragmento))}\r\n\r\n".encode("utf-8"))
+                self.wfile.flush()
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return Manejador
+
+
+def servir_http(falso: GeminiFalso, puerto: int = 0) -> ThreadingHTTPServer:
+    """Arranca el servidor falso en un hilo daemon; devuelve el servidor (ver .server_address)."""
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), _crear_manejador(falso))
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="gemini-falso", daemon=True).start()
+    return servidor
+
+
+class ClienteGeminiHTTP:
+    """Generador compatible con GeminiAPIRotator que llama al servidor falso por HTTP."""
+
+    def __init__(self, url_base: str, timeout: float = 60.0):
+        self.url_base = url_base.rstrip("/")
+        self.timeout = timeout
+
+    def __call__(self, model_name: str, prompt: str, generation_config: dict, stream: bool = False):
+        accion = "streamGenerateContent?alt=sse" if stream else "generateContent"
+        modelo = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        cuerpo = json.dumps({
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+            "generationConfig": generation_config,
+        }).encode("utf-8")
+        peticion = urllib.request.Request(
+            f"{self.url_base}/v1beta/{modelo}:{accion}", data=cuerpo,
+            headers={"Content-Type": "application/json"}, method="POST",
+        )
+        try:
+            respuesta = urllib.request.urlopen(peticion, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            detalle = e.read().decode("utf-8", "replace")
+            raise Exception(f"{e.code} {detalle}") from None
+        if not stream:
+            with respuesta:
+                datos = json.loads(respuesta.read())
+            return RespuestaFalsa([_texto_candidato(datos)])
+        return _RespuestaSSE(respuesta)
+
+
+def _texto_candidato(datos: dict) -> str:
+    return "".join(p.get("text", "") for p in datos["candidates"][0]["content"]["parts"])
+
+
+class _RespuestaSSE(RespuestaFalsa):
+    def __init__(self, respuesta_http):
+        super().__init__([], stream=True)
+        self._http = respuesta_http
+        self._terminado = False
+
+    def __iter__(self):
+        with self._http:
+            for linea in self._http:
+                linea = linea.strip()
+                if not linea.startswith(b"data:"):
+                    continue
+                texto = _texto_candidato(json.loads(linea[5:]))
+                self._fragmentos.append(texto)
+                yield FragmentoFalso(texto)
+        self._terminado = True
+
+    @property
+    def text(self) -> str:
+        if not self._terminado:
+            for _ in self:
+                pass
+        return "".join(self._fragmentos)
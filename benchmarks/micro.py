@@ -0,0 +1,284 @@
+"""
+Microbenchmarks de las funciones calientes de Krishna AI.
+
+Mide ops/s y asignaciones (tracemalloc) de:
+- RAGKrishna.obtener_versos_relevantes con embeddings sintéticos de 768 dimensiones
+- construir_prompt_krishna con historiales de distinta longitud y el prompt precalculado
+- extraer_versos_citados_del_historial con distintas ventanas
+- procesado_bhagavad_gita_txt_corregido.extraer_capitulos_versos sobre Bhagavad-Gita-Anonimo.txt
+- IndiceShingles.analizar (citas textuales y fundamentación) sobre una respuesta sintética
+
+Uso (desde la raíz del repositorio):
+    python -m benchmarks.micro
+    python -m benchmarks.micro --filtro prompt --guardar-base
+    python -m benchmarks.micro --comparar --tolerancia 0.15
+"""
+
+import argparse
+import contextlib
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+BASE_POR_DEFECTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_micro.json")
+TXT_GITA = os.path.join(RAIZ, "Bhagavad-Gita-Anonimo.txt")
+JSON_GITA = os.path.join(RAIZ, "bhagavad_gita_txt_corregido.json")
+
+ROMANOS = ['', 'I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X',
+           'XI', 'XII', 'XIII', 'XIV', 'XV', 'XVI', 'XVII', 'XVIII']
+
+
+@contextlib.contextmanager
+def _silencio():
+    """Descarta la salida por consola del código medido."""
+    with open(os.devnull, "w", encoding="utf-8") as nulo, contextlib.redirect_stdout(nulo):
+        yield
+
+
+def medir(funcion, tiempo_minimo: float = 0.5, repeticiones: int = 3) -> dict:
+    """ops/s (mejor de varias repeticiones), tiempo medio y asignaciones de una llamada."""
+    funcion()  # calentamiento
+
+    mejor = float("inf")
+    for _ in range(repeticiones):
+        n = 0
+        gc.collect()
+        inicio = time.perf_counter()
+        while True:
+            funcion()
+            n += 1
+            transcurrido = time.perf_counter() - inicio
+            if transcurrido >= tiempo_minimo / repeticiones:
+                break
+        mejor = min(mejor, transcurrido / n)
+
+    gc.collect()
+    tracemalloc.start()
+    antes = tracemalloc.take_snapshot()
+    funcion()
+    despues = tracemalloc.take_snapshot()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    bloques = sum(max(0, s.count_diff) for s in despues.compare_to(antes, "lineno"))
+
+    return {
+        "ops_s": round(1.0 / mejor, 2),
+        "media_ms": round(mejor * 1000, 4),
+        "pico_kb": round(pico / 1024, 1),
+        "asignaciones_retenidas": bloques,
+    }
+
+
+def cargar_corpus() -> dict:
+    if os.path.exists(JSON_GITA):
+        with open(JSON_GITA, encoding="utf-8") as f:
+            return json.load(f)
+    from procesado_bhagavad_gita_txt_corregido import extraer_capitulos_versos
+    with open(TXT_GITA, encoding="utf-8") as f, _silencio():
+        capitulos = extraer_capitulos_versos(f.read())
+    return {"titulo": "Bhagavad Gita", "traductor": "", "capitulos": capitulos}
+
+
+def _versos_krishna(bhagavad_gita: dict) -> list[tuple[int, int]]:
+    return [
+        (int(c), int(v))
+        for c, cap in bhagavad_gita["capitulos"].items()
+        for v, verso in cap["versos"].items()
+        if v.isdigit() and "El Bienaventurado Señor" in verso.get("locutor", "")
+    ]
+
+
+def historial_sintetico(bhagavad_gita: dict, mensajes: int, rng: random.Random) -> list[dict]:
+    """Historial alternando Arjuna/Krishna; cada respuesta cita dos versos reales."""
+    versos = _versos_krishna(bhagavad_gita) or [(2, 47)]
+    historial = []
+    for i in range(mensajes):
+        if i % 2 == 0:
+            historial.append({"role": "user", "content": "¿Cómo actuar sin apego a los frutos?"})
+        else:
+            citas = " ".join(f"Sabe que... [C. {ROMANOS[c]} - {v}]." for c, v in rng.sample(versos, 2))
+            historial.append({"role": "assistant", "content": f"Mi querido Arjuna, escucha. {citas}"})
+    return historial
+
+
+def bench_rag(bhagavad_gita: dict, rng: random.Random) -> dict:
+    try:
+        import numpy as np
+        from rag_krishna import RAGKrishna
+    except ImportError as e:
+        return {"rag_obtener_versos_relevantes": {"omitido": f"dependencia no disponible: {e}"}}
+
+    generador = np.random.default_rng(rng.randint(0, 2**31))
+    rag = RAGKrishna.__new__(RAGKrishna)
+    rag.bhagavad_gita = bhagavad_gita
+    rag.api_rotator = None
+    rag.verse_embeddings = []
+    for c, cap in bhagavad_gita["capitulos"].items():
+        for v, verso in cap["versos"].items():
+            if not v.isdigit():
+                continue
+            locutor = verso.get("locutor", "")
+            rag.verse_embeddings.append({
+                "capitulo": int(c), "verso": int(v),
+                "texto_completo": f"Capítulo {c}, Verso {v} ({locutor}): {verso.get('texto', '')}",
+                "locutor": locutor,
+                "es_krishna": "El Bienaventurado Señor" in locutor,
+                "embedding": generador.standard_normal(768).astype(np.float32).tolist(),
+            })
+    consulta = generador.standard_normal(768).astype(np.float32).tolist()
+    rag._get_embedding = lambda texto: consulta
+    bloqueados = {f"{c}:{v}" for c, v in _versos_krishna(bhagavad_gita)[:16]}
+    return {
+        "rag_obtener_versos_relevantes": medir(
+            lambda: rag.obtener_versos_relevantes("¿Cuál es mi dharma?", top_k=25, versos_citados_previos=bloqueados)
+        )
+    }
+
+
+def bench_prompt(bhagavad_gita: dict, rng: random.Random) -> dict:
+    from gita_loader import obtener_versos_contexto
+    from prompt_builder import completar_prompt_krishna, construir_prompt_krishna, preparar_prompt_krishna
+
+    contexto = obtener_versos_contexto(bhagavad_gita)
+    resultados = {}
+    for longitud in (0, 2, 8, 32):
+        historial = historial_sintetico(bhagavad_gita, longitud, rng)
+        resultados[f"construir_prompt_historial_{longitud}"] = medir(
+            lambda h=historial: construir_prompt_krishna(
+                "¿Cuál es mi dharma?", contexto, bhagavad_gita, h, "Arjuna", "Masculino")
+        )
+    # Lo que queda en el camino crítico cuando el motor ya precalculó el turno
+    preparado = preparar_prompt_krishna(contexto, bhagavad_gita, historial_sintetico(bhagavad_gita, 8, rng),
+                                        "Arjuna", "Masculino")
+    pregunta = {"role": "user", "content": "¿Cuál es mi dharma?"}
+    resultados["completar_prompt_precalculado"] = medir(
+        lambda: completar_prompt_krishna(preparado, pregunta["content"], pregunta))
+    return resultados
+
+
+def bench_historial(bhagavad_gita: dict, rng: random.Random) -> dict:
+    from prompt_builder import extraer_versos_citados_del_historial
+
+    historial = historial_sintetico(bhagavad_gita, 256, rng)
+    return {
+        f"extraer_citados_ventana_{ventana}": medir(
+            lambda v=ventana: extraer_versos_citados_del_historial(historial, bhagavad_gita, ventana_prohibicion=v)
+        )
+        for ventana in (2, 8, 32, 128)
+    }
+
+
+def bench_parser(bhagavad_gita: dict, rng: random.Random) -> dict:
+    from procesado_bhagavad_gita_txt_corregido import extraer_capitulos_versos
+
+    with open(TXT_GITA, encoding="utf-8") as f:
+        contenido = f.read()
+
+    def parsear():
+        with _silencio():
+            extraer_capitulos_versos(contenido)
+
+    return {"parser_extraer_capitulos_versos": medir(parsear, tiempo_minimo=1.0)}
+
+
+def bench_citas(bhagavad_gita: dict, rng: random.Random) -> dict:
+    from indice_shingles import IndiceShingles
+
+    indice = IndiceShingles(bhagavad_gita)
+    versos = _versos_krishna(bhagavad_gita) or [(2, 47)]
+    partes = ["Mi querido Arjuna, escucha con atención."]
+    for c, v in rng.sample(versos, min(3, len(versos))):
+        texto = bhagavad_gita["capitulos"][str(c)]["versos"][str(v)].get("texto", "")
+        partes.append(f"Sabe que {texto} [C. {ROMANOS[c]} - {v}].")
+    respuesta = " ".join(partes)
+    return {"analizar_respuesta": medir(lambda: indice.analizar(respuesta, bhagavad_gita=bhagavad_gita))}
+
+
+BENCHMARKS = {
+    "rag": bench_rag,
+    "prompt": bench_prompt,
+    "historial": bench_historial,
+    "parser": bench_parser,
+    "citas": bench_citas,
+}
+
+
+def comparar(resultados: dict, base: dict, tolerancia: float) -> list[str]:
+    """Regresiones de ops/s o de memoria pico por encima de la tolerancia relativa."""
+    regresiones = []
+    for nombre, actual in resultados.items():
+        referencia = base.get(nombre)
+        if not referencia or "ops_s" not in actual or "ops_s" not in referencia:
+            continue
+        if actual["ops_s"] < referencia["ops_s"] * (1 - tolerancia):
+            regresiones.append(f"{nombre}: ops/s {referencia['ops_s']} → {actual['ops_s']}")
+        if referencia["pico_kb"] and actual["pico_kb"] > referencia["pico_kb"] * (1 + tolerancia):
+            regresiones.append(f"{nombre}: pico {referencia['pico_kb']} KB → {actual['pico_kb']} KB")
+    return regresiones
+
+
+def imprimir(resultados: dict, base: dict | None):
+    print(f"{'benchmark':42} {'ops/s':>12} {'ms':>10} {'pico KB':>10} {'vs base':>9}")
+    for nombre, r in resultados.items():
+        if "omitido" in r:
+            print(f"{nombre:42} {'omitido: ' + r['omitido']}")
+            continue
+        delta = ""
+        if base and nombre in base and base[nombre].get("ops_s"):
+            delta = f"{r['ops_s'] / base[nombre]['ops_s'] - 1:+.1%}"
+        print(f"{nombre:42} {r['ops_s']:>12.2f} {r['media_ms']:>10.3f} {r['pico_kb']:>10.1f} {delta:>9}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Microbenchmarks de Krishna AI")
+    parser.add_argument("--filtro", choices=sorted(BENCHMARKS), action="append",
+                        help="ejecutar solo estos grupos (repetible)")
+    parser.add_argument("--semilla", type=int, default=1234)
+    parser.add_argument("--base", default=BASE_POR_DEFECTO)
+    parser.add_argument("--guardar-base", action="store_true")
+    parser.add_argument("--comparar", action="store_true")
+    parser.add_argument("--tolerancia", type=float, default=0.2)
+    parser.add_argument("--salida", help="escribir los resultados en este JSON")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.semilla)
+    bhagavad_gita = cargar_corpus()
+    resultados = {}
+    for nombre in args.filtro or BENCHMARKS:
+        resultados.update(BENCHMARKS[nombre](bhagavad_gita, rng))
+
+    base = None
+    if os.path.exists(args.base):
+        with open(args.base, encoding="utf-8") as f:
+            base = json.load(f)
+    imprimir(resultados, base)
+
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+    if args.guardar_base:
+        combinada = dict(base or {})
+        combinada.update({k: v for k, v in resultados.items() if "omitido" not in v})
+        with open(args.base, "w", encoding="utf-8") as f:
+            json.dump(combinada, f, ensure_ascii=False, indent=2)
+        print(f"Línea base guardada en {args.base}")
+    if args.comparar:
+        if base is None:
+            print(f"No existe la línea base {args.base}; ejecuta con --guardar-base")
+            return 2
+        regresiones = comparar(resultados, base, args.tolerancia)
+        for r in regresiones:
+            print(f"REGRESIÓN {r}")
+        return 1 if regresiones else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
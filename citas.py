@@ -0,0 +1,139 @@
+"""
+Extracción y validación de citas del Bhagavad Gita en las respuestas del modelo.
+
+Un único patrón compilado reconoce todas las formas de cita que emite el
+modelo y las normaliza a claves de verso "capítulo:verso":
+    [C. XII - 45]   [C. 12 - 45]   [C. II - 47-48]   [Cap. II, 47]
+    (Capítulo 2, verso 47)   Capítulo XII, versos 13 y 14   BG 2.47
+
+EscanerCitas procesa la respuesta fragmento a fragmento mientras llega en
+streaming; extraer_citas hace lo mismo sobre un texto completo. Las citas se
+validan contra el corpus (existe el verso, lo pronuncia Krishna) y se
+devuelven como estructuras, para que el post-procesado y la anti-repetición
+no vuelvan a parsear el texto.
+"""
+
+import re
+from dataclasses import dataclass
+
+import tablas_corpus
+
+_CAPITULO = r"[IVXLC]+|\d{1,2}"
+_RANGO = r"\d{{1,3}})(?:\s*(?:[-–]|y)\s*(?P<{fin}>\d{{1,3}}))?"
+
+PATRON_CITA = re.compile(
+    # [C. XII - 45], [Cap. 12, 45], [C. II - 47-48], [C. II - v. 47]
+    r"\[\s*C(?:ap(?:[íi]tulo)?)?\.?\s*(?P<cap_a>" + _CAPITULO + r")\s*[-–—,:.]\s*(?:v(?:ersos?)?\.?\s*)?"
+    r"(?P<ver_a>" + _RANGO.format(fin="fin_a") + r"\s*\]"
+    # Capítulo 2, verso 47 / Capítulo XII, versos 13 y 14
+    r"|Cap[íi]tulo\s+(?P<cap_b>" + _CAPITULO + r"),?\s+versos?\s+(?P<ver_b>" + _RANGO.format(fin="fin_b") +
+    # BG 2.47 / Gita 2:47
+    r"|\b(?:BG|Gita)\s+(?P<cap_c>\d{1,2})[.:](?P<ver_c>\d{1,3})\b",
+    re.IGNORECASE,
+)
+
+# Una cita nunca es más larga que esto: lo que quede más cerca del final del
+# búfer puede estar incompleto y se espera al siguiente fragmento.
+LONGITUD_MAXIMA_CITA = 48
+MAX_VERSOS_RANGO = 10
+
+
+@dataclass(frozen=True)
+class Cita:
+    """Una cita normalizada a un verso (los rangos se expanden en varias)."""
+    capitulo: int
+    verso: int
+    texto: str            # texto tal como aparece en la respuesta
+    inicio: int           # posición en la respuesta
+    fin: int
+    existe: bool | None = None       # None si no se validó contra un corpus
+    es_krishna: bool | None = None
+
+    @property
+    def clave(self) -> str:
+        return f"{self.capitulo}:{self.verso}"
+
+    @property
+    def valida(self) -> bool:
+        return bool(self.existe)
+
+
+def _numero_capitulo(texto: str):
+    if texto.isdigit():
+        return int(texto)
+    return tablas_corpus.ROMANO_A_ARABIGO.get(texto.upper())
+
+
+def _citas_de(match: re.Match, desplazamiento: int, bhagavad_gita) -> list[Cita]:
+    for sufijo in ("a", "b", "c"):
+        cap_texto = match.group(f"cap_{sufijo}")
+        if cap_texto:
+            break
+    capitulo = _numero_capitulo(cap_texto)
+    if capitulo is None:
+        return []
+    primero = int(match.group(f"ver_{sufijo}"))
+    ultimo = int(match.groupdict().get(f"fin_{sufijo}") or primero)
+    if not primero <= ultimo < primero + MAX_VERSOS_RANGO:
+        ultimo = primero
+    citas = []
+    for verso in range(primero, ultimo + 1):
+        existe = es_krishna = None
+        if bhagavad_gita is not None:
+            datos = bhagavad_gita['capitulos'].get(str(capitulo), {}).get('versos', {})
+            existe = str(verso) in datos
+            es_krishna = existe and tablas_corpus.es_krishna(datos[str(verso)])
+        citas.append(Cita(capitulo, verso, match.group(0), desplazamiento + match.start(),
+                          desplazamiento + match.end(), existe, es_krishna))
+    return citas
+
+
+def extraer_citas(texto: str, bhagavad_gita: dict | None = None) -> list[Cita]:
+    """Todas las citas de un texto completo, en orden de aparición."""
+    citas = []
+    for match in PATRON_CITA.finditer(texto):
+        citas.extend(_citas_de(match, 0, bhagavad_gita))
+    return citas
+
+
+class EscanerCitas:
+    """
+    Escáner incremental: alimentar() con cada fragmento del streaming devuelve
+    las citas completadas hasta ese momento; cerrar() devuelve las últimas.
+    """
+
+    def __init__(self, bhagavad_gita: dict | None = None):
+        self.bhagavad_gita = bhagavad_gita
+        self.citas: list[Cita] = []
+        self._bufer = ""
+        self._base = 0      # posición en la respuesta del inicio del búfer
+
+    def _escanear(self, final: bool) -> list[Cita]:
+        limite = len(self._bufer) if final else len(self._bufer) - LONGITUD_MAXIMA_CITA
+        nuevas = []
+        consumido = 0
+        for match in PATRON_CITA.finditer(self._bufer):
+            if match.start() >= limite:
+                break
+            nuevas.extend(_citas_de(match, self._base, self.bhagavad_gita))
+            consumido = match.end()
+        consumido = max(consumido, limite, 0)
+        self._bufer = self._bufer[consumido:]
+        self._base += consumido
+        self.citas.extend(nuevas)
+        return nuevas
+
+    def alimentar(self, fragmento: str) -> list[Cita]:
+        self._bufer += fragmento
+        return self._escanear(final=False)
+
+    def cerrar(self) -> list[Cita]:
+        return self._escanear(final=True)
+
+    def claves(self) -> set[str]:
+        return {c.clave for c in self.citas}
+
+
+def claves(citas: list[Cita]) -> list[str]:
+    """Claves únicas en orden de aparición (forma compacta para el historial)."""
+    return list(dict.fromkeys(c.clave for c in citas))
@@ -0,0 +1,111 @@
+"""
+Clasificación local de las preguntas y perfil de generación por tipo.
+
+Los tipos son los que ya distingue el prompt de Krishna:
+    saludo       "hola", "buenos días", "gracias"
+    casual       preguntas sin contenido espiritual ("¿te gusta el fútbol?")
+    espiritual   preguntas espirituales genuinas (por defecto)
+    filosofica   doctrina central: dharma, karma, moksha, atman, gunas...
+
+clasificar_pregunta() usa solo vocabulario y longitud (sin red ni
+embeddings, unos microsegundos). Cada tipo tiene un PerfilConsulta con el
+tamaño del contexto, el máximo de tokens de salida y el modelo; un saludo no
+necesita 80K tokens de versos ni el modelo completo. Ante la duda se elige
+espiritual, que conserva el contexto y el modelo de siempre.
+"""
+
+import os
+from dataclasses import dataclass
+
+import indice_shingles
+
+MODELO_LIGERO = os.environ.get("KRISHNAI_MODELO_LIGERO", "gemini-2.0-flash-lite")
+MODELO_ESTANDAR = os.environ.get("KRISHNAI_MODELO", "gemini-2.0-flash")
+# Modelo para la doctrina central; p. ej. KRISHNAI_MODELO_PROFUNDO=gemini-2.5-pro
+MODELO_PROFUNDO = os.environ.get("KRISHNAI_MODELO_PROFUNDO", MODELO_ESTANDAR)
+
+MAX_TOKENS_CONTEXTO = 80000
+# Palabras a partir de las cuales un mensaje ya no es un saludo
+MAX_PALABRAS_SALUDO = 5
+
+SALUDOS = frozenset("""
+hola holi buenas buenos dias tardes noches hi hello hey saludos namaste namaskar om
+gracias muchas mil adios hasta luego pronto manana chao bienvenido que tal como estas
+estas krishna senor mi querido bien muy
+""".split())
+
+# Vocabulario que debe estar presente para que un mensaje sea saludo (no solo relleno)
+NUCLEO_SALUDO = frozenset("hola holi buenas buenos hi hello hey saludos namaste namaskar gracias adios chao".split())
+
+# Solo términos que por sí solos señalan doctrina; palabras corrientes como "ser",
+# "sentido" o "verdad" aparecen en cualquier pregunta y no deciden el perfil
+DOCTRINA = frozenset("""
+dharma karma moksha moksa atman atma brahman paramatma samsara maya guna gunas sattva rajas tamas
+yoga jnana bhakti sannyasa renuncia liberacion reencarnacion renacimiento muerte inmortal
+inmortalidad eterno eternidad alma deber accion inaccion fruto frutos destino proposito
+existencia conocimiento sabiduria ignorancia ilusion purusha prakriti
+conciencia ego apego desapego deseo deseos
+""".split())
+
+ESPIRITUAL = frozenset("""
+espiritual espiritualidad dios dioses divino divina sagrado meditacion meditar mente paz serenidad
+devocion devoto oracion rezar fe amor compasion sufrimiento sufrir dolor miedo ira odio envidia
+angustia ansiedad tristeza felicidad alegria perdon perdonar camino vida vivir morir sacrificio
+ofrenda adoracion guru maestro discipulo virtud pecado bien mal justicia guerra batalla luchar
+familia hijo padre madre trabajo
+""".split())
+
+CASUAL = frozenset("""
+futbol deporte deportes pelicula peliculas serie series musica cancion canciones
+comida comer cocinar receta pizza coche coches movil telefono ordenador videojuego videojuegos
+politica politico elecciones clima lluvia playa vacaciones viaje moda ropa
+favorito chiste broma bromas gusta gustan opinas piensas
+""".split())
+
+
+@dataclass(frozen=True)
+class PerfilConsulta:
+    tipo: str
+    max_tokens_contexto: int
+    max_output_tokens: int
+    modelo: str
+
+
+PERFILES = {
+    "saludo": PerfilConsulta("saludo", 6000, 200, MODELO_LIGERO),
+    "casual": PerfilConsulta("casual", 6000, 300, MODELO_LIGERO),
+    "espiritual": PerfilConsulta("espiritual", MAX_TOKENS_CONTEXTO, 1200, MODELO_ESTANDAR),
+    "filosofica": PerfilConsulta("filosofica", MAX_TOKENS_CONTEXTO, 1200, MODELO_PROFUNDO),
+}
+
+
+def _formas(palabra: str) -> tuple[str, ...]:
+    """La palabra y su singular aproximado ("deseos" → "deseo", "pasiones" → "pasion")."""
+    if len(palabra) > 4 and palabra.endswith("es"):
+        return palabra, palabra[:-2], palabra[:-1]
+    if len(palabra) > 3 and palabra.endswith("s"):
+        return palabra, palabra[:-1]
+    return (palabra,)
+
+
+def clasificar_pregunta(pregunta: str) -> str:
+    """Tipo de la pregunta: saludo, casual, espiritual o filosofica."""
+    lista = indice_shingles.palabras(pregunta)
+    if not lista:
+        return "saludo"
+    # Un saludo solo tiene palabras de SALUDOS, así que se reconoce antes que el
+    # vocabulario espiritual, que comparte alguna ("muy bien, gracias")
+    if len(lista) <= MAX_PALABRAS_SALUDO and set(lista) <= SALUDOS and set(lista) & NUCLEO_SALUDO:
+        return "saludo"
+    formas = {forma for palabra in lista for forma in _formas(palabra)}
+    if formas & DOCTRINA:
+        return "filosofica"
+    if formas & ESPIRITUAL:
+        return "espiritual"
+    if formas & CASUAL:
+        return "casual"
+    return "espiritual"
+
+
+def perfil_para(pregunta: str, perfiles: dict | None = None) -> PerfilConsulta:
+    return (perfiles or PERFILES)[clasificar_pregunta(pregunta)]
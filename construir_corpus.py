@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Pipeline de construcción del corpus multi-traducción de Krishna AI.
+
+Toma varias fuentes (traducciones y comentarios), localiza los límites de
+capítulo con un pre-escaneo rápido, parsea los capítulos en paralelo en un
+pool de procesos, valida el número de versos por capítulo y escribe un único
+artefacto versionado (corpus_gita.json) con una alineación de versos por
+traducción. El cargador en tiempo de ejecución y el indexador de embeddings
+consumen ese único archivo precompilado, o su versión binaria mapeable en
+memoria (corpus_gita.bin, ver corpus_binario.py).
+
+Uso:
+    python construir_corpus.py                       # fuentes de corpus_fuentes.json
+    python construir_corpus.py --manifiesto otras_fuentes.json --estricto
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import corpus_binario
+import procesado_bhagavad_gita_txt_corregido
+import tablas_corpus
+from procesado_bhagavad_gita_txt_corregido import ORDINALES, PATRON_CAPITULO, convertir_romano_a_arabigo
+
+FORMATO_CORPUS = "krishnai-corpus"
+VERSION_ESQUEMA = 1
+
+MANIFIESTO_POR_DEFECTO = "corpus_fuentes.json"
+SALIDA_POR_DEFECTO = "corpus_gita.json"
+
+# Numeración canónica (700 versos). Algunas ediciones cuentan 35 versos en el
+# capítulo XIII porque numeran la pregunta inicial de Arjuna como verso 1.
+VERSOS_POR_CAPITULO = {
+    1: 47, 2: 72, 3: 43, 4: 42, 5: 29, 6: 47, 7: 30, 8: 28, 9: 34,
+    10: 42, 11: 55, 12: 20, 13: 34, 14: 27, 15: 20, 16: 24, 17: 28, 18: 78,
+}
+VARIANTES_ADMITIDAS = {13: (34, 35)}
+
+# Parsers por formato de fuente: reciben las líneas de uno o varios capítulos
+PARSERS = {
+    "txt_corregido": procesado_bhagavad_gita_txt_corregido.extraer_capitulos_versos,
+}
+
+
+def _numero_capitulo(texto: str):
+    return ORDINALES.get(texto.lower()) or convertir_romano_a_arabigo(texto) or (int(texto) if texto.isdigit() else None)
+
+
+def prescan_capitulos(path: str) -> list[tuple[int, int, int]]:
+    """
+    Localiza los límites de capítulo sin parsear versos.
+    Devuelve [(capitulo, byte_inicio, byte_fin), ...] en orden de aparición.
+    """
+    limites = []
+    offset = 0
+    with open(path, "rb") as f:
+        for linea in f:
+            texto = linea.decode("utf-8", errors="replace")
+            match = PATRON_CAPITULO.search(texto)
+            if match:
+                numero = _numero_capitulo(match.group(1))
+                if numero is not None:
+                    limites.append((numero, offset))
+            offset += len(linea)
+    return [
+        (numero, inicio, limites[i + 1][1] if i + 1 < len(limites) else offset)
+        for i, (numero, inicio) in enumerate(limites)
+    ]
+
+
+def _parsear_fragmento(tarea: tuple) -> dict:
+    """Parsea un tramo [inicio, fin) del archivo (se ejecuta en un proceso del pool)."""
+    path, formato, inicio, fin = tarea
+    with open(path, "rb") as f:
+        f.seek(inicio)
+        texto = f.read(fin - inicio).decode("utf-8", errors="replace")
+    return PARSERS[formato](io.StringIO(texto))
+
+
+def _fusionar(destino: dict, parcial: dict):
+    """Fusiona capítulos parseados por tramos, igual que lo haría una pasada única."""
+    for cap, datos in parcial.items():
+        if cap not in destino:
+            destino[cap] = {"titulo": datos["titulo"], "versos": dict(datos["versos"])}
+        else:
+            if datos["titulo"]:
+                destino[cap]["titulo"] = datos["titulo"]
+            destino[cap]["versos"].update(datos["versos"])
+
+
+def validar_capitulos(capitulos: dict) -> dict:
+    """Compara los versos encontrados con la numeración canónica."""
+    informe = {}
+    for cap, esperados in VERSOS_POR_CAPITULO.items():
+        versos = capitulos.get(str(cap), {}).get("versos", {})
+        numeros = {int(v) for v in versos if v.isdigit()}
+        admitidos = VARIANTES_ADMITIDAS.get(cap, (esperados,))
+        limite = max(admitidos)
+        informe[str(cap)] = {
+            "encontrados": len(numeros),
+            "esperados": esperados,
+            "faltan": sorted(set(range(1, min(admitidos) + 1)) - numeros),
+            "sobran": sorted(n for n in numeros if n > limite),
+            "no_numericos": sorted(v for v in versos if not v.isdigit()),
+            "ok": len(numeros) in admitidos and all(1 <= n <= limite for n in numeros),
+        }
+    return informe
+
+
+def desplazamiento_alineacion(capitulos: dict, cap: int) -> int:
+    """Versos extra al inicio del capítulo respecto a la numeración canónica."""
+    if cap == 13 and len(capitulos.get("13", {}).get("versos", {})) >= 35:
+        return 1
+    return 0
+
+
+def construir_alineacion(traducciones: dict) -> dict:
+    """
+    Para cada verso canónico "c:v", la clave del verso en cada traducción.
+    Solo se incluyen las traducciones que contienen ese verso.
+    """
+    alineacion = {}
+    for cap, total in VERSOS_POR_CAPITULO.items():
+        for verso in range(1, total + 1):
+            fila = {}
+            for trad_id, trad in traducciones.items():
+                capitulos = trad["capitulos"]
+                clave = str(verso + desplazamiento_alineacion(capitulos, cap))
+                if clave in capitulos.get(str(cap), {}).get("versos", {}):
+                    fila[trad_id] = f"{cap}:{clave}"
+            if fila:
+                alineacion[f"{cap}:{verso}"] = fila
+    return alineacion
+
+
+def _aplicar_comentario(traduccion: dict, comentario: dict, alineacion: dict, trad_id: str, com_id: str):
+    """Vuelca el texto de un comentario en el campo 'significado' de los versos alineados."""
+    for fila in alineacion.values():
+        if trad_id not in fila or com_id not in fila:
+            continue
+        cap_t, ver_t = fila[trad_id].split(":")
+        cap_c, ver_c = fila[com_id].split(":")
+        texto = comentario["capitulos"][cap_c]["versos"][ver_c].get("texto", "")
+        if texto:
+            traduccion["capitulos"][cap_t]["versos"][ver_t]["significado"] = texto
+
+
+def _hash_fuentes(fuentes: list[dict]) -> str:
+    h = hashlib.sha256()
+    for fuente in fuentes:
+        h.update(fuente["id"].encode("utf-8"))
+        with open(fuente["fuente"], "rb") as f:
+            for bloque in iter(lambda: f.read(1 << 16), b""):
+                h.update(bloque)
+    return h.hexdigest()[:16]
+
+
+def cargar_manifiesto(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        fuentes = json.load(f)["fuentes"]
+    for fuente in fuentes:
+        fuente.setdefault("tipo", "traduccion")
+        fuente.setdefault("formato", "txt_corregido")
+        if fuente["formato"] not in PARSERS:
+            raise ValueError(f"Formato desconocido para {fuente['id']}: {fuente['formato']}")
+    return fuentes
+
+
+def construir_corpus(fuentes: list[dict], output_path: str = SALIDA_POR_DEFECTO,
+                     max_workers: int | None = None, estricto: bool = False,
+                     binario: bool = True) -> dict | None:
+    """Ejecuta el pipeline completo y escribe el artefacto. Devuelve el corpus o None si falla."""
+    print("🕉️  CONSTRUYENDO CORPUS MULTI-TRADUCCIÓN")
+    print("=" * 50)
+
+    tareas, origen = [], []
+    for fuente in fuentes:
+        if not os.path.exists(fuente["fuente"]):
+            print(f"❌ Error: Archivo {fuente['fuente']} no encontrado")
+            return None
+        limites = prescan_capitulos(fuente["fuente"])
+        print(f"📄 {fuente['id']}: {len(limites)} capítulos localizados en {fuente['fuente']}")
+        for _, inicio, fin in limites:
+            tareas.append((fuente["fuente"], fuente["formato"], inicio, fin))
+            origen.append(fuente["id"])
+
+    parsed = {fuente["id"]: {} for fuente in fuentes}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        # map conserva el orden: los tramos se fusionan en orden de aparición
+        for fuente_id, parcial in zip(origen, pool.map(_parsear_fragmento, tareas, chunksize=2)):
+            _fusionar(parsed[fuente_id], parcial)
+
+    traducciones, comentarios, validacion = {}, {}, {}
+    for fuente in fuentes:
+        capitulos = {c: parsed[fuente["id"]][c] for c in sorted(parsed[fuente["id"]], key=int)}
+        entrada = {
+            "tipo": fuente["tipo"],
+            "idioma": fuente.get("idioma", ""),
+            "traductor": fuente.get("traductor", ""),
+            "fuente": fuente["fuente"],
+            "titulo": fuente.get("titulo", "Bhagavad Gita"),
+            "total_capitulos": len(capitulos),
+            "capitulos": capitulos,
+        }
+        validacion[fuente["id"]] = validar_capitulos(capitulos)
+        (comentarios if fuente["tipo"] == "comentario" else traducciones)[fuente["id"]] = entrada
+        if fuente["tipo"] == "comentario":
+            entrada["comenta"] = fuente.get("comenta")
+
+    if not traducciones:
+        print("❌ Error: el manifiesto no contiene ninguna traducción")
+        return None
+
+    alineacion = construir_alineacion({**traducciones, **comentarios})
+    for com_id, comentario in comentarios.items():
+        if comentario.get("comenta") in traducciones:
+            _aplicar_comentario(traducciones[comentario["comenta"]], comentario, alineacion,
+                                comentario["comenta"], com_id)
+    # Tablas derivadas (texto_completo, citas, conteos) una vez fijado el significado
+    for traduccion in traducciones.values():
+        traduccion["tablas"] = tablas_corpus.anotar_capitulos(traduccion["capitulos"])
+
+    principal = next((f["id"] for f in fuentes if f.get("principal")), next(iter(traducciones)))
+    corpus = {
+        "formato": FORMATO_CORPUS,
+        "version_esquema": VERSION_ESQUEMA,
+        "version": _hash_fuentes(fuentes),
+        "generado": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "principal": principal,
+        "traducciones": traducciones,
+        "comentarios": {k: {kk: vv for kk, vv in v.items() if kk != "capitulos"} for k, v in comentarios.items()},
+        "alineacion": alineacion,
+        "validacion": validacion,
+    }
+
+    print("\n📊 VALIDACIÓN DE VERSOS POR CAPÍTULO:")
+    errores = 0
+    for fuente_id, informe in validacion.items():
+        for cap, datos in informe.items():
+            if not datos["ok"]:
+                errores += 1
+                print(f"   ⚠️  {fuente_id} cap {cap}: {datos['encontrados']}/{datos['esperados']} "
+                      f"(faltan {datos['faltan']}, sobran {datos['sobran']})")
+    if not errores:
+        print("   ✅ Todos los capítulos tienen el número de versos esperado")
+    if estricto and errores:
+        print("❌ Validación estricta fallida; no se escribe el corpus")
+        return None
+
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(corpus, f, ensure_ascii=False, separators=(",", ":"))
+    print(f"\n✅ Corpus {corpus['version']} guardado en {output_path} "
+          f"({os.path.getsize(output_path) / 1024:.1f} KB, {len(traducciones)} traducciones, "
+          f"{len(alineacion)} versos alineados)")
+
+    if binario:
+        ruta_binario = os.path.splitext(output_path)[0] + ".bin"
+        tamano = corpus_binario.escribir_binario(corpus, ruta_binario)
+        print(f"✅ Corpus binario guardado en {ruta_binario} ({tamano / 1024:.1f} KB)")
+    return corpus
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Construye el corpus multi-traducción de Krishna AI")
+    parser.add_argument("--manifiesto", default=MANIFIESTO_POR_DEFECTO)
+    parser.add_argument("--salida", default=SALIDA_POR_DEFECTO)
+    parser.add_argument("--procesos", type=int, default=None)
+    parser.add_argument("--estricto", action="store_true", help="fallar si algún capítulo no cuadra")
+    parser.add_argument("--sin-binario", action="store_true", help="no generar el artefacto binario (.bin)")
+    args = parser.parse_args(argv)
+
+    corpus = construir_corpus(cargar_manifiesto(args.manifiesto), args.salida, args.procesos, args.estricto,
+                              binario=not args.sin_binario)
+    return 0 if corpus else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+"""
+Artefacto binario compacto del corpus con carga perezosa del texto de los versos.
+
+Formato (little-endian):
+    cabecera   8s magia | H versión | H reservado | I nº versos | I bytes meta | Q off tabla | Q off texto
+    meta       JSON UTF-8: traducciones, títulos de capítulo y rangos de la tabla, locutores
+    tabla      registros de ancho fijo: traducción, capítulo, verso, locutor y
+               offset/longitud de cada campo de CAMPOS_TEXTO
+    texto      un único blob UTF-8 con todos los textos
+
+Cada verso guarda su 'texto_completo' tal cual, sin formatearlo al leer. El
+texto y el significado son subcadenas suyas, así que sus offsets apuntan
+dentro de él y no se duplican en el blob.
+
+La carga es un mmap más el parseo de la cabecera: el texto de un verso solo se
+decodifica cuando se accede a él y no se guarda, así que varios procesos
+comparten la misma copia en la caché de páginas del sistema.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+from collections.abc import Mapping
+
+import tablas_corpus
+
+MAGIA = b"KGITABIN"
+VERSION_BINARIO = 4
+
+CAMPOS_TEXTO = ("texto", "significado", "texto_completo")
+CABECERA = struct.Struct("<8sHHIIQQ")
+REGISTRO = struct.Struct("<HHHH" + "II" * len(CAMPOS_TEXTO))
+
+
+def escribir_binario(corpus: dict, path: str) -> int:
+    """Escribe el artefacto binario a partir del corpus de construir_corpus.py. Devuelve los bytes escritos."""
+    locutores = {}
+    registros = []
+    blob = bytearray()
+    traducciones = []
+
+    def añadir_texto(texto: str) -> tuple[int, int]:
+        datos = texto.encode("utf-8")
+        offset = len(blob)
+        blob.extend(datos)
+        return offset, len(datos)
+
+    def añadir_verso(cap: str, verso: str, datos: dict) -> list[int]:
+        inicio, longitud = añadir_texto(tablas_corpus.texto_completo(cap, verso, datos))
+        completo = bytes(blob[inicio:])
+        campos = []
+        for campo in CAMPOS_TEXTO[:-1]:
+            parte = datos.get(campo, "").encode("utf-8")
+            dentro = completo.find(parte) if parte else 0
+            campos.extend((inicio + dentro, len(parte)) if dentro >= 0 else añadir_texto(datos[campo]))
+        return campos + [inicio, longitud]
+
+    for indice, (trad_id, trad) in enumerate(corpus["traducciones"].items()):
+        capitulos = {}
+        for cap, datos_cap in trad["capitulos"].items():
+            inicio = len(registros)
+            for verso, datos in datos_cap["versos"].items():
+                if not verso.isdigit():
+                    raise ValueError(f"{trad_id} cap {cap}: clave de verso no numérica {verso!r}")
+                locutor = locutores.setdefault(datos.get("locutor", ""), len(locutores))
+                registros.append((indice, int(cap), int(verso), locutor, *añadir_verso(cap, verso, datos)))
+            capitulos[cap] = {"titulo": datos_cap.get("titulo", ""), "inicio": inicio, "fin": len(registros)}
+        traducciones.append({
+            "id": trad_id,
+            **{k: v for k, v in trad.items() if k != "capitulos"},
+            "capitulos": capitulos,
+        })
+
+    meta = json.dumps({
+        "formato": corpus.get("formato"),
+        "version": corpus.get("version"),
+        "principal": corpus.get("principal"),
+        "traducciones": traducciones,
+        "locutores": list(locutores),
+        "locutores_krishna": [tablas_corpus.LOCUTOR_KRISHNA in locutor for locutor in locutores],
+    }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    off_tabla = CABECERA.size + len(meta)
+    off_texto = off_tabla + REGISTRO.size * len(registros)
+    with open(path, "wb") as f:
+        f.write(CABECERA.pack(MAGIA, VERSION_BINARIO, 0, len(registros), len(meta), off_tabla, off_texto))
+        f.write(meta)
+        for registro in registros:
+            f.write(REGISTRO.pack(*registro))
+        f.write(blob)
+    return off_texto + len(blob)
+
+
+class VersosPerezosos(Mapping):
+    """Versos de un capítulo: se decodifican del mmap al acceder a cada uno."""
+
+    def __init__(self, corpus: "CorpusBinario", inicio: int, fin: int):
+        self._corpus = corpus
+        self._inicio = inicio
+        self._fin = fin
+        self._indice = None
+
+    def _claves(self) -> dict:
+        if self._indice is None:
+            tabla = self._corpus._tabla
+            self._indice = {
+                str(REGISTRO.unpack_from(tabla, i * REGISTRO.size)[2]): i
+                for i in range(self._inicio, self._fin)
+            }
+        return self._indice
+
+    def __getitem__(self, verso: str) -> dict:
+        return self._corpus._verso(self._claves()[verso])
+
+    def __contains__(self, verso) -> bool:
+        return verso in self._claves()
+
+    def __iter__(self):
+        return iter(self._claves())
+
+    def __len__(self) -> int:
+        return self._fin - self._inicio
+
+
+class CorpusBinario:
+    """Vista de solo lectura sobre un artefacto binario mapeado en memoria."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magia, version, _, n_versos, len_meta, off_tabla, off_texto = CABECERA.unpack_from(self._mmap, 0)
+        if magia != MAGIA or version != VERSION_BINARIO:
+            self._mmap.close()
+            raise ValueError(f"{path} no es un corpus binario v{VERSION_BINARIO}")
+        vista = memoryview(self._mmap)
+        self.meta = json.loads(bytes(vista[CABECERA.size:CABECERA.size + len_meta]))
+        self.num_versos = n_versos
+        self._tabla = vista[off_tabla:off_texto]
+        self._texto = vista[off_texto:]
+        self._locutores = self.meta["locutores"]
+        self._locutores_krishna = self.meta["locutores_krishna"]
+
+    def _verso(self, indice: int) -> dict:
+        registro = REGISTRO.unpack_from(self._tabla, indice * REGISTRO.size)
+        locutor = registro[3]
+        verso = {"locutor": self._locutores[locutor], "es_krishna": self._locutores_krishna[locutor]}
+        for i, campo in enumerate(CAMPOS_TEXTO):
+            offset, longitud = registro[4 + 2 * i], registro[5 + 2 * i]
+            verso[campo] = str(self._texto[offset:offset + longitud], "utf-8")
+        return verso
+
+    def traducciones(self) -> list[str]:
+        return [t["id"] for t in self.meta["traducciones"]]
+
+    def traduccion(self, trad_id: str | None = None) -> dict:
+        """Una traducción con la forma clásica {titulo, traductor, capitulos}; los versos son perezosos."""
+        trad_id = trad_id or self.meta["principal"]
+        trad = next(t for t in self.meta["traducciones"] if t["id"] == trad_id)
+        return {
+            "titulo": trad.get("titulo", "Bhagavad Gita"),
+            "traductor": trad.get("traductor", ""),
+            "fuente": trad.get("fuente", ""),
+            "traduccion": trad_id,
+            "version_corpus": self.meta.get("version"),
+            "total_capitulos": len(trad["capitulos"]),
+            "tablas": trad.get("tablas", {}),
+            "capitulos": {
+                cap: {"titulo": datos["titulo"], "versos": VersosPerezosos(self, datos["inicio"], datos["fin"])}
+                for cap, datos in trad["capitulos"].items()
+            },
+        }
+
+
+_abiertos = {}
+_lock = threading.Lock()
+
+
+def abrir(path: str) -> CorpusBinario:
+    """Abre (una vez por proceso y versión del archivo) el corpus binario mapeado en memoria."""
+    clave = (os.path.abspath(path), os.path.getmtime(path))
+    with _lock:
+        corpus = _abiertos.get(clave)
+        if corpus is None:
+            corpus = _abiertos[clave] = CorpusBinario(path)
+        return corpus
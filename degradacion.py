@@ -0,0 +1,312 @@
+"""
+Degradación ordenada cuando no se puede llamar al modelo.
+
+Si todas las claves están bloqueadas (o el modelo agota reintentos o plazo),
+el turno no termina en un error: se responde con el primer escalón
+disponible de esta escalera:
+1. una respuesta ya generada a una pregunta equivalente (CacheRespuestas:
+   mismas palabras significativas, mismo tipo y género, sin versos que la
+   sesión tenga bloqueados). Solo se guardan respuestas a la primera
+   pregunta de una conversación, que no dependen de ningún historial, con
+   MARCA_NOMBRE en lugar del nombre del usuario (plantilla_nombre); una
+   respuesta guardada solo se sirve si todos los términos de su
+   pregunta están en la nueva, así que no puede mencionar nada que el nuevo
+   usuario no haya dicho;
+2. una respuesta compuesta localmente con los versos del contexto más
+   afines a la pregunta, con sus citas [C. X - N] y la voz de Krishna.
+
+El turno degradado queda además en una ColaReintentos: un hilo espera a que
+se desbloquee una clave y lo repite en orden de llegada, con el prompt
+rearmado en ese momento. El hilo no toca la sesión: deja la respuesta en el
+Future del turno y es quien la posee (su siguiente turno, la app o el
+servidor con el cerrojo de la sesión) quien la sustituye en el historial.
+posicion() permite informar al usuario de cuántos turnos tiene delante.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+import indice_shingles
+import metrics
+import tablas_corpus
+import tracing
+
+# Respuestas guardadas para reutilizar y similitud (Jaccard de términos) para considerar equivalente una pregunta
+MAX_RESPUESTAS_CACHE = 500
+UMBRAL_SIMILITUD = 0.6
+# Versos de una respuesta compuesta localmente
+VERSOS_LOCALES = 3
+# Enseñanzas centrales para preguntas sin términos en común con ningún verso
+VERSOS_ESENCIALES = ("2:47", "2:20", "18:66", "6:5", "3:19", "4:7")
+# Prefijo que se compara de cada palabra ("acciones" y "acción" comparten "accion")
+LONGITUD_RAIZ = 6
+# Cola de reintentos: turnos en espera, intentos por turno, espera máxima entre comprobaciones, caducidad
+MAX_PENDIENTES = 100
+MAX_INTENTOS = 3
+ESPERA_MAXIMA_S = 30.0
+CADUCIDAD_S = 3600.0
+
+PALABRAS_VACIAS = frozenset("""
+que como cual cuales cuando donde quien quienes para por porque pero sino esta este esto estos estas
+ese esa eso esos esas aquel aquella una uno unos unas los las del con sin sobre entre hasta desde hacia
+mas muy tan todo toda todos todas algo nada cada otro otra otros otras ser estar hay puedo puede
+debo debe tengo tiene hace hacer sus mis tus nos les lo la el en es se te me mi tu su al de y o a
+""".split())
+
+# Nombre del usuario en las respuestas guardadas; se sustituye al servirlas
+MARCA_NOMBRE = "{NOMBRE}"
+
+
+def terminos(texto: str) -> frozenset:
+    """Raíces de las palabras significativas del texto."""
+    return frozenset(p[:LONGITUD_RAIZ] for p in indice_shingles.palabras(texto)
+                     if len(p) > 2 and p not in PALABRAS_VACIAS)
+
+
+def plantilla_nombre(texto: str, nombre_usuario: str, fuentes) -> str | None:
+    """
+    Respuesta con MARCA_NOMBRE en lugar del nombre del usuario, o None si no
+    se puede guardar: el nombre también aparece en fuentes (lo que el modelo
+    vio además del nombre: instrucciones, pregunta, versos), así que alguna
+    mención podría no ser del usuario.
+    """
+    if not nombre_usuario.strip() or MARCA_NOMBRE in texto:
+        return None
+    patron = re.compile(rf"\b{re.escape(nombre_usuario.strip())}\b", re.IGNORECASE)
+    if any(patron.search(fuente) for fuente in fuentes):
+        return None
+    return patron.sub(MARCA_NOMBRE, texto)
+
+
+def _clave_verso(verso: dict) -> str:
+    return f"{verso['capitulo']}:{verso['verso']}"
+
+
+def ordenar_por_afinidad(pregunta: str, versos: list[dict]) -> list[dict]:
+    """Versos (con 'texto_completo') de más a menos términos en común con la pregunta; estable."""
+    consulta = terminos(pregunta)
+    if not consulta:
+        return list(versos)
+    puntuados = [(len(consulta & terminos(v['texto_completo'])), i) for i, v in enumerate(versos)]
+    return [versos[i] for _, i in sorted(puntuados, key=lambda p: (-p[0], p[1]))]
+
+
+def _texto_verso(bhagavad_gita: dict, verso: dict) -> str:
+    datos = bhagavad_gita['capitulos'][str(verso['capitulo'])]['versos'][str(verso['verso'])]
+    return (datos.get('texto') or verso['texto_completo']).strip()
+
+
+def componer_respuesta_local(pregunta: str, tipo: str, versos_contexto: list[dict], bhagavad_gita: dict,
+                             nombre_usuario: str, genero_usuario: str | None) -> str:
+    """Respuesta sin modelo: saludo o los versos del contexto más afines, citados con su referencia."""
+    from gender_detector import obtener_tratamiento_genero
+    querido = obtener_tratamiento_genero(nombre_usuario, genero_usuario)["querido"]
+    if tipo == "saludo" or not versos_contexto:
+        bienvenido = "Bienvenida" if querido == "querida" else "Bienvenido"
+        return (f"{bienvenido} a mi presencia, mi {querido} {nombre_usuario}. Aquí estoy, como estuve junto a "
+                f"Arjuna en Kurukshetra. Pregúntame lo que inquiete a tu corazón.")
+
+    afines = ordenar_por_afinidad(pregunta, versos_contexto)
+    consulta = terminos(pregunta)
+    elegidos = [v for v in afines[:VERSOS_LOCALES] if consulta & terminos(v['texto_completo'])]
+    if len(elegidos) < VERSOS_LOCALES:
+        por_clave = {_clave_verso(v): v for v in versos_contexto}
+        vistos = {_clave_verso(v) for v in elegidos}
+        esenciales = [por_clave[c] for c in VERSOS_ESENCIALES if c in por_clave and c not in vistos]
+        elegidos += (esenciales or [v for v in afines if _clave_verso(v) not in vistos])[:VERSOS_LOCALES - len(elegidos)]
+
+    aperturas = ("Te digo que", "Sabe que", "Escucha")
+    partes = [f"Mi {querido} {nombre_usuario}, escucha mis palabras."]
+    for apertura, verso in zip(aperturas, elegidos):
+        partes.append(f"{apertura}: \"{_texto_verso(bhagavad_gita, verso)}\" "
+                      f"{tablas_corpus.cita(bhagavad_gita, _clave_verso(verso))}")
+    partes.append(f"Medita en estas enseñanzas, {nombre_usuario}; en ellas está la respuesta que buscas.")
+    return "\n\n".join(partes)
+
+
+@dataclass
+class _RespuestaGuardada:
+    tipo: str
+    genero: str | None
+    plantilla: str          # texto con MARCA_NOMBRE en lugar del nombre del usuario
+    citas: frozenset
+
+
+class CacheRespuestas:
+    """
+    Respuestas del modelo reutilizables para preguntas equivalentes (LRU acotado).
+
+    Se comparte entre todos los usuarios del motor: solo debe recibir
+    respuestas que no dependan del historial, con MARCA_NOMBRE por nombre.
+    """
+
+    def __init__(self, max_entradas: int = MAX_RESPUESTAS_CACHE, umbral: float = UMBRAL_SIMILITUD):
+        self.max_entradas = max_entradas
+        self.umbral = umbral
+        self._entradas: OrderedDict[frozenset, _RespuestaGuardada] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def guardar(self, pregunta: str, tipo: str, plantilla: str, genero: str | None, claves_citas):
+        clave = terminos(pregunta)
+        if not clave or not plantilla.strip():
+            return
+        with self._lock:
+            self._entradas[clave] = _RespuestaGuardada(tipo, genero, plantilla, frozenset(claves_citas))
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def buscar(self, pregunta: str, tipo: str, nombre_usuario: str, genero: str | None,
+               versos_bloqueados=()) -> str | None:
+        """
+        Texto de la respuesta más parecida que la sesión puede usar, o None.
+
+        Solo valen respuestas cuya pregunta no tenga términos ausentes de la
+        nueva: lo que el otro usuario contó de sí mismo no llega a este.
+        """
+        consulta = terminos(pregunta)
+        if not consulta:
+            return None
+        bloqueados = set(versos_bloqueados)
+        mejor, similitud_mejor = None, self.umbral
+        with self._lock:
+            for clave, guardada in self._entradas.items():
+                if (guardada.tipo != tipo or guardada.genero != genero or guardada.citas & bloqueados
+                        or not clave <= consulta):
+                    continue
+                similitud = len(consulta & clave) / len(consulta | clave)
+                if similitud >= similitud_mejor:
+                    mejor, similitud_mejor = (clave, guardada), similitud
+            if mejor is None:
+                return None
+            self._entradas.move_to_end(mejor[0])
+        return mejor[1].plantilla.replace(MARCA_NOMBRE, nombre_usuario)
+
+    def __len__(self) -> int:
+        return len(self._entradas)
+
+
+@dataclass(eq=False)
+class TurnoPendiente:
+    """Turno respondido en modo degradado, a la espera de repetirse con el modelo."""
+    sesion: object                  # krishna_engine.Sesion
+    mensaje: dict                   # respuesta degradada en el historial; se sustituye al reintentar
+    versos_bloqueados: set
+    perfil: object                  # clasificador.PerfilConsulta
+    pregunta: str = ""
+    primero: bool = False           # primera pregunta de la conversación: su respuesta se puede guardar
+    futuro: Future = field(default_factory=Future)
+    creado: float = field(default_factory=time.monotonic)
+    intentos: int = 0
+
+
+class ColaReintentos:
+    """
+    Turnos degradados que se repiten, en orden de llegada, cuando vuelve a
+    haber una clave disponible.
+
+    reintentar(turno) hace la llamada al modelo y devuelve el resultado del
+    Future del turno (None si el turno ya no está en la sesión y no hay nada
+    que repetir); segundos_hasta_clave() es 0 si hay alguna clave disponible
+    o los segundos hasta que se desbloquee la primera.
+    """
+
+    def __init__(self, reintentar, segundos_hasta_clave, max_pendientes: int = MAX_PENDIENTES,
+                 max_intentos: int = MAX_INTENTOS, espera_maxima: float = ESPERA_MAXIMA_S,
+                 caducidad: float = CADUCIDAD_S):
+        self.reintentar = reintentar
+        self.segundos_hasta_clave = segundos_hasta_clave
+        self.max_pendientes = max_pendientes
+        self.max_intentos = max_intentos
+        self.espera_maxima = espera_maxima
+        self.caducidad = caducidad
+        self._pendientes: deque[TurnoPendiente] = deque()
+        self._condicion = threading.Condition()
+        self._hilo = None
+
+    def encolar(self, turno: TurnoPendiente) -> int | None:
+        """Añade el turno; devuelve su posición (1 = el siguiente) o None si la cola está llena."""
+        with self._condicion:
+            if len(self._pendientes) >= self.max_pendientes:
+                metrics.contar("krishnai_reintentos_descartados_total", "Turnos degradados sin reintento",
+                               motivo="cola_llena")
+                return None
+            self._pendientes.append(turno)
+            self._indicador()
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._trabajar, name="krishnai-reintentos", daemon=True)
+                self._hilo.start()
+            self._condicion.notify()
+            return len(self._pendientes)
+
+    def posicion(self, turno: TurnoPendiente) -> int | None:
+        """Posición del turno en la cola (1 = el siguiente) o None si ya salió de ella."""
+        with self._condicion:
+            for i, pendiente in enumerate(self._pendientes, 1):
+                if pendiente is turno:
+                    return i
+        return None
+
+    def despertar(self):
+        """Vuelve a comprobar ya las claves (p. ej. tras desbloquear una)."""
+        with self._condicion:
+            self._condicion.notify()
+
+    def __len__(self) -> int:
+        return len(self._pendientes)
+
+    def _indicador(self):
+        metrics.REGISTRO.indicador("krishnai_reintentos_pendientes",
+                                   "Turnos degradados en cola de reintento").set(len(self._pendientes))
+
+    def _siguiente(self) -> TurnoPendiente:
+        """Primer turno vigente de la cola, cuando hay una clave disponible."""
+        with self._condicion:
+            while True:
+                while self._pendientes and time.monotonic() - self._pendientes[0].creado > self.caducidad:
+                    caducado = self._pendientes.popleft()
+                    caducado.futuro.set_exception(TimeoutError("Reintento caducado en la cola"))
+                    metrics.contar("krishnai_reintentos_descartados_total", "Turnos degradados sin reintento",
+                                   motivo="caducado")
+                self._indicador()
+                if not self._pendientes:
+                    self._condicion.wait()
+                    continue
+                espera = self.segundos_hasta_clave()
+                if espera > 0:
+                    self._condicion.wait(min(espera, self.espera_maxima))
+                    continue
+                return self._pendientes[0]
+
+    def _trabajar(self):
+        while True:
+            turno = self._siguiente()
+            turno.intentos += 1
+            try:
+                with tracing.span("reintento_degradado"):
+                    resultado = self.reintentar(turno)
+            except Exception as e:
+                tracing.aviso("Falló el reintento de un turno degradado", intento=turno.intentos, error=str(e))
+                if turno.intentos < self.max_intentos:
+                    with self._condicion:
+                        self._condicion.wait(self.espera_maxima)
+                    continue
+                self._sacar(turno)
+                turno.futuro.set_exception(e)
+                metrics.contar("krishnai_reintentos_degradados_total", "Reintentos de turnos degradados",
+                               resultado="error")
+            else:
+                self._sacar(turno)
+                turno.futuro.set_result(resultado)
+                metrics.contar("krishnai_reintentos_degradados_total", "Reintentos de turnos degradados",
+                               resultado="ok" if resultado is not None else "descartado")
+
+    def _sacar(self, turno: TurnoPendiente):
+        with self._condicion:
+            if self._pendientes and self._pendientes[0] is turno:
+                self._pendientes.popleft()
+            self._indicador()
@@ -1,28 +1,180 @@
 """
 Detección de género para tratamiento de Krishna AI.
+
+El género de un nombre se resuelve sin bloquear, en este orden:
+1. léxico de nombres de pila (nombres_genero.json, cargado como frozensets),
+2. caché persistente en disco con las respuestas ya obtenidas del LLM,
+3. reglas de sufijo derivadas del propio léxico (-a, -ia, -o, -el, ...).
+Si nada de esto decide, se devuelve la estimación y, en segundo plano, se
+pregunta una sola vez a Gemini; la respuesta se guarda en la caché y se usa
+a partir del siguiente render o turno. Con un canal (la sesión de la barra
+lateral) la consulta espera RETARDO_LLM segundos y la cancela el siguiente
+nombre desconocido del mismo canal, así que escribir un nombre letra a letra
+no lanza una llamada por pulsación.
 """
 
+import json
 import logging
+import os
+import threading
+import unicodedata
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import tracing
+from plazo import Plazo
 
 logger = logging.getLogger(__name__)
 
-NOMBRES_FEMENINOS = [
-    "maria", "ana", "carmen", "isabel", "pilar", "dolores", "teresa", "rosa",
-    "francisca", "antonia", "mercedes", "elena", "laura", "cristina", "marta",
-    "patricia", "sandra", "lucia", "monica", "silvia", "beatriz", "julia",
-    "irene", "raquel", "sara", "sofia", "andrea", "claudia", "daniela",
-    "paola", "alejandra", "gabriela", "natalia", "carolina"
-]
+LEXICO_NOMBRES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nombres_genero.json")
+CACHE_GENERO = "genero_cache.json"
 
-def obtener_tratamiento_genero(nombre_usuario, genero=None, api_rotator=None):
-    if genero == "Femenino":
-        return {"querido": "querida", "estimado": "estimada", "hijo": "hija", "devoto": "devota"}
-    elif genero == "Masculino":
-        return {"querido": "querido", "estimado": "estimado", "hijo": "hijo", "devoto": "devoto"}
-    else:
-        if api_rotator and nombre_usuario.strip():
-            try:
-                prompt_genero = f"""
+# Reglas de sufijo: longitud máxima del sufijo y mínimos para que una terminación decida
+MAX_SUFIJO = 3
+MIN_NOMBRES_SUFIJO = 4
+MIN_PROPORCION_SUFIJO = 0.85
+# Espera antes de consultar al LLM un nombre desconocido de un canal (debounce)
+RETARDO_LLM = 1.5
+# Plazo total de la consulta al LLM, reintentos y pausas incluidos
+PLAZO_LLM_S = 6.0
+
+TRATAMIENTO_FEMENINO = {"querido": "querida", "estimado": "estimada", "hijo": "hija", "devoto": "devota"}
+TRATAMIENTO_MASCULINO = {"querido": "querido", "estimado": "estimado", "hijo": "hijo", "devoto": "devoto"}
+
+
+def normalizar_nombre(nombre: str) -> str:
+    """Primer nombre de pila en minúsculas y sin tildes ("María José" → "maria", "Iñaki" → "inaki")."""
+    partes = (nombre or "").strip().lower().split()
+    if not partes:
+        return ""
+    descompuesto = unicodedata.normalize("NFKD", partes[0])
+    return "".join(c for c in descompuesto if not unicodedata.combining(c))
+
+
+class ResolvedorGenero:
+    """Resuelve "Femenino"/"Masculino" para un nombre; nunca espera al LLM."""
+
+    def __init__(self, path_lexico: str = LEXICO_NOMBRES, path_cache: str | None = CACHE_GENERO,
+                 retardo_llm: float = RETARDO_LLM):
+        self.femeninos, self.masculinos = self._cargar_lexico(path_lexico)
+        self.sufijos = self._aprender_sufijos()
+        self.path_cache = path_cache
+        self._cache = self._cargar_cache()
+        self._lock = threading.Lock()
+        self._pendientes = set()
+        self.retardo_llm = retardo_llm
+        self._diferidas: dict[str, tuple[str, threading.Timer]] = {}   # canal -> (nombre, temporizador)
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="krishnai-genero")
+
+    @staticmethod
+    def _cargar_lexico(path: str) -> tuple[frozenset, frozenset]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                datos = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning("No se pudo cargar el léxico de nombres %s: %s", path, e)
+            datos = {"femenino": [], "masculino": []}
+        femeninos = frozenset(normalizar_nombre(n) for n in datos["femenino"])
+        masculinos = frozenset(normalizar_nombre(n) for n in datos["masculino"]) - femeninos
+        return femeninos, masculinos
+
+    def _aprender_sufijos(self) -> dict[str, str]:
+        """Terminaciones del léxico con un género claramente mayoritario."""
+        conteo = Counter()
+        for nombres, genero in ((self.femeninos, "Femenino"), (self.masculinos, "Masculino")):
+            for nombre in nombres:
+                for n in range(1, MAX_SUFIJO + 1):
+                    if len(nombre) > n:
+                        conteo[(nombre[-n:], genero)] += 1
+        sufijos = {}
+        for sufijo in {s for s, _ in conteo}:
+            f, m = conteo[(sufijo, "Femenino")], conteo[(sufijo, "Masculino")]
+            if f + m >= MIN_NOMBRES_SUFIJO and max(f, m) / (f + m) >= MIN_PROPORCION_SUFIJO:
+                sufijos[sufijo] = "Femenino" if f > m else "Masculino"
+        return sufijos
+
+    def _cargar_cache(self) -> dict:
+        if not self.path_cache or not os.path.exists(self.path_cache):
+            return {}
+        try:
+            with open(self.path_cache, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning("Caché de género ilegible, se ignora: %s", e)
+            return {}
+
+    def _guardar_cache(self):
+        if not self.path_cache:
+            return
+        temporal = f"{self.path_cache}.tmp"
+        try:
+            with open(temporal, "w", encoding="utf-8") as f:
+                json.dump(self._cache, f, ensure_ascii=False, sort_keys=True)
+            os.replace(temporal, self.path_cache)
+        except OSError as e:
+            logger.warning("No se pudo guardar la caché de género: %s", e)
+
+    def _por_sufijo(self, nombre: str) -> str | None:
+        for n in range(min(MAX_SUFIJO, len(nombre) - 1), 0, -1):
+            genero = self.sufijos.get(nombre[-n:])
+            if genero:
+                return genero
+        return None
+
+    def resolver(self, nombre_usuario: str, api_rotator=None, canal: str | None = None) -> tuple[str, str]:
+        """(género, fuente); fuente es lexico, cache, sufijo o defecto."""
+        nombre = normalizar_nombre(nombre_usuario)
+        if nombre in self.femeninos:
+            genero, fuente = "Femenino", "lexico"
+        elif nombre in self.masculinos:
+            genero, fuente = "Masculino", "lexico"
+        elif nombre in self._cache:
+            genero, fuente = self._cache[nombre], "cache"
+        else:
+            genero = self._por_sufijo(nombre)
+            fuente = "sufijo" if genero else "defecto"
+            genero = genero or "Masculino"
+            # Nombre desconocido: se confirma con el LLM en segundo plano para la próxima vez
+            if nombre and api_rotator is not None:
+                self._consultar_llm(nombre_usuario.strip(), nombre, api_rotator, canal)
+        metrics.contar("krishnai_genero_resoluciones_total", "Resoluciones de género por fuente", fuente=fuente)
+        tracing.depurar("Género resuelto", nombre=nombre_usuario, genero=genero, fuente=fuente)
+        return genero, fuente
+
+    def _consultar_llm(self, nombre_usuario: str, nombre: str, api_rotator, canal: str | None = None):
+        with self._lock:
+            if canal is not None:
+                diferida = self._diferidas.get(canal)
+                if diferida and diferida[0] == nombre:
+                    return
+                if diferida:
+                    # El usuario sigue escribiendo: se descarta el nombre anterior
+                    diferida[1].cancel()
+                    self._pendientes.discard(diferida[0])
+            if nombre in self._pendientes:
+                return
+            self._pendientes.add(nombre)
+            if canal is None:
+                self._pool.submit(self._inferir_con_llm, nombre_usuario, nombre, api_rotator)
+                return
+            temporizador = threading.Timer(self.retardo_llm, self._lanzar_diferida,
+                                           args=(canal, nombre_usuario, nombre, api_rotator))
+            temporizador.daemon = True
+            self._diferidas[canal] = (nombre, temporizador)
+        temporizador.start()
+
+    def _lanzar_diferida(self, canal: str, nombre_usuario: str, nombre: str, api_rotator):
+        with self._lock:
+            diferida = self._diferidas.get(canal)
+            if not diferida or diferida[0] != nombre:
+                return
+            del self._diferidas[canal]
+        self._pool.submit(self._inferir_con_llm, nombre_usuario, nombre, api_rotator)
+
+    def _inferir_con_llm(self, nombre_usuario: str, nombre: str, api_rotator):
+        try:
+            prompt_genero = f"""
 Analiza el nombre "{nombre_usuario}" y determina si es típicamente masculino o femenino.
 
 Responde ÚNICAMENTE con una sola palabra:
@@ -32,27 +184,46 @@ Responde ÚNICAMENTE con una sola palabra:
 
 Nombre: {nombre_usuario}
 Respuesta:"""
-                response = api_rotator.generate_content_with_retry(
-                    model_name='gemini-2.0-flash',
-                    prompt=prompt_genero,
-                    generation_config={'temperature': 0.1, 'max_output_tokens': 10},
-                    max_retries=1,
-                    timeout_seconds=5
-                )
-                resultado = response.text.strip().upper()
-                logger.info(f"Gemini infirió género para '{nombre_usuario}': {resultado}")
-                if "FEMENINO" in resultado:
-                    return {"querido": "querida", "estimado": "estimada", "hijo": "hija", "devoto": "devota"}
-                else:
-                    return {"querido": "querido", "estimado": "estimado", "hijo": "hijo", "devoto": "devoto"}
-            except Exception as e:
-                logger.warning(f"Error en inferencia de género con Gemini: {e}")
-
-        nombre_lower = nombre_usuario.lower().strip()
-        if (nombre_lower in NOMBRES_FEMENINOS or
-            nombre_lower.endswith('a') and not nombre_lower.endswith('ma') and len(nombre_lower) > 3):
-            logger.info(f"Detección fallback para '{nombre_usuario}': FEMENINO")
-            return {"querido": "querida", "estimado": "estimada", "hijo": "hija", "devoto": "devota"}
-        else:
-            logger.info(f"Detección fallback para '{nombre_usuario}': MASCULINO")
-            return {"querido": "querido", "estimado": "estimado", "hijo": "hijo", "devoto": "devoto"}
+            response = api_rotator.generate_content_with_retry(
+                model_name='gemini-2.0-flash',
+                prompt=prompt_genero,
+                generation_config={'temperature': 0.1, 'max_output_tokens': 10},
+                max_retries=1,
+                timeout_seconds=5,
+                plazo=Plazo(PLAZO_LLM_S),
+            )
+            resultado = response.text.strip().upper()
+            tracing.depurar("Gemini infirió género", nombre=nombre_usuario, resultado=resultado)
+            with self._lock:
+                self._cache[nombre] = "Femenino" if "FEMENINO" in resultado else "Masculino"
+                self._guardar_cache()
+        except Exception as e:
+            logger.warning("Error en inferencia de género con Gemini: %s", e)
+        finally:
+            with self._lock:
+                self._pendientes.discard(nombre)
+
+
+_resolvedor = None
+_resolvedor_lock = threading.Lock()
+
+
+def obtener_resolvedor() -> ResolvedorGenero:
+    """Resolvedor compartido del proceso (léxico y caché se cargan una vez)."""
+    global _resolvedor
+    if _resolvedor is None:
+        with _resolvedor_lock:
+            if _resolvedor is None:
+                _resolvedor = ResolvedorGenero()
+    return _resolvedor
+
+
+def resolver_genero(nombre_usuario, api_rotator=None, canal: str | None = None) -> str:
+    return obtener_resolvedor().resolver(nombre_usuario, api_rotator, canal)[0]
+
+
+def obtener_tratamiento_genero(nombre_usuario, genero=None, api_rotator=None):
+    """Formas de tratamiento (querido/querida, ...) para el género dado o resuelto sin bloquear."""
+    if genero not in ("Femenino", "Masculino"):
+        genero = resolver_genero(nombre_usuario, api_rotator)
+    return dict(TRATAMIENTO_FEMENINO if genero == "Femenino" else TRATAMIENTO_MASCULINO)
@@ -2,15 +2,59 @@
 Carga y procesamiento del archivo JSON del Bhagavad Gita.
 """
 
+import itertools
 import json
 import os
-import streamlit as st
 import logging
+import corpus_binario
+import tablas_corpus
+import tracing
 
 logger = logging.getLogger(__name__)
 
+FORMATO_CORPUS = "krishnai-corpus"
+CORPUS_BINARIO = "corpus_gita.bin"
+
+
+def leer_corpus(datos, traduccion=None):
+    """
+    Devuelve una traducción del corpus multi-traducción (construir_corpus.py)
+    con la forma clásica {titulo, traductor, capitulos}. Los JSON de una sola
+    traducción se devuelven tal cual.
+    """
+    if datos.get("formato") != FORMATO_CORPUS:
+        return datos
+    trad_id = traduccion or datos["principal"]
+    trad = datos["traducciones"][trad_id]
+    return {
+        "titulo": trad.get("titulo", "Bhagavad Gita"),
+        "traductor": trad.get("traductor", ""),
+        "fuente": trad.get("fuente", ""),
+        "traduccion": trad_id,
+        "version_corpus": datos.get("version"),
+        "total_capitulos": trad.get("total_capitulos", len(trad["capitulos"])),
+        "tablas": trad.get("tablas", {}),
+        "capitulos": trad["capitulos"],
+    }
+
+@tracing.trazado("carga_corpus")
 def cargar_bhagavad_gita(path="bhagavad_gita.json"):
+    """
+    Carga el Bhagavad Gita desde el corpus binario o el archivo JSON estructurado.
+
+    No depende de Streamlit: si no hay corpus lanza FileNotFoundError y, si el
+    JSON está corrupto, json.JSONDecodeError; la interfaz decide cómo mostrarlo.
+    """
+    # El corpus binario se mapea en memoria una vez por proceso; el texto se decodifica al acceder
+    if os.path.exists(CORPUS_BINARIO):
+        try:
+            return corpus_binario.abrir(CORPUS_BINARIO).traduccion()
+        except (OSError, ValueError) as e:
+            logger.warning("No se pudo abrir %s, se usa el JSON: %s", CORPUS_BINARIO, e)
+
+    # Prioridad: Corpus multi-traducción > TXT CORREGIDO > TXT > Mejorado > EPUB > Original
     paths_prioritarios = [
+        "corpus_gita.json",
         "bhagavad_gita_txt_corregido.json",
         "bhagavad_gita_txt.json",
         "bhagavad_gita_mejorado.json",
@@ -24,29 +68,120 @@ def cargar_bhagavad_gita(path="bhagavad_gita.json"):
             archivo_usado = p
             break
 
+    # Si no existe ningún JSON, procesar el TXT la primera vez
     if not archivo_usado and os.path.exists("Bhagavad-Gita-Anonimo.txt"):
-        st.info("🔄 Procesando el Bhagavad Gita por primera vez...")
-        try:
-            from procesado_bhagavad_gita_txt_corregido import procesar_bhagavad_gita_txt
-            resultado = procesar_bhagavad_gita_txt("Bhagavad-Gita-Anonimo.txt", "bhagavad_gita_txt_corregido.json")
-            if resultado and os.path.exists("bhagavad_gita_txt_corregido.json"):
-                archivo_usado = "bhagavad_gita_txt_corregido.json"
-                st.success("✅ Bhagavad Gita procesado correctamente")
-                st.rerun()
-            else:
-                st.error("❌ No se pudo crear el archivo JSON del Bhagavad Gita")
-        except Exception as e:
-            st.error(f"❌ Error procesando el Bhagavad Gita: {e}")
-
-    if not archivo_usado:
-        st.error("❌ Error: No se encontró ningún archivo del Bhagavad Gita")
-        st.stop()
-
-    try:
-        with open(archivo_usado, "r", encoding="utf-8") as f:
-            bhagavad_gita = json.load(f)
-        logger.info(f"Bhagavad Gita cargado desde {archivo_usado}")
-        return bhagavad_gita
-    except json.JSONDecodeError as e:
-        st.error(f"Error al decodificar JSON en {archivo_usado}: {e}")
-        st.stop()
+        tracing.aviso("Procesando el Bhagavad Gita por primera vez")
+        from procesado_bhagavad_gita_txt_corregido import procesar_bhagavad_gita_txt
+        if procesar_bhagavad_gita_txt("Bhagavad-Gita-Anonimo.txt", "bhagavad_gita_txt_corregido.json"):
+            archivo_usado = "bhagavad_gita_txt_corregido.json"
+
+    if not archivo_usado or not os.path.exists(archivo_usado):
+        raise FileNotFoundError("No se encontró ningún archivo del Bhagavad Gita y no se pudo procesar el TXT")
+
+    with open(archivo_usado, "r", encoding="utf-8") as f:
+        bhagavad_gita = leer_corpus(json.load(f))
+    logger.info("Bhagavad Gita cargado desde %s", archivo_usado)
+    return bhagavad_gita
+
+@tracing.trazado("seleccion_contexto")
+def obtener_versos_contexto(bhagavad_gita, max_tokens=80000, versos_citados_previos=None):
+    """Obtiene versos del Bhagavad Gita optimizados para el contexto de Krishna, evitando repeticiones."""
+    if versos_citados_previos is None:
+        versos_citados_previos = set()
+    
+    versos_seleccionados = []
+    tokens_actuales = 0
+    
+    capitulos_disponibles = list(bhagavad_gita['capitulos'].keys())
+
+    # DIAGNÓSTICO: distribución de versos por capítulo (solo en modo detallado)
+    if tracing.activo():
+        versos_krishna = tablas_corpus.versos_krishna_por_capitulo(bhagavad_gita)
+        for cap_num in sorted(capitulos_disponibles, key=int):
+            tracing.depurar("Capítulo disponible", capitulo=cap_num,
+                            versos=len(bhagavad_gita['capitulos'][cap_num]['versos']),
+                            versos_krishna=versos_krishna.get(cap_num, 0))
+
+    # Procesar todos los capítulos de forma equitativa
+    for cap_num in sorted(capitulos_disponibles, key=int):
+        if cap_num in bhagavad_gita['capitulos']:
+            capitulo = bhagavad_gita['capitulos'][cap_num]
+            versos_cap = 0
+            
+            for verso_num, verso in capitulo['versos'].items():
+                # Priorizar versos de Krishna ("El Bienaventurado Señor")
+                locutor = verso.get('locutor', '')
+                es_krishna = tablas_corpus.es_krishna(verso)
+                
+                # FILTRO ANTI-REPETICIÓN CRÍTICO: Eliminar completamente versos ya citados
+                verso_key = f"{cap_num}:{verso_num}"
+                if verso_key in versos_citados_previos:
+                    tracing.depurar("Verso eliminado del contexto (ya citado)", verso=verso_key)
+                    continue  # ELIMINADO: No incluir este verso en el contexto
+                
+                if es_krishna:  # Solo procesar versos de Krishna
+                    verso_texto = tablas_corpus.texto_completo(cap_num, verso_num, verso)
+                    verso_tokens = len(verso_texto) // 4  # Aproximación
+                    
+                    if tokens_actuales + verso_tokens < max_tokens:
+                        versos_seleccionados.append({
+                            'capitulo': int(cap_num),
+                            'verso': int(verso_num),
+                            'texto_completo': verso_texto,
+                            'locutor': locutor,
+                            'es_krishna': es_krishna
+                        })
+                        tokens_actuales += verso_tokens
+                        versos_cap += 1
+                    else:
+                        tracing.depurar("Límite de tokens alcanzado", capitulo=cap_num, verso=verso_num)
+                        break
+            
+            tracing.depurar("Versos de Krishna añadidos", capitulo=cap_num, versos=versos_cap)
+            
+            if tokens_actuales >= max_tokens * 0.9:  # 90% del límite
+                tracing.depurar("Límite de tokens (90%) alcanzado", capitulo=cap_num)
+                break
+    
+    # Ordenar para poner primero los versos de Krishna
+    versos_seleccionados.sort(key=lambda x: (not x['es_krishna'], x['capitulo'], x['verso']))
+    
+    # DIAGNÓSTICO FINAL
+    if tracing.activo():
+        versos_por_capitulo = {}
+        for v in versos_seleccionados:
+            cap = v['capitulo']
+            versos_por_capitulo[cap] = versos_por_capitulo.get(cap, 0) + 1
+        tracing.depurar(
+            "Contexto seleccionado",
+            versos=len(versos_seleccionados),
+            tokens_estimados=tokens_actuales,
+            distribucion=dict(sorted(versos_por_capitulo.items())),
+            eliminados=sorted(versos_citados_previos),
+        )
+
+    return versos_seleccionados
+
+
+def recortar_contexto(versos_contexto, max_tokens):
+    """
+    Subconjunto de un contexto ya seleccionado que cabe en max_tokens (misma
+    aproximación de 4 caracteres/token). Se toma por turnos de capítulo (el
+    primer verso de cada uno, luego el segundo...) para que un contexto corto
+    no se quede en los primeros capítulos; el resultado conserva el orden
+    original. No depende de la pregunta, así que se puede precalcular.
+    """
+    por_capitulo = {}
+    for posicion, verso in enumerate(versos_contexto):
+        por_capitulo.setdefault(verso['capitulo'], []).append(posicion)
+    elegidos = []
+    tokens = 0
+    for ronda in itertools.zip_longest(*por_capitulo.values()):
+        for posicion in ronda:
+            if posicion is None:
+                continue
+            tokens += len(versos_contexto[posicion]['texto_completo']) // 4
+            if tokens >= max_tokens:
+                return [versos_contexto[i] for i in sorted(elegidos)]
+            elegidos.append(posicion)
+    return list(versos_contexto)
@@ -0,0 +1,192 @@
+"""
+Guardia anti-repetición sobre la respuesta en streaming.
+
+Mientras llegan los fragmentos del modelo vigila dos cosas:
+- citas de versos bloqueados (escáner de citas.py), y
+- solapamiento de k-gramas con el texto de los versos bloqueados
+  (índice de shingles de indice_shingles.py).
+
+Si detecta una repetición, generar_con_guardia corta la generación en ese
+punto y la reemite una sola vez con el verso detectado añadido a la
+prohibición, de modo que una respuesta mala gasta los mínimos tokens.
+Con un Plazo, la reemisión solo se hace si queda holgura y el streaming se
+lee desde un hilo con una espera acotada por lo que queda: si el plazo se
+agota (aunque el stream se haya quedado colgado sin enviar nada) se devuelve
+lo recibido, marcado como truncado.
+"""
+
+import queue
+import threading
+from collections import Counter
+from dataclasses import dataclass
+
+import citas
+import indice_shingles
+import metrics
+import tablas_corpus
+import tracing
+from plazo import PlazoAgotado
+
+# Coincidencias de k-gramas con un mismo verso bloqueado para considerarlo reutilizado
+UMBRAL_SHINGLES = indice_shingles.MIN_SHINGLES_CITA
+
+
+@dataclass(frozen=True)
+class Repeticion:
+    motivo: str      # "cita" o "texto"
+    verso: str       # clave "capítulo:verso"
+    posicion: int    # caracteres de respuesta recibidos al detectarla
+
+
+class GuardiaRepeticion:
+    def __init__(self, bhagavad_gita: dict, versos_bloqueados, umbral: int = UMBRAL_SHINGLES):
+        self.bhagavad_gita = bhagavad_gita
+        self.versos_bloqueados = set(versos_bloqueados)
+        self.umbral = umbral
+        self.escaner_citas = citas.EscanerCitas(bhagavad_gita)
+        indice = indice_shingles.indice_para(bhagavad_gita)
+        self._escaner_shingles = indice_shingles.EscanerShingles(indice.k)
+        self._hash_a_verso = {
+            h: verso
+            for verso in self.versos_bloqueados
+            for h in indice.por_verso.get(verso, ())
+            if indice.versos_de(h)
+        }
+        self._coincidencias = Counter()
+        self._vistos = set()
+        self._recibidos = 0
+        self.repeticion: Repeticion | None = None
+
+    def _revisar(self, nuevas_citas, hashes) -> Repeticion | None:
+        for cita in nuevas_citas:
+            if cita.clave in self.versos_bloqueados:
+                return Repeticion("cita", cita.clave, self._recibidos)
+        for h in hashes:
+            verso = self._hash_a_verso.get(h)
+            if verso is None or h in self._vistos:
+                continue
+            self._vistos.add(h)
+            self._coincidencias[verso] += 1
+            if self._coincidencias[verso] >= self.umbral:
+                return Repeticion("texto", verso, self._recibidos)
+        return None
+
+    def alimentar(self, fragmento: str) -> Repeticion | None:
+        """Procesa un fragmento; devuelve la primera repetición detectada (una sola vez)."""
+        self._recibidos += len(fragmento)
+        nuevas = self.escaner_citas.alimentar(fragmento)
+        hashes = self._escaner_shingles.alimentar(fragmento) if self._hash_a_verso else []
+        return self._registrar(self._revisar(nuevas, hashes))
+
+    def cerrar(self) -> Repeticion | None:
+        nuevas = self.escaner_citas.cerrar()
+        hashes = self._escaner_shingles.cerrar() if self._hash_a_verso else []
+        return self._registrar(self._revisar(nuevas, hashes))
+
+    def _registrar(self, repeticion: Repeticion | None) -> Repeticion | None:
+        if repeticion is None or self.repeticion is not None:
+            return None
+        self.repeticion = repeticion
+        metrics.contar("krishnai_repeticiones_total", "Versos bloqueados reutilizados en la respuesta",
+                       motivo=repeticion.motivo)
+        tracing.aviso("Repetición de verso bloqueado detectada", verso=repeticion.verso,
+                      motivo=repeticion.motivo, posicion=repeticion.posicion)
+        return repeticion
+
+
+def aviso_reemision(bhagavad_gita: dict, repeticion: Repeticion) -> str:
+    """Instrucción añadida al prompt al reemitir tras una repetición."""
+    return (f"\n\n⛔ ATENCIÓN: un intento anterior de respuesta usó el verso "
+            f"{tablas_corpus.cita(bhagavad_gita, repeticion.verso)}, que está PROHIBIDO. "
+            f"Responde de nuevo sin citarlo ni parafrasear su texto.\n")
+
+
+def fragmentos_con_plazo(respuesta, plazo=None):
+    """
+    Fragmentos de una respuesta en streaming sin esperar más que el plazo.
+
+    Un hilo recorre la respuesta y deja cada fragmento en una cola; aquí se
+    espera como mucho lo que queda del plazo, así que un stream colgado no
+    retiene el turno. Lanza PlazoAgotado("streaming") si el plazo se agota.
+    """
+    if plazo is None:
+        yield from respuesta
+        return
+    cola = queue.Queue()
+    fin = object()
+
+    def leer():
+        try:
+            for fragmento in respuesta:
+                cola.put((fragmento, None))
+            cola.put((fin, None))
+        except Exception as e:
+            cola.put((None, e))
+
+    threading.Thread(target=leer, name="krishnai-stream", daemon=True).start()
+    while True:
+        try:
+            fragmento, error = cola.get(timeout=plazo.restante())
+        except queue.Empty:
+            raise PlazoAgotado("streaming") from None
+        if error is not None:
+            raise error
+        if fragmento is fin:
+            return
+        if plazo.agotado():
+            raise PlazoAgotado("streaming")
+        yield fragmento
+
+
+def generar_con_guardia(generar, prompt: str, bhagavad_gita: dict, versos_bloqueados,
+                        al_fragmento=None, max_reemisiones: int = 1, plazo=None):
+    """
+    Genera en streaming vigilando repeticiones.
+
+    generar(prompt) debe devolver una respuesta iterable de fragmentos con .text.
+    al_fragmento(texto_acumulado) se llama con cada fragmento recibido.
+    plazo (plazo.Plazo) acota la espera de cada fragmento, corta el streaming al
+    agotarse y evita reemitir sin holgura.
+    Devuelve (texto, citas, repeticion, truncada); repeticion es la detectada en
+    el intento final (None si la respuesta es limpia) y truncada indica que el
+    plazo cortó la respuesta antes de terminar.
+    """
+    reemisiones = 0
+    while True:
+        guardia = GuardiaRepeticion(bhagavad_gita, versos_bloqueados)
+        partes = []
+        repeticion = None
+        respuesta = generar(prompt)
+        try:
+            for fragmento in fragmentos_con_plazo(respuesta, plazo):
+                partes.append(fragmento.text)
+                if al_fragmento is not None:
+                    al_fragmento("".join(partes))
+                nueva = guardia.alimentar(fragmento.text)
+                repeticion = nueva or repeticion
+                if nueva is not None and reemisiones < max_reemisiones:
+                    if plazo is None or plazo.permite("reemision"):
+                        break
+                    # Sin tiempo para otra generación: se sigue con la respuesta en curso
+                    max_reemisiones = reemisiones
+            else:
+                repeticion = guardia.cerrar() or repeticion
+        except PlazoAgotado:
+            metrics.contar("krishnai_plazos_agotados_total", "Turnos que agotaron su plazo por etapa",
+                           etapa="streaming")
+            tracing.aviso("Plazo agotado durante el streaming, se entrega la respuesta parcial",
+                          caracteres=sum(map(len, partes)))
+            return "".join(partes), guardia.escaner_citas.citas, repeticion, True
+
+        if repeticion is None or reemisiones >= max_reemisiones:
+            return "".join(partes), guardia.escaner_citas.citas, repeticion, False
+        if plazo is not None and not plazo.permite("reemision"):
+            return "".join(partes), guardia.escaner_citas.citas, repeticion, False
+
+        reemisiones += 1
+        metrics.contar("krishnai_reemisiones_total", "Respuestas cortadas y reemitidas por repetición",
+                       motivo=repeticion.motivo)
+        metrics.contar("krishnai_caracteres_descartados_total", "Caracteres de respuesta descartados al reemitir",
+                       cantidad=float(repeticion.posicion))
+        prompt = prompt + aviso_reemision(bhagavad_gita, repeticion)
+        versos_bloqueados = set(versos_bloqueados) | {repeticion.verso}
@@ -0,0 +1,216 @@
+"""
+Índice de shingles (k-gramas de palabras) sobre el texto normalizado de los versos.
+
+Cada k-grama se resume en un hash rodante de 64 bits calculado sobre
+identificadores estables de las palabras, de modo que un texto que llega en
+streaming se puede comparar palabra a palabra con el corpus sin volver a
+trocearlo. El índice se construye una vez por corpus y proceso.
+
+Sobre el índice, IndiceShingles.analizar() responde en milisegundos, sin
+LLM, qué versos cita textualmente una respuesta, en qué tramos y con qué
+cobertura, y si sus citas [C. X - N] coinciden con el texto citado. Lo usan
+la guardia anti-repetición, las métricas de fundamentación y el resaltado de
+citas textuales en la interfaz.
+"""
+
+import re
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass, field
+
+import citas
+
+K_POR_DEFECTO = 5
+# Coincidencias de k-gramas con un mismo verso para considerarlo citado textualmente
+MIN_SHINGLES_CITA = 3
+# Los k-gramas presentes en más versos que este límite son fórmulas comunes y no cuentan
+MAX_VERSOS_POR_SHINGLE = 3
+
+_BASE = 1_000_003
+_MASCARA = (1 << 64) - 1
+_PATRON_PALABRA = re.compile(r"\w+")
+
+
+def normalizar(texto: str) -> str:
+    """Minúsculas y sin tildes ni diacríticos."""
+    descompuesto = unicodedata.normalize("NFKD", texto.lower())
+    return "".join(c for c in descompuesto if not unicodedata.combining(c))
+
+
+def palabras(texto: str) -> list[str]:
+    return _PATRON_PALABRA.findall(normalizar(texto))
+
+
+def palabras_con_posicion(texto: str) -> list[tuple[str, int, int]]:
+    """Palabras normalizadas con su posición en el texto original."""
+    return [(normalizar(m.group(0)), m.start(), m.end()) for m in _PATRON_PALABRA.finditer(texto)]
+
+
+def _id_palabra(palabra: str) -> int:
+    return zlib.crc32(palabra.encode("utf-8")) + 1
+
+
+def hashes_shingles(lista_palabras: list[str], k: int = K_POR_DEFECTO) -> list[int]:
+    """Hash rodante de cada k-grama consecutivo."""
+    if len(lista_palabras) < k:
+        return []
+    ids = [_id_palabra(p) for p in lista_palabras]
+    potencia = pow(_BASE, k - 1, 1 << 64)
+    h = 0
+    for i in ids[:k]:
+        h = (h * _BASE + i) & _MASCARA
+    resultado = [h]
+    for saliente, entrante in zip(ids, ids[k:]):
+        h = ((h - saliente * potencia) * _BASE + entrante) & _MASCARA
+        resultado.append(h)
+    return resultado
+
+
+class EscanerShingles:
+    """Calcula los hashes de k-gramas de un texto que llega por fragmentos."""
+
+    def __init__(self, k: int = K_POR_DEFECTO):
+        self.k = k
+        self._potencia = pow(_BASE, k - 1, 1 << 64)
+        self._ventana = deque()
+        self._hash = 0
+        self._pendiente = ""    # palabra posiblemente cortada al final del fragmento
+
+    def _añadir(self, palabra: str) -> int | None:
+        id_palabra = _id_palabra(palabra)
+        if len(self._ventana) == self.k:
+            self._hash = (self._hash - self._ventana.popleft() * self._potencia) & _MASCARA
+        self._ventana.append(id_palabra)
+        self._hash = (self._hash * _BASE + id_palabra) & _MASCARA
+        return self._hash if len(self._ventana) == self.k else None
+
+    def _procesar(self, texto: str) -> list[int]:
+        hashes = []
+        for palabra in _PATRON_PALABRA.findall(texto):
+            h = self._añadir(palabra)
+            if h is not None:
+                hashes.append(h)
+        return hashes
+
+    def alimentar(self, fragmento: str) -> list[int]:
+        texto = self._pendiente + normalizar(fragmento)
+        # La última palabra puede continuar en el siguiente fragmento
+        corte = len(texto)
+        while corte and (texto[corte - 1].isalnum() or texto[corte - 1] == "_"):
+            corte -= 1
+        self._pendiente = texto[corte:]
+        return self._procesar(texto[:corte])
+
+    def cerrar(self) -> list[int]:
+        texto, self._pendiente = self._pendiente, ""
+        return self._procesar(texto)
+
+
+class IndiceShingles:
+    """hash de k-grama → versos que lo contienen, y verso → sus hashes."""
+
+    def __init__(self, bhagavad_gita: dict, k: int = K_POR_DEFECTO):
+        self.k = k
+        self.por_hash: dict[int, tuple[str, ...]] = {}
+        self.por_verso: dict[str, list[int]] = {}
+        for cap, datos_cap in bhagavad_gita['capitulos'].items():
+            for verso, datos in datos_cap['versos'].items():
+                clave = f"{cap}:{verso}"
+                hashes = hashes_shingles(palabras(datos.get('texto', '')), k)
+                self.por_verso[clave] = hashes
+                for h in set(hashes):
+                    self.por_hash[h] = self.por_hash.get(h, ()) + (clave,)
+
+    def versos_de(self, h: int) -> tuple[str, ...]:
+        """Versos con este k-grama, salvo que sea una fórmula común a muchos versos."""
+        versos = self.por_hash.get(h, ())
+        return versos if len(versos) <= MAX_VERSOS_POR_SHINGLE else ()
+
+    def analizar(self, texto: str, citas_respuesta=None, bhagavad_gita: dict | None = None) -> "AnalisisRespuesta":
+        """
+        Versos citados textualmente en una respuesta, sus tramos y cobertura,
+        y la concordancia de las citas con el texto citado.
+        """
+        if citas_respuesta is None:
+            citas_respuesta = citas.extraer_citas(texto, bhagavad_gita)
+
+        lista = palabras_con_posicion(texto)
+        hashes = hashes_shingles([p for p, _, _ in lista], self.k)
+        coincidencias = defaultdict(set)
+        tramos_por_verso = defaultdict(list)
+        fundamentados = 0
+        for i, h in enumerate(hashes):
+            versos = self.versos_de(h)
+            if not versos:
+                continue
+            fundamentados += 1
+            inicio, fin = lista[i][1], lista[i + self.k - 1][2]
+            for verso in versos:
+                coincidencias[verso].add(h)
+                tramos = tramos_por_verso[verso]
+                if tramos and inicio <= tramos[-1][1]:
+                    tramos[-1] = (tramos[-1][0], fin)
+                else:
+                    tramos.append((inicio, fin))
+
+        cobertura = {
+            verso: round(len(hs) / len(set(self.por_verso[verso])), 3)
+            for verso, hs in coincidencias.items()
+            if len(hs) >= MIN_SHINGLES_CITA
+        }
+        claves_citadas = list(dict.fromkeys(c.clave for c in citas_respuesta))
+        return AnalisisRespuesta(
+            cobertura=cobertura,
+            tramos=sorted((i, f, v) for v in cobertura for i, f in tramos_por_verso[v]),
+            citas_con_texto=[c for c in claves_citadas if c in cobertura],
+            citas_sin_texto=[c for c in claves_citadas if c not in cobertura],
+            texto_sin_cita=[v for v in cobertura if v not in claves_citadas],
+            fundamentacion=round(fundamentados / len(hashes), 3) if hashes else 0.0,
+        )
+
+
+@dataclass
+class AnalisisRespuesta:
+    cobertura: dict[str, float] = field(default_factory=dict)       # verso → fracción de sus k-gramas presentes
+    tramos: list[tuple[int, int, str]] = field(default_factory=list)  # (inicio, fin, verso) en la respuesta
+    citas_con_texto: list[str] = field(default_factory=list)         # citas cuyo texto aparece en la respuesta
+    citas_sin_texto: list[str] = field(default_factory=list)         # citas sin el texto del verso citado
+    texto_sin_cita: list[str] = field(default_factory=list)          # versos citados textualmente sin referencia
+    fundamentacion: float = 0.0                                      # fracción de k-gramas de la respuesta en el corpus
+
+    @property
+    def versos_citados(self) -> list[str]:
+        return sorted(self.cobertura, key=lambda v: -self.cobertura[v])
+
+
+_indices = OrderedDict()
+_lock = threading.Lock()
+_MAX_INDICES = 4
+
+
+def _huella(bhagavad_gita: dict) -> tuple:
+    """Identifica el corpus cargado sin recorrer el texto (se recarga en cada rerun)."""
+    version = bhagavad_gita.get('version_corpus')
+    if version:
+        return (version, bhagavad_gita.get('traduccion'))
+    capitulos = bhagavad_gita['capitulos']
+    return (bhagavad_gita.get('fuente'), bhagavad_gita.get('traductor'),
+            tuple((c, len(d['versos'])) for c, d in capitulos.items()))
+
+
+def indice_para(bhagavad_gita: dict, k: int = K_POR_DEFECTO) -> IndiceShingles:
+    """Índice del corpus, construido una vez por versión de corpus y proceso."""
+    clave = (_huella(bhagavad_gita), k)
+    with _lock:
+        indice = _indices.get(clave)
+        if indice is not None:
+            _indices.move_to_end(clave)
+            return indice
+    indice = IndiceShingles(bhagavad_gita, k)
+    with _lock:
+        _indices[clave] = indice
+        while len(_indices) > _MAX_INDICES:
+            _indices.popitem(last=False)
+    return indice
@@ -0,0 +1,486 @@
+"""
+Motor de Krishna AI sin interfaz: un turno completo de conversación.
+
+KrishnaEngine reúne el corpus, la selección de contexto, el prompt, la
+llamada al modelo con la guardia anti-repetición y el análisis de la
+respuesta. La app de Streamlit, el backend móvil y los benchmarks llaman
+todos a respond(), de modo que un cambio en el pipeline se aplica y se mide
+en un único sitio.
+
+El estado de cada conversación vive en una Sesion que aporta quien llama
+(st.session_state, una petición HTTP, un benchmark); el motor no guarda
+estado por usuario y se puede compartir entre sesiones e hilos.
+
+Al terminar cada respuesta, mientras el usuario lee, el motor precalcula en
+segundo plano lo que el siguiente turno ya puede saber: versos bloqueados,
+contexto filtrado, prompt sin la pregunta (el completo y el de cada perfil
+de contexto corto) y una clave API utilizable. El
+precálculo se guarda en la Sesion con una firma de sus entradas; si al llegar
+la pregunta la firma no coincide (otro nombre, historial recortado o
+editado), se descarta y se calcula en el momento.
+
+Cada pregunta se clasifica localmente (clasificador.py) antes de armar el
+prompt; su perfil fija el tamaño del contexto, el techo de tokens de salida
+y el modelo del turno. PresupuestoSalida ajusta ese techo con las longitudes
+observadas por tipo y añade secuencias de parada.
+
+Cada turno tiene un Plazo (plazo.py) que se pasa a todas sus etapas: la
+espera al precálculo, la preparación del prompt, cada intento de llamada al
+modelo y el streaming vigilado por la guardia. Sin holgura se omite el
+trabajo opcional y al agotarse se corta, así que un turno no dura más que
+plazo_turno aunque fallen claves o el modelo se quede colgado.
+
+Si no hay clave disponible o la llamada falla por cuota, reintentos o plazo,
+el turno se degrada (degradacion.py) en vez de fallar: respuesta guardada a
+una pregunta equivalente o, si no la hay, compuesta localmente con los
+versos más afines del contexto. El turno queda en la cola de reintentos,
+que lo repite con un prompt rearmado cuando vuelve una clave; la respuesta
+del modelo sustituye a la degradada en el historial desde el camino de la
+propia sesión (aplicar_reintentos(), también al empezar su siguiente
+turno), nunca desde el hilo de la cola. Solo se guardan para otros usuarios
+las respuestas a la primera pregunta de una conversación, con el nombre del
+usuario cambiado por MARCA_NOMBRE.
+"""
+
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import citas
+import clasificador
+import indice_shingles
+import metrics
+import tracing
+from degradacion import CacheRespuestas, ColaReintentos, TurnoPendiente, componer_respuesta_local, plantilla_nombre
+from gita_loader import cargar_bhagavad_gita, obtener_versos_contexto, recortar_contexto
+from guardia_repeticion import Repeticion, generar_con_guardia
+from plazo import PLAZO_TURNO_S, Plazo
+from presupuesto_salida import PresupuestoSalida
+from gender_detector import resolver_genero
+from prompt_builder import (PromptPreparado, completar_prompt_krishna, extraer_versos_citados_del_historial,
+                            preparar_prompt_krishna)
+
+# Mensajes hacia atrás cuyos versos citados no se pueden repetir
+VENTANA_PROHIBICION = 8
+# Contextos seleccionados que se conservan, por conjunto de versos bloqueados
+MAX_CONTEXTOS = 64
+
+
+@dataclass
+class Sesion:
+    """Estado de una conversación: historial y preferencias del usuario."""
+    mensajes: list = field(default_factory=list)    # [{"role", "content", "citas"?, "tramos"?}]
+    nombre_usuario: str = "Arjuna"
+    genero_usuario: str | None = None               # "Masculino", "Femenino" o None para resolverlo por el nombre
+    temperatura: float = 0.1
+    precalculo: Future | None = field(default=None, repr=False, compare=False)   # Future[Precalculo]
+    reintentos: list = field(default_factory=list, repr=False, compare=False)   # TurnoPendiente en cola
+
+
+@dataclass
+class Precalculo:
+    """Lo que el siguiente turno necesita y no depende de la pregunta."""
+    firma: tuple
+    versos_bloqueados: set
+    versos_contexto: list
+    prompt: PromptPreparado
+    reducidos: dict = field(default_factory=dict)   # max_tokens_contexto -> prompt de los perfiles cortos
+
+
+@dataclass
+class Respuesta:
+    texto: str
+    citas: list                                     # citas.Cita escaneadas durante el streaming
+    analisis: indice_shingles.AnalisisRespuesta
+    repeticion: Repeticion | None = None            # repetición que persiste tras reemitir
+    prompt_caracteres: int = 0
+    perfil: clasificador.PerfilConsulta | None = None
+    degradacion: str | None = None                  # "cache" o "local" si no respondió el modelo
+    truncada: bool = False                          # el plazo del turno cortó la respuesta
+    reintento: TurnoPendiente | None = field(default=None, repr=False)   # turno en la cola de reintentos
+
+    def mensaje(self) -> dict:
+        """Entrada del historial: texto, claves de verso citadas y tramos textuales."""
+        return {"role": "assistant", "content": self.texto, "citas": citas.claves(self.citas),
+                "tramos": self.analisis.tramos}
+
+
+def mensaje_error(error: Exception) -> tuple[str, str]:
+    """(nivel, mensaje para el usuario) de un error del turno; nivel es "warning" o "error"."""
+    error_str = str(error).lower()
+    if isinstance(error, TimeoutError):
+        return "warning", ("⏰ **Tiempo de espera agotado**\n\nKrishna no pudo responder a tiempo. "
+                           "Por favor, intenta de nuevo.")
+    if "429" in error_str or "quota" in error_str or "rate limit" in error_str:
+        return "warning", ("⏳ **Límite de velocidad alcanzado**\n\nSe están rotando las claves API "
+                           "automáticamente. Por favor, intenta de nuevo en unos momentos.")
+    if "timeout" in error_str or "se agotaron todos los reintentos" in error_str:
+        return "warning", ("⏰ **Tiempo de espera agotado**\n\nEl sistema probó múltiples claves pero todas "
+                           "tardaron demasiado. Por favor, intenta de nuevo.")
+    if "api key" in error_str:
+        return "error", ("🔑 **Error de clave API**\n\nTodas las claves API están temporalmente bloqueadas. "
+                         "Por favor, intenta más tarde.")
+    return "error", f"❌ **Error inesperado**\n\n{error}"
+
+
+def es_agotamiento(error: Exception) -> bool:
+    """Errores de cuota, claves agotadas o tiempo: el turno se degrada en vez de fallar."""
+    return mensaje_error(error)[0] == "warning"
+
+
+class KrishnaEngine:
+    def __init__(self, bhagavad_gita: dict | None = None, api_rotator=None,
+                 ventana_prohibicion: int = VENTANA_PROHIBICION, max_retries: int = 2, timeout_seconds: int = 10,
+                 precalcular: bool = True, perfiles: dict | None = None,
+                 presupuesto: PresupuestoSalida | None = None, plazo_turno: float = PLAZO_TURNO_S,
+                 degradar: bool = True):
+        self.bhagavad_gita = bhagavad_gita if bhagavad_gita is not None else cargar_bhagavad_gita()
+        if api_rotator is None:
+            from rotacion_claves import get_api_rotator
+            api_rotator = get_api_rotator()
+        self.api_rotator = api_rotator
+        self.ventana_prohibicion = ventana_prohibicion
+        self.max_retries = max_retries
+        self.timeout_seconds = timeout_seconds
+        self.plazo_turno = plazo_turno
+        # Contexto, tokens de salida y modelo por tipo de pregunta
+        self.perfiles = dict(perfiles or clasificador.PERFILES)
+        self._contextos_reducidos = tuple(sorted({p.max_tokens_contexto for p in self.perfiles.values()
+                                                  if p.max_tokens_contexto < clasificador.MAX_TOKENS_CONTEXTO}))
+        self.presupuesto = presupuesto or PresupuestoSalida()
+        self._precalculos = (ThreadPoolExecutor(max_workers=2, thread_name_prefix="krishnai-precalculo")
+                             if precalcular else None)
+        # Escalera de degradación: respuestas reutilizables y cola de reintentos
+        self.degradar = degradar
+        self.respuestas = CacheRespuestas()
+        self.reintentos = ColaReintentos(self._reintentar, self.segundos_hasta_clave)
+        # El contexto solo depende de los versos bloqueados: el primer turno de todas
+        # las sesiones (nada bloqueado) comparte una misma selección
+        self._contextos: OrderedDict[frozenset, list] = OrderedDict()
+        self._lock_contextos = threading.Lock()
+        self._instrucciones = None
+
+    def versos_bloqueados(self, sesion: Sesion) -> set:
+        """Versos citados en la ventana deslizante del historial."""
+        if not sesion.mensajes:
+            return set()
+        versos, _ = extraer_versos_citados_del_historial(sesion.mensajes, self.bhagavad_gita,
+                                                         ventana_prohibicion=self.ventana_prohibicion)
+        return versos
+
+    def genero(self, sesion: Sesion) -> str:
+        """Género explícito de la sesión o el resuelto sin bloquear a partir del nombre."""
+        return sesion.genero_usuario or resolver_genero(sesion.nombre_usuario, self.api_rotator)
+
+    def segundos_hasta_clave(self) -> float:
+        """0 si el rotador tiene alguna clave disponible (o no lo sabe); si no, espera hasta la primera."""
+        segundos = getattr(self.api_rotator, "segundos_hasta_clave", None)
+        return segundos() if segundos is not None else 0.0
+
+    def contexto(self, versos_bloqueados: set) -> list[dict]:
+        """Versos del contexto sin los bloqueados; la lista es compartida y no se debe modificar."""
+        clave = frozenset(versos_bloqueados)
+        with self._lock_contextos:
+            versos_contexto = self._contextos.get(clave)
+            if versos_contexto is not None:
+                self._contextos.move_to_end(clave)
+                return versos_contexto
+        versos_contexto = obtener_versos_contexto(self.bhagavad_gita, versos_citados_previos=versos_bloqueados)
+        with self._lock_contextos:
+            self._contextos[clave] = versos_contexto
+            while len(self._contextos) > MAX_CONTEXTOS:
+                self._contextos.popitem(last=False)
+        # Verificar que ningún verso bloqueado aparece en el contexto
+        if versos_bloqueados:
+            encontrados = [f"{v['capitulo']}:{v['verso']}" for v in versos_contexto
+                           if f"{v['capitulo']}:{v['verso']}" in versos_bloqueados]
+            if encontrados:
+                tracing.error("Versos bloqueados aparecen en el contexto", versos=encontrados)
+        return versos_contexto
+
+    def _firma(self, mensajes: list, nombre_usuario: str, genero: str) -> tuple:
+        """Entradas del precálculo: citas de la ventana, textos del historial del prompt, nombre y género."""
+        recientes = mensajes[-self.ventana_prohibicion:]
+        return (nombre_usuario, genero, len(recientes),
+                tuple((m["role"], tuple(m["citas"]) if m.get("citas") is not None else None) for m in recientes),
+                tuple(m["content"] for m in mensajes[-5:]))
+
+    def _preparar(self, sesion: Sesion, genero: str, plazo: Plazo | None = None,
+                  contextos_reducidos: tuple = ()) -> Precalculo:
+        """Precálculo del turno; contextos_reducidos son los tamaños de contexto de los perfiles cortos a preparar."""
+        versos_bloqueados = self.versos_bloqueados(sesion)
+        versos_contexto = self.contexto(versos_bloqueados)
+        textos_prohibidos = plazo is None or plazo.permite("textos_prohibidos")
+        prompt = preparar_prompt_krishna(versos_contexto, self.bhagavad_gita, sesion.mensajes,
+                                         sesion.nombre_usuario, genero, self.api_rotator,
+                                         textos_prohibidos=textos_prohibidos)
+        reducidos = {
+            tamano: preparar_prompt_krishna(recortar_contexto(versos_contexto, tamano), self.bhagavad_gita,
+                                            sesion.mensajes, sesion.nombre_usuario, genero, self.api_rotator,
+                                            textos_prohibidos=textos_prohibidos)
+            for tamano in contextos_reducidos
+        }
+        return Precalculo(self._firma(sesion.mensajes, sesion.nombre_usuario, genero),
+                          versos_bloqueados, versos_contexto, prompt, reducidos)
+
+    def precalcular(self, sesion: Sesion):
+        """Lanza en segundo plano el precálculo del siguiente turno de la sesión."""
+        if self._precalculos is None:
+            return
+        # Copia de lo necesario: quien llama puede recortar el historial mientras tanto
+        copia = Sesion(mensajes=list(sesion.mensajes[-max(self.ventana_prohibicion, 8):]),
+                       nombre_usuario=sesion.nombre_usuario)
+        genero = self.genero(sesion)
+
+        def tarea():
+            with tracing.span("precalculo"):
+                # Solo adelanta el desbloqueo de claves: cada llamada elige la suya
+                preparar_clave = getattr(self.api_rotator, "preparar_clave", None)
+                if preparar_clave is not None:
+                    preparar_clave()
+                return self._preparar(copia, genero, contextos_reducidos=self._contextos_reducidos)
+        sesion.precalculo = self._precalculos.submit(tarea)
+
+    def _preparado(self, sesion: Sesion, plazo: Plazo | None = None) -> Precalculo:
+        """Precálculo vigente de la sesión o, si no lo hay, calculado ahora."""
+        genero = self.genero(sesion)
+        futuro, sesion.precalculo = sesion.precalculo, None
+        if futuro is not None and futuro.cancel():
+            # Aún en cola detrás de otras sesiones: calcularlo aquí es más rápido que esperar
+            metrics.contar("krishnai_precalculos_total", "Precálculos de turno por resultado", resultado="cancelado")
+        elif futuro is not None:
+            try:
+                precalculo = futuro.result(timeout=plazo.restante() if plazo is not None else None)
+                resultado = "acierto" if precalculo.firma == self._firma(sesion.mensajes, sesion.nombre_usuario,
+                                                                         genero) else "obsoleto"
+            except Exception as e:
+                tracing.aviso("Falló el precálculo del turno", error=str(e))
+                resultado = "error"
+            metrics.contar("krishnai_precalculos_total", "Precálculos de turno por resultado", resultado=resultado)
+            if resultado == "acierto":
+                return precalculo
+        return self._preparar(sesion, genero, plazo)
+
+    def _prompt_perfil(self, sesion: Sesion, precalculo: Precalculo, perfil: clasificador.PerfilConsulta,
+                       plazo: Plazo | None = None) -> PromptPreparado:
+        """Parte preparada del prompt con el contexto que permite el perfil."""
+        if perfil.max_tokens_contexto >= clasificador.MAX_TOKENS_CONTEXTO:
+            return precalculo.prompt
+        reducido = precalculo.reducidos.get(perfil.max_tokens_contexto)
+        if reducido is not None:
+            return reducido
+        versos_contexto = recortar_contexto(precalculo.versos_contexto, perfil.max_tokens_contexto)
+        return preparar_prompt_krishna(versos_contexto, self.bhagavad_gita, sesion.mensajes,
+                                       sesion.nombre_usuario, self.genero(sesion), self.api_rotator,
+                                       textos_prohibidos=plazo is None or plazo.permite("textos_prohibidos"))
+
+    def _generar(self, modelo: str, generation_config: dict, stream: bool, plazo: Plazo | None = None):
+        def generar(prompt):
+            respuesta = self.api_rotator.generate_content_with_retry(
+                model_name=modelo,
+                prompt=prompt,
+                generation_config=generation_config,
+                max_retries=self.max_retries,
+                timeout_seconds=self.timeout_seconds,
+                stream=stream,
+                plazo=plazo,
+            )
+            # Sin streaming la respuesta entera es el único fragmento
+            return respuesta if stream else [respuesta]
+        return generar
+
+    def _analizar(self, texto: str, citas_respuesta: list) -> indice_shingles.AnalisisRespuesta:
+        # Citas estructuradas de la respuesta, validadas contra el corpus
+        for cita in citas_respuesta:
+            estado = "valida" if cita.es_krishna else ("no_krishna" if cita.existe else "inexistente")
+            metrics.contar("krishnai_citas_total", "Citas emitidas por el modelo", estado=estado)
+            if estado != "valida":
+                tracing.aviso("Cita no válida en la respuesta", cita=cita.texto, verso=cita.clave, estado=estado)
+
+        # Fundamentación: qué versos cita textualmente y si las citas coinciden con el texto
+        analisis = indice_shingles.indice_para(self.bhagavad_gita).analizar(texto, citas_respuesta)
+        metrics.REGISTRO.histograma("krishnai_fundamentacion",
+                                    "Fracción de la respuesta que reproduce texto del Gita").observe(analisis.fundamentacion)
+        metrics.contar("krishnai_citas_sin_texto_total", "Citas cuyo verso no aparece en la respuesta",
+                       cantidad=float(len(analisis.citas_sin_texto)))
+        metrics.contar("krishnai_texto_sin_cita_total", "Versos reproducidos sin referencia",
+                       cantidad=float(len(analisis.texto_sin_cita)))
+        tracing.depurar("Fundamentación de la respuesta", cobertura=analisis.cobertura,
+                        citas_sin_texto=analisis.citas_sin_texto, fundamentacion=analisis.fundamentacion)
+        return analisis
+
+    def _configuracion(self, sesion: Sesion, max_tokens: int) -> dict:
+        return {
+            'temperature': sesion.temperatura,
+            'max_output_tokens': max_tokens,
+            'stop_sequences': self.presupuesto.secuencias_parada(sesion.nombre_usuario),
+        }
+
+    def respond(self, sesion: Sesion, pregunta: str, al_fragmento=None, stream: bool = True,
+                plazo: Plazo | None = None) -> Respuesta:
+        """
+        Un turno completo: añade la pregunta y la respuesta al historial de la sesión.
+
+        al_fragmento(texto_acumulado) recibe la respuesta a medida que llega.
+        plazo es el del turno si quien llama ya lo empezó a contar (p. ej. al
+        recibir la petición); si no, se crea uno de plazo_turno segundos.
+        Los errores del modelo se propagan con la pregunta ya en el historial;
+        mensaje_error() da el texto que mostrar al usuario.
+        """
+        plazo = plazo or Plazo(self.plazo_turno)
+        plazo.comprobar("inicio_turno")
+        self.aplicar_reintentos(sesion)
+        with tracing.span("turno"):
+            perfil = self.perfiles[clasificador.clasificar_pregunta(pregunta)]
+            metrics.contar("krishnai_preguntas_total", "Preguntas por tipo clasificado", tipo=perfil.tipo)
+            tracing.depurar("Pregunta clasificada", tipo=perfil.tipo, modelo=perfil.modelo,
+                            contexto=perfil.max_tokens_contexto, techo_salida=perfil.max_output_tokens)
+            # Solo la respuesta a la primera pregunta (sin historial) se puede guardar para otros usuarios
+            primero = self.degradar and not sesion.mensajes
+            preparado = self._preparado(sesion, plazo)
+            versos_bloqueados = preparado.versos_bloqueados
+            prompt_preparado = self._prompt_perfil(sesion, preparado, perfil, plazo)
+            sesion.mensajes.append({"role": "user", "content": pregunta})
+            prompt = completar_prompt_krishna(prompt_preparado, pregunta, sesion.mensajes[-1])
+            max_tokens = self.presupuesto.max_tokens(perfil, sesion.mensajes)
+            generation_config = self._configuracion(sesion, max_tokens)
+
+            turno = TurnoPendiente(sesion, {}, versos_bloqueados, perfil, pregunta, primero)
+
+            # Respuesta vigilada por la guardia anti-repetición: si el modelo
+            # reutiliza un verso bloqueado se corta y se reemite una sola vez
+            try:
+                if self.degradar and self.segundos_hasta_clave() > 0:
+                    raise RuntimeError("Se agotaron todos los reintentos y claves API disponibles (todas bloqueadas)")
+                with tracing.span("llamada_llm", modelo=perfil.modelo):
+                    texto, citas_respuesta, repeticion, truncada = generar_con_guardia(
+                        self._generar(perfil.modelo, generation_config, stream, plazo), prompt, self.bhagavad_gita,
+                        versos_bloqueados, al_fragmento=al_fragmento, plazo=plazo,
+                    )
+            except Exception as e:
+                if not self.degradar or not es_agotamiento(e):
+                    raise
+                respuesta = self._degradar(turno, preparado.versos_contexto, len(prompt), e)
+                if al_fragmento is not None:
+                    al_fragmento(respuesta.texto)
+                self.precalcular(sesion)
+                return respuesta
+            if repeticion is not None:
+                tracing.aviso("La respuesta reemitida sigue repitiendo un verso", verso=repeticion.verso)
+            # Una respuesta cortada por el plazo no dice cuánto habría escrito el modelo
+            if not truncada:
+                self.presupuesto.observar(perfil, texto, max_tokens)
+
+            respuesta = Respuesta(texto, citas_respuesta, self._analizar(texto, citas_respuesta),
+                                  repeticion, len(prompt), perfil, truncada=truncada)
+            sesion.mensajes.append(respuesta.mensaje())
+            self._recordar(turno, respuesta, preparado.versos_contexto)
+            self.precalcular(sesion)
+            return respuesta
+
+    # --- Degradación ---------------------------------------------------------
+
+    def _texto_fijo(self) -> str:
+        """Instrucciones del prompt sin nombre ni contexto (las mismas para todos los turnos)."""
+        if self._instrucciones is None:
+            preparado = preparar_prompt_krishna([], self.bhagavad_gita, [], "", "Masculino")
+            self._instrucciones = preparado.cabecera + preparado.pie
+        return self._instrucciones
+
+    def _recordar(self, turno: TurnoPendiente, respuesta: Respuesta, versos_contexto: list):
+        """
+        Guarda para otros usuarios una respuesta limpia y completa a la primera
+        pregunta de una conversación, con MARCA_NOMBRE en lugar del nombre. No
+        se guarda si el nombre también sale en el prompt por otra razón (p. ej.
+        «Arjuna»): no se sabría qué menciones son del usuario.
+        """
+        if not turno.primero or respuesta.repeticion is not None or respuesta.truncada:
+            return
+        fuentes = itertools.chain((self._texto_fijo(), turno.pregunta), (v['texto_completo'] for v in versos_contexto))
+        plantilla = plantilla_nombre(respuesta.texto, turno.sesion.nombre_usuario, fuentes)
+        if plantilla is None:
+            metrics.contar("krishnai_respuestas_no_guardadas_total",
+                           "Primeras respuestas que no se guardan por un nombre ambiguo")
+            return
+        self.respuestas.guardar(turno.pregunta, turno.perfil.tipo, plantilla, self.genero(turno.sesion),
+                                citas.claves(respuesta.citas))
+
+    def _degradar(self, turno: TurnoPendiente, versos_contexto: list, prompt_caracteres: int,
+                  error: Exception) -> Respuesta:
+        """Respuesta sin modelo (guardada o compuesta localmente) y el turno a la cola de reintentos."""
+        sesion, perfil = turno.sesion, turno.perfil
+        genero = self.genero(sesion)
+        nivel = "cache"
+        texto = self.respuestas.buscar(turno.pregunta, perfil.tipo, sesion.nombre_usuario, genero,
+                                       turno.versos_bloqueados)
+        if texto is None:
+            nivel = "local"
+            texto = componer_respuesta_local(turno.pregunta, perfil.tipo, versos_contexto,
+                                             self.bhagavad_gita, sesion.nombre_usuario, genero)
+        metrics.contar("krishnai_respuestas_degradadas_total", "Turnos respondidos sin el modelo", nivel=nivel)
+        tracing.aviso("Turno degradado", escalon=nivel, error=str(error))
+
+        citas_respuesta = citas.extraer_citas(texto, self.bhagavad_gita)
+        respuesta = Respuesta(texto, citas_respuesta, self._analizar(texto, citas_respuesta), None,
+                              prompt_caracteres, perfil, degradacion=nivel)
+        turno.mensaje = respuesta.mensaje()
+        sesion.mensajes.append(turno.mensaje)
+        if self.reintentos.encolar(turno) is not None:
+            sesion.reintentos.append(turno)
+            respuesta.reintento = turno
+        return respuesta
+
+    def _reintentar(self, turno: TurnoPendiente) -> Respuesta | None:
+        """
+        Repite con el modelo un turno degradado (en el hilo de la cola).
+
+        El prompt se rearma ahora con el historial anterior a la pregunta y el
+        nombre y género actuales; lo citado después del turno también se
+        bloquea. No modifica la sesión: aplicar_reintentos() sustituye la
+        respuesta desde el camino de la sesión. None si el turno ya no está en
+        el historial (conversación nueva o recortada).
+        """
+        sesion, perfil = turno.sesion, turno.perfil
+        mensajes = list(sesion.mensajes)
+        indice = next((i for i, mensaje in enumerate(mensajes) if mensaje is turno.mensaje), None)
+        if not indice:
+            return None
+        plazo = Plazo(self.plazo_turno)
+        genero = self.genero(sesion)
+        previa = Sesion(mensajes=mensajes[:indice - 1], nombre_usuario=sesion.nombre_usuario,
+                        genero_usuario=genero, temperatura=sesion.temperatura)
+        preparado = self._preparar(previa, genero, plazo)
+        pregunta = mensajes[indice - 1]
+        prompt = completar_prompt_krishna(self._prompt_perfil(previa, preparado, perfil, plazo),
+                                          pregunta["content"], pregunta)
+        generation_config = self._configuracion(previa, self.presupuesto.max_tokens(perfil, mensajes[:indice]))
+        versos_bloqueados = preparado.versos_bloqueados | {clave for mensaje in mensajes[indice + 1:]
+                                                           for clave in mensaje.get("citas") or ()}
+        texto, citas_respuesta, repeticion, truncada = generar_con_guardia(
+            self._generar(perfil.modelo, generation_config, False, plazo), prompt, self.bhagavad_gita,
+            versos_bloqueados, plazo=plazo,
+        )
+        respuesta = Respuesta(texto, citas_respuesta, self._analizar(texto, citas_respuesta), repeticion,
+                              len(prompt), perfil, truncada=truncada)
+        self._recordar(turno, respuesta, preparado.versos_contexto)
+        return respuesta
+
+    def aplicar_reintentos(self, sesion: Sesion) -> int:
+        """
+        Sustituye en el historial las respuestas degradadas cuyo reintento ya
+        terminó. Debe llamarlo quien posee la sesión (respond() lo hace al
+        empezar cada turno). Devuelve cuántas sustituyó.
+        """
+        aplicados = 0
+        for turno in [t for t in sesion.reintentos if t.futuro.done()]:
+            sesion.reintentos.remove(turno)
+            if turno.futuro.exception() is not None or turno.futuro.result() is None:
+                continue
+            for i, mensaje in enumerate(sesion.mensajes):
+                if mensaje is turno.mensaje:
+                    sesion.mensajes[i] = turno.futuro.result().mensaje()
+                    aplicados += 1
+                    break
+        return aplicados
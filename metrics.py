@@ -0,0 +1,249 @@
+"""
+Métricas de latencia por etapa para Krishna AI.
+
+Agrega la duración de los spans de tracing.py en histogramas (p50/p95/p99),
+mantiene contadores (reintentos, errores 429, timeouts, esperas) e indicadores
+alimentados desde GeminiAPIRotator.get_status_summary. Se exponen en formato
+de texto de Prometheus desde un servidor HTTP auxiliar y en el panel de
+administración de la barra lateral.
+"""
+
+import logging
+import os
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+CUANTILES = (0.5, 0.95, 0.99)
+VENTANA_HISTOGRAMA = 1024
+
+
+def _clave_etiquetas(etiquetas: dict) -> tuple:
+    return tuple(sorted(etiquetas.items()))
+
+
+def _formatear_etiquetas(etiquetas: tuple, extra: tuple = ()) -> str:
+    pares = list(etiquetas) + list(extra)
+    if not pares:
+        return ""
+    contenido = ",".join(f'{k}="{str(v)}"' for k, v in pares)
+    return "{" + contenido + "}"
+
+
+def cuantil(valores_ordenados: list, q: float) -> float:
+    """Cuantil por el método del rango más cercano sobre una lista ordenada."""
+    if not valores_ordenados:
+        return 0.0
+    idx = min(len(valores_ordenados) - 1, max(0, int(round(q * (len(valores_ordenados) - 1)))))
+    return valores_ordenados[idx]
+
+
+class Contador:
+    def __init__(self):
+        self.valor = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, cantidad: float = 1.0):
+        # += no es atómico: sin el cerrojo dos hilos pueden perder un incremento
+        with self._lock:
+            self.valor += cantidad
+
+
+class Indicador:
+    def __init__(self):
+        self.valor = 0.0
+
+    def set(self, valor: float):
+        self.valor = float(valor)
+
+
+class Histograma:
+    """Ventana deslizante de observaciones con suma y cuenta acumuladas."""
+
+    def __init__(self, ventana: int = VENTANA_HISTOGRAMA):
+        self.observaciones = deque(maxlen=ventana)
+        self.suma = 0.0
+        self.cuenta = 0
+        self._lock = threading.Lock()
+
+    def observe(self, valor: float):
+        with self._lock:
+            self.observaciones.append(valor)
+            self.suma += valor
+            self.cuenta += 1
+
+    def cuantiles(self) -> dict:
+        # Se copia bajo el cerrojo: ordenar la deque mientras otro hilo observa falla
+        with self._lock:
+            copia = list(self.observaciones)
+        ordenados = sorted(copia)
+        return {q: cuantil(ordenados, q) for q in CUANTILES}
+
+
+class RegistroMetricas:
+    """Registro de métricas en memoria del proceso, seguro entre hilos."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metricas = {}
+        self._ayuda = {}
+        self._recolectores = {}
+
+    def _obtener(self, tipo, nombre: str, ayuda: str, etiquetas: dict):
+        clave = (nombre, _clave_etiquetas(etiquetas))
+        with self._lock:
+            metrica = self._metricas.get(clave)
+            if metrica is None:
+                metrica = tipo()
+                self._metricas[clave] = metrica
+                self._ayuda.setdefault(nombre, (ayuda, tipo))
+            return metrica
+
+    def contador(self, nombre: str, ayuda: str = "", **etiquetas) -> Contador:
+        return self._obtener(Contador, nombre, ayuda, etiquetas)
+
+    def indicador(self, nombre: str, ayuda: str = "", **etiquetas) -> Indicador:
+        return self._obtener(Indicador, nombre, ayuda, etiquetas)
+
+    def histograma(self, nombre: str, ayuda: str = "", **etiquetas) -> Histograma:
+        return self._obtener(Histograma, nombre, ayuda, etiquetas)
+
+    def registrar_recolector(self, nombre: str, funcion):
+        """Registra una función que actualiza indicadores justo antes de exportar."""
+        with self._lock:
+            self._recolectores[nombre] = funcion
+
+    def recolectar(self):
+        with self._lock:
+            recolectores = list(self._recolectores.values())
+        for funcion in recolectores:
+            try:
+                funcion()
+            except Exception as e:
+                logger.warning("Recolector de métricas falló: %s", e)
+
+    def instantanea(self) -> dict:
+        """Devuelve {nombre: [(etiquetas, metrica), ...]} para exportar o mostrar."""
+        self.recolectar()
+        with self._lock:
+            agrupado = {}
+            for (nombre, etiquetas), metrica in sorted(self._metricas.items(), key=lambda kv: kv[0]):
+                agrupado.setdefault(nombre, []).append((etiquetas, metrica))
+            return agrupado
+
+    def exportar_prometheus(self) -> str:
+        lineas = []
+        for nombre, series in self.instantanea().items():
+            ayuda, tipo = self._ayuda[nombre]
+            tipo_prom = {Contador: "counter", Indicador: "gauge", Histograma: "summary"}[tipo]
+            if ayuda:
+                lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} {tipo_prom}")
+            for etiquetas, metrica in series:
+                if isinstance(metrica, Histograma):
+                    for q, valor in metrica.cuantiles().items():
+                        lineas.append(f"{nombre}{_formatear_etiquetas(etiquetas, (('quantile', q),))} {valor:.6f}")
+                    lineas.append(f"{nombre}_sum{_formatear_etiquetas(etiquetas)} {metrica.suma:.6f}")
+                    lineas.append(f"{nombre}_count{_formatear_etiquetas(etiquetas)} {metrica.cuenta}")
+                else:
+                    lineas.append(f"{nombre}{_formatear_etiquetas(etiquetas)} {metrica.valor:g}")
+        return "\n".join(lineas) + "\n"
+
+    def resumen_etapas(self) -> list[dict]:
+        """Filas de latencia por etapa (ms) para el panel de administración."""
+        filas = []
+        for etiquetas, metrica in self.instantanea().get("krishnai_etapa_segundos", []):
+            q = metrica.cuantiles()
+            filas.append({
+                "etapa": dict(etiquetas).get("etapa", ""),
+                "n": metrica.cuenta,
+                "p50_ms": round(q[0.5] * 1000, 1),
+                "p95_ms": round(q[0.95] * 1000, 1),
+                "p99_ms": round(q[0.99] * 1000, 1),
+            })
+        return filas
+
+
+REGISTRO = RegistroMetricas()
+
+
+def _observar_span(span: tracing.Span):
+    REGISTRO.histograma(
+        "krishnai_etapa_segundos", "Duración de cada etapa del turno en segundos", etapa=span.nombre
+    ).observe(span.duracion)
+
+
+tracing.registrar_observador(_observar_span)
+
+
+def contar(nombre: str, ayuda: str = "", cantidad: float = 1.0, **etiquetas):
+    REGISTRO.contador(nombre, ayuda, **etiquetas).inc(cantidad)
+
+
+def actualizar_desde_rotador(api_rotator):
+    """Alimenta los indicadores de claves con get_status_summary del rotador."""
+    resumen = api_rotator.get_status_summary()
+    REGISTRO.indicador("krishnai_claves_totales", "Claves API configuradas").set(resumen["total_keys"])
+    REGISTRO.indicador("krishnai_claves_disponibles", "Claves API no bloqueadas").set(resumen["available_keys"])
+    REGISTRO.indicador("krishnai_claves_bloqueadas", "Claves API bloqueadas").set(resumen["blocked_keys"])
+    for estado in resumen["keys_status"]:
+        REGISTRO.indicador("krishnai_clave_bloqueada", "1 si la clave está bloqueada", clave=estado["name"]).set(
+            1 if estado["is_blocked"] else 0)
+        REGISTRO.indicador("krishnai_clave_fallos", "Fallos acumulados de la clave", clave=estado["name"]).set(
+            estado["failed_count"])
+        if estado.get("latency_ewma_ms") is not None:
+            REGISTRO.indicador("krishnai_clave_latencia_ewma_ms", "Latencia media móvil de la clave",
+                               clave=estado["name"]).set(estado["latency_ewma_ms"])
+        if "error_rate" in estado:
+            REGISTRO.indicador("krishnai_clave_tasa_error", "Tasa de error media móvil de la clave",
+                               clave=estado["name"]).set(estado["error_rate"])
+
+
+class _ManejadorMetricas(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        cuerpo = REGISTRO.exportar_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_servidor = {"instancia": None}
+_servidor_lock = threading.Lock()
+
+
+def iniciar_servidor_metricas(puerto: int | None = None):
+    """
+    Arranca (una sola vez por proceso) el endpoint /metrics en un hilo daemon.
+    Sin puerto explícito se usa KRISHNAI_METRICS_PORT; si no está definida no se arranca.
+    """
+    if puerto is None:
+        valor = os.environ.get("KRISHNAI_METRICS_PORT", "").strip()
+        if not valor:
+            return None
+        puerto = int(valor)
+    with _servidor_lock:
+        if _servidor["instancia"] is not None:
+            return _servidor["instancia"]
+        try:
+            servidor = ThreadingHTTPServer(("0.0.0.0", puerto), _ManejadorMetricas)
+        except OSError as e:
+            logger.warning("No se pudo arrancar el endpoint de métricas en el puerto %s: %s", puerto, e)
+            return None
+        servidor.daemon_threads = True
+        threading.Thread(target=servidor.serve_forever, name="krishnai-metricas", daemon=True).start()
+        _servidor["instancia"] = servidor
+        logger.info("Endpoint de métricas escuchando en :%s/metrics", servidor.server_address[1])
+        return servidor
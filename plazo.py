@@ -0,0 +1,70 @@
+"""
+Plazo de extremo a extremo de un turno.
+
+Cada turno crea un Plazo al empezar (el servidor HTTP, al llegar la
+petición, de modo que cuenta también la espera en cola) y lo pasa a todas
+sus etapas: preparación del prompt, llamada al modelo con sus reintentos y
+pausas, streaming vigilado por la guardia y, fuera del motor, embeddings
+del RAG e inferencia de género. Cada etapa recorta sus propios timeouts a
+lo que queda y omite el trabajo opcional (otro reintento, la reemisión tras
+una repetición, los textos completos de los versos prohibidos) si no hay
+holgura, así que la latencia de un turno en el peor caso queda acotada por
+el plazo en vez de sumar timeouts, reintentos y pausas de cada etapa.
+"""
+
+import os
+import time
+
+import metrics
+import tracing
+
+# Plazo total de un turno, desde que llega la pregunta hasta el último fragmento
+PLAZO_TURNO_S = float(os.environ.get("KRISHNAI_PLAZO_TURNO", "20"))
+# Tiempo mínimo para que merezca la pena empezar otro intento de llamada al modelo
+MIN_INTENTO_S = 2.0
+# Con menos de esto restante se omite el trabajo opcional del turno
+HOLGURA_OPCIONAL_S = 8.0
+
+
+class PlazoAgotado(TimeoutError):
+    def __init__(self, etapa: str):
+        super().__init__(f"Plazo del turno agotado en {etapa}")
+        self.etapa = etapa
+
+
+class Plazo:
+    """Instante límite de un turno; lo comparten todas sus etapas."""
+
+    def __init__(self, segundos: float = PLAZO_TURNO_S, reloj=time.monotonic):
+        self.segundos = segundos
+        self._reloj = reloj
+        self.limite = reloj() + segundos
+
+    def restante(self) -> float:
+        return max(0.0, self.limite - self._reloj())
+
+    def agotado(self) -> bool:
+        return self.restante() <= 0.0
+
+    def alcanza(self, segundos: float) -> bool:
+        """True si quedan al menos `segundos`."""
+        return self.restante() >= segundos
+
+    def recortar(self, segundos: float) -> float:
+        """Timeout de una etapa: el suyo o lo que queda del plazo, lo que sea menor."""
+        return min(segundos, self.restante())
+
+    def comprobar(self, etapa: str):
+        """Lanza PlazoAgotado si ya no queda tiempo para la etapa."""
+        if self.agotado():
+            metrics.contar("krishnai_plazos_agotados_total", "Turnos que agotaron su plazo por etapa", etapa=etapa)
+            tracing.aviso("Plazo del turno agotado", etapa=etapa, plazo=self.segundos)
+            raise PlazoAgotado(etapa)
+
+    def permite(self, etapa: str, segundos: float = HOLGURA_OPCIONAL_S) -> bool:
+        """True si quedan `segundos` para el trabajo opcional `etapa`; si no, lo registra como omitido."""
+        if self.alcanza(segundos):
+            return True
+        metrics.contar("krishnai_etapas_omitidas_total", "Trabajo opcional omitido por falta de plazo", etapa=etapa)
+        tracing.depurar("Etapa omitida por el plazo del turno", etapa=etapa, restante=round(self.restante(), 2))
+        return False
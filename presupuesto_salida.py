@@ -0,0 +1,71 @@
+"""
+Presupuesto de tokens de salida por turno.
+
+El máximo de tokens de la respuesta parte del techo del perfil de la pregunta
+(clasificador.PERFILES) y se ajusta con:
+- la longitud observada de las respuestas de ese tipo: p95 de una ventana
+  deslizante (histograma krishnai_tokens_respuesta) con un margen; las
+  respuestas cortadas por el límite se registran como el límite, de modo que
+  el presupuesto vuelve a crecer si se queda corto;
+- la longitud de los mensajes recientes del usuario: a quien escribe
+  mensajes muy breves le basta una respuesta algo más corta.
+
+Las secuencias de parada cortan la generación cuando el modelo, en vez de
+terminar, empieza a continuar la transcripción del prompt (una línea
+"ARJUNA:", "KRISHNA:" o los separadores "---"/"===").
+"""
+
+import metrics
+from clasificador import PerfilConsulta
+
+# Respuestas observadas de un tipo antes de ajustar su presupuesto
+MIN_OBSERVACIONES = 20
+# Margen sobre el p95 observado
+MARGEN = 1.25
+# Mínimo absoluto por tipo: nunca se corta por debajo
+MIN_TOKENS = {"saludo": 60, "casual": 100, "espiritual": 500, "filosofica": 600}
+# Mensajes del usuario más cortos que esto (caracteres, media reciente) reducen el presupuesto
+USUARIO_BREVE = 40
+FACTOR_USUARIO_BREVE = 0.85
+# Fracción del límite a partir de la cual una respuesta se considera cortada
+FRACCION_CORTADA = 0.95
+CARACTERES_POR_TOKEN = 4
+
+
+class PresupuestoSalida:
+    def __init__(self, registro: metrics.RegistroMetricas | None = None,
+                 min_observaciones: int = MIN_OBSERVACIONES, margen: float = MARGEN):
+        self.registro = registro or metrics.REGISTRO
+        self.min_observaciones = min_observaciones
+        self.margen = margen
+
+    def _histograma(self, tipo: str) -> metrics.Histograma:
+        return self.registro.histograma("krishnai_tokens_respuesta",
+                                        "Tokens (aprox.) de las respuestas completas por tipo", tipo=tipo)
+
+    def max_tokens(self, perfil: PerfilConsulta, mensajes: list) -> int:
+        """Máximo de tokens de salida para el turno; mensajes incluye ya la pregunta."""
+        techo = perfil.max_output_tokens
+        minimo = min(techo, MIN_TOKENS.get(perfil.tipo, techo))
+        presupuesto = techo
+        histograma = self._histograma(perfil.tipo)
+        if len(histograma.observaciones) >= self.min_observaciones:
+            presupuesto = int(histograma.cuantiles()[0.95] * self.margen)
+
+        longitudes = [len(m["content"]) for m in mensajes[-6:] if m["role"] == "user"]
+        if longitudes and sum(longitudes) / len(longitudes) < USUARIO_BREVE:
+            presupuesto = int(presupuesto * FACTOR_USUARIO_BREVE)
+        return max(minimo, min(techo, presupuesto))
+
+    def observar(self, perfil: PerfilConsulta, texto: str, max_tokens: int):
+        """Registra la longitud de una respuesta completa (o el límite, si se cortó)."""
+        tokens = len(texto) // CARACTERES_POR_TOKEN
+        cortada = tokens >= max_tokens * FRACCION_CORTADA
+        if cortada:
+            metrics.contar("krishnai_respuestas_cortadas_total", "Respuestas que alcanzaron max_output_tokens",
+                           tipo=perfil.tipo)
+        self._histograma(perfil.tipo).observe(max(tokens, max_tokens) if cortada else tokens)
+
+    @staticmethod
+    def secuencias_parada(nombre_usuario: str) -> list[str]:
+        return [f"\n{nombre_usuario.upper()}:", "\nKRISHNA:", "\n--- ", "\n=== "]
@@ -5,10 +5,13 @@ Script mejorado para procesar el Bhagavad Gita desde archivo TXT
 Maneja correctamente versos compuestos como "3-4", "13-19", etc.
 """
 
+import io
 import re
 import json
 import os
 
+import tablas_corpus
+
 def procesar_bhagavad_gita_txt(txt_path, output_path):
     """Procesa el archivo TXT del Bhagavad Gita y lo convierte a JSON estructurado"""
     
@@ -21,14 +24,12 @@ def procesar_bhagavad_gita_txt(txt_path, output_path):
             print(f"❌ Error: Archivo {txt_path} no encontrado")
             return False
         
-        # Leer archivo
-        with open(txt_path, 'r', encoding='utf-8') as f:
-            contenido = f.read()
-        
-        print(f"📄 Archivo leído: {len(contenido)} caracteres")
+        print(f"📄 Archivo: {os.path.getsize(txt_path)} bytes")
+        print("🔍 Extrayendo capítulos, versos y locutores...")
         
-        # Extraer capítulos y versos
-        capitulos = extraer_capitulos_versos(contenido)
+        # Extraer capítulos y versos leyendo el archivo línea a línea
+        with open(txt_path, 'r', encoding='utf-8') as f:
+            capitulos = extraer_capitulos_versos(f)
         
         if not capitulos:
             print("❌ Error: No se pudieron extraer capítulos")
@@ -40,6 +41,7 @@ def procesar_bhagavad_gita_txt(txt_path, output_path):
             "traductor": "José Barrio Gutiérrez", 
             "fuente": txt_path,
             "total_capitulos": len(capitulos),
+            "tablas": tablas_corpus.anotar_capitulos(capitulos),
             "capitulos": capitulos
         }
         
@@ -53,8 +55,7 @@ def procesar_bhagavad_gita_txt(txt_path, output_path):
         # Análisis por capítulo
         for cap_num in sorted(capitulos.keys(), key=int):
             cap = capitulos[cap_num]
-            versos_krishna = sum(1 for v in cap['versos'].values() 
-                               if 'El Bienaventurado Señor' in v.get('locutor', ''))
+            versos_krishna = bhagavad_gita["tablas"]["versos_krishna"][cap_num]
             print(f"   📖 Cap {cap_num}: {len(cap['versos'])} versos ({versos_krishna} de Krishna)")
         
         # Guardar resultado
@@ -73,16 +74,37 @@ def procesar_bhagavad_gita_txt(txt_path, output_path):
         print(f"❌ Error al procesar archivo: {e}")
         return False
 
+# Capítulos escritos con ordinal ("Capítulo primero")
+ORDINALES = {
+    'primero': 1, 'segundo': 2, 'tercero': 3, 'cuarto': 4, 'quinto': 5, 'sexto': 6,
+    'séptimo': 7, 'octavo': 8, 'noveno': 9, 'décimo': 10, 'undécimo': 11, 'duodécimo': 12,
+    'decimotercero': 13, 'decimocuarto': 14, 'decimoquinto': 15, 'decimosexto': 16,
+    'decimoséptimo': 17, 'decimoctavo': 18,
+}
+
+# Patrones precompilados para detectar capítulos, locutores y versos
+PATRON_CAPITULO = re.compile(
+    r'Capítulo\s+([IVX]+|[\d]+|' + '|'.join(sorted(ORDINALES, key=len, reverse=True)) + r')',
+    re.IGNORECASE)
+PATRON_LOCUTOR = re.compile(r'^([A-Za-zñáéíóúÑÁÉÍÓÚ\s]+)\s+dijo:', re.IGNORECASE)
+PATRON_VERSO = re.compile(r'^\d+[\-\d]*\.')
+PATRON_FRASES = re.compile(r'[;:]\s*')
+PATRON_COMAS = re.compile(r'[,]\s*')
+
 def extraer_capitulos_versos(contenido):
-    """Extrae capítulos y versos del contenido del archivo TXT"""
-    print("🔍 Extrayendo capítulos, versos y locutores...")
+    """
+    Extrae capítulos y versos del archivo TXT en una sola pasada.
+
+    `contenido` puede ser el texto completo o cualquier iterable de líneas
+    (p. ej. el archivo abierto), de modo que no hace falta cargarlo entero.
+    Las líneas de continuación se acumulan en una lista de fragmentos del
+    verso actual y se unen una sola vez.
+    """
+    if isinstance(contenido, str):
+        contenido = io.StringIO(contenido)
     
     capitulos = {}
-    lineas = contenido.split('\n')
-    
-    # Patrones para detectar capítulos y locutores
-    patron_capitulo = r'Capítulo\s+([IVX]+|[\d]+)'
-    patron_locutor = r'^([A-Za-zñáéíóúÑÁÉÍÓÚ\s]+)\s+dijo:'
+    versos = None  # dict de versos del capítulo actual
     
     # Variables de estado
     capitulo_actual = None
@@ -90,16 +112,29 @@ def extraer_capitulos_versos(contenido):
     locutor_actual = ""
     esperando_titulo = False
     
-    for i, linea in enumerate(lineas):
+    # Verso que recibe las líneas de continuación (el último insertado en el capítulo)
+    registro_actual = None
+    fragmentos = []
+    
+    def cerrar_registro():
+        if registro_actual is not None and fragmentos:
+            registro_actual['texto'] = ' '.join([registro_actual['texto'], *fragmentos])
+            fragmentos.clear()
+    
+    def ultimo_registro():
+        # O(1): el último verso insertado en el capítulo actual
+        return versos[next(reversed(versos))] if versos else None
+    
+    for linea in contenido:
         linea = linea.strip()
         
         # Buscar capítulos
-        match_capitulo = re.search(patron_capitulo, linea, re.IGNORECASE)
+        match_capitulo = PATRON_CAPITULO.search(linea)
         if match_capitulo:
             cap_num_str = match_capitulo.group(1)
             
-            # Convertir números romanos a arábigos
-            cap_num = convertir_romano_a_arabigo(cap_num_str)
+            # Convertir ordinales y números romanos a arábigos
+            cap_num = ORDINALES.get(cap_num_str.lower()) or convertir_romano_a_arabigo(cap_num_str)
             if cap_num is None:
                 try:
                     cap_num = int(cap_num_str)
@@ -121,8 +156,10 @@ def extraer_capitulos_versos(contenido):
                     'titulo': titulo_actual,
                     'versos': {}
                 }
-                print(f"📖 Encontrado: Capítulo {capitulo_actual}")
             
+            cerrar_registro()
+            versos = capitulos[capitulo_actual]['versos']
+            registro_actual = ultimo_registro()
             continue
         
         # Capturar título del capítulo si estamos esperando
@@ -134,126 +171,84 @@ def extraer_capitulos_versos(contenido):
             continue
         
         # Buscar locutores (quien habla)
-        match_locutor = re.search(patron_locutor, linea, re.IGNORECASE)
+        match_locutor = PATRON_LOCUTOR.search(linea)
         if match_locutor:
             locutor_actual = match_locutor.group(1).strip()
-            print(f"   🗣️  {locutor_actual} habla en capítulo {capitulo_actual}")
             continue
         
         # Buscar versos (números seguidos de punto, incluyendo rangos)
-        if capitulo_actual and re.match(r'^\d+[\-\d]*\.', linea):
-            partes = linea.split('.', 1)
-            if len(partes) == 2:
-                verso_num_str = partes[0].strip()
-                verso_texto = partes[1].strip()
-                
-                # MANEJO DE VERSOS COMPUESTOS (ej: "3-4", "13-19")
-                if '-' in verso_num_str:
-                    rango = verso_num_str.split('-')
-                    if len(rango) == 2:
-                        try:
-                            inicio = int(rango[0])
-                            fin = int(rango[1])
-                            
-                            print(f"   📝 Verso compuesto {verso_num_str}: expandiendo versos {inicio}-{fin}")
-                            expandir_verso_compuesto(capitulos, capitulo_actual, inicio, fin, verso_texto, locutor_actual)
-                            
-                        except ValueError:
-                            # Si falla la conversión, tratar como verso simple
-                            capitulos[capitulo_actual]['versos'][verso_num_str] = {
-                                'texto': verso_texto,
-                                'significado': '',
-                                'locutor': locutor_actual
-                            }
-                else:
-                    # Verso simple
-                    capitulos[capitulo_actual]['versos'][verso_num_str] = {
-                        'texto': verso_texto,
-                        'significado': '',
-                        'locutor': locutor_actual
-                    }
-                    print(f"   📄 Verso {verso_num_str}: {verso_texto[:50]}...")
+        if capitulo_actual and PATRON_VERSO.match(linea):
+            verso_num_str, verso_texto = linea.split('.', 1)
+            verso_num_str = verso_num_str.strip()
+            verso_texto = verso_texto.strip()
+            
+            # MANEJO DE VERSOS COMPUESTOS (ej: "3-4", "13-19")
+            if '-' in verso_num_str:
+                rango = verso_num_str.split('-')
+                if len(rango) == 2:
+                    try:
+                        inicio = int(rango[0])
+                        fin = int(rango[1])
+                        expandir_verso_compuesto(capitulos, capitulo_actual, inicio, fin, verso_texto, locutor_actual)
+                    except ValueError:
+                        # Si falla la conversión, tratar como verso simple
+                        versos[verso_num_str] = {
+                            'texto': verso_texto,
+                            'significado': '',
+                            'locutor': locutor_actual
+                        }
+            else:
+                # Verso simple
+                versos[verso_num_str] = {
+                    'texto': verso_texto,
+                    'significado': '',
+                    'locutor': locutor_actual
+                }
+            
+            nuevo_registro = ultimo_registro()
+            if nuevo_registro is not registro_actual:
+                cerrar_registro()
+                registro_actual = nuevo_registro
         
         # Continuar texto de verso anterior
-        elif capitulo_actual and linea and not linea.startswith('Capítulo') and not re.match(patron_locutor, linea):
-            if capitulos[capitulo_actual]['versos']:
-                ultimo_verso = list(capitulos[capitulo_actual]['versos'].keys())[-1]
-                texto_actual = capitulos[capitulo_actual]['versos'][ultimo_verso]['texto']
-                capitulos[capitulo_actual]['versos'][ultimo_verso]['texto'] = texto_actual + ' ' + linea
+        elif registro_actual is not None and linea and not linea.startswith('Capítulo'):
+            fragmentos.append(linea)
     
+    cerrar_registro()
     return capitulos
 
 def expandir_verso_compuesto(capitulos, capitulo_actual, inicio, fin, texto_completo, locutor):
     """Expande un verso compuesto (ej: 13-19) en versos individuales"""
     
     num_versos = fin - inicio + 1
+    versos = capitulos[capitulo_actual]['versos']
     
     # Intentar dividir por frases (punto y coma, dos puntos)
-    frases = re.split(r'[;:]\s*', texto_completo)
-    frases = [f.strip() for f in frases if f.strip()]
+    frases = [f.strip() for f in PATRON_FRASES.split(texto_completo) if f.strip()]
+    separador = '; '
     
     if len(frases) < num_versos:
         # Si no hay suficientes frases, dividir por comas
-        frases = re.split(r'[,]\s*', texto_completo)
-        frases = [f.strip() for f in frases if f.strip()]
+        frases = [f.strip() for f in PATRON_COMAS.split(texto_completo) if f.strip()]
     
-    if len(frases) >= num_versos:
-        # Distribuir frases entre versos
-        frases_por_verso = len(frases) // num_versos
-        resto_frases = len(frases) % num_versos
-        
-        idx_frase = 0
-        for j in range(num_versos):
-            verso_individual = str(inicio + j)
-            
-            # Calcular frases para este verso
-            frases_este_verso = frases_por_verso
-            if j < resto_frases:
-                frases_este_verso += 1
-            
-            # Tomar las frases correspondientes
-            if frases_este_verso > 0:
-                texto_verso = '; '.join(frases[idx_frase:idx_frase + frases_este_verso])
-            else:
-                texto_verso = ""
-            
-            capitulos[capitulo_actual]['versos'][verso_individual] = {
-                'texto': texto_verso.strip(),
-                'significado': '',
-                'locutor': locutor
-            }
-            
-            idx_frase += frases_este_verso
-            print(f"      📄 Verso {verso_individual}: {texto_verso[:50]}...")
-    else:
+    if len(frases) < num_versos:
         # Si no hay suficientes frases, dividir equitativamente por palabras
-        palabras = texto_completo.split()
-        palabras_por_verso = len(palabras) // num_versos
-        resto_palabras = len(palabras) % num_versos
-        
-        idx_palabra = 0
-        for j in range(num_versos):
-            verso_individual = str(inicio + j)
-            
-            # Calcular palabras para este verso
-            palabras_este_verso = palabras_por_verso
-            if j < resto_palabras:
-                palabras_este_verso += 1
-            
-            # Tomar las palabras correspondientes
-            if palabras_este_verso > 0:
-                texto_verso = ' '.join(palabras[idx_palabra:idx_palabra + palabras_este_verso])
-            else:
-                texto_verso = ""
-            
-            capitulos[capitulo_actual]['versos'][verso_individual] = {
-                'texto': texto_verso.strip(),
-                'significado': '',
-                'locutor': locutor
-            }
-            
-            idx_palabra += palabras_este_verso
-            print(f"      📄 Verso {verso_individual}: {texto_verso[:50]}...")
+        frases = texto_completo.split()
+        separador = ' '
+    
+    # Distribuir frases (o palabras) entre versos
+    por_verso, resto = divmod(len(frases), num_versos)
+    
+    idx = 0
+    for j in range(num_versos):
+        cantidad = por_verso + (1 if j < resto else 0)
+        texto_verso = separador.join(frases[idx:idx + cantidad]) if cantidad > 0 else ""
+        versos[str(inicio + j)] = {
+            'texto': texto_verso.strip(),
+            'significado': '',
+            'locutor': locutor
+        }
+        idx += cantidad
 
 def convertir_romano_a_arabigo(romano):
     if not romano:
@@ -1,37 +1,24 @@
 """
 Construcción del prompt de Krishna con contexto del Bhagavad Gita
 y sistema anti-repetición.
+
+El prompt se arma en dos pasos: preparar_prompt_krishna() hace todo lo que
+depende solo del historial previo (tratamiento, contexto organizado, versos
+prohibidos, líneas del historial) y completar_prompt_krishna() añade la
+pregunta. El motor prepara el del siguiente turno en segundo plano.
 """
 
-import re
 import logging
+from dataclasses import dataclass
 
-logger = logging.getLogger(__name__)
+import citas
+import tablas_corpus
+import tracing
 
-NUMEROS_ROMANOS = ['', 'I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X',
-                   'XI', 'XII', 'XIII', 'XIV', 'XV', 'XVI', 'XVII', 'XVIII']
-
-def convertir_romano_a_arabigo(romano):
-    if not romano:
-        return None
-    valores = {'I': 1, 'V': 5, 'X': 10, 'L': 50, 'C': 100, 'D': 500, 'M': 1000}
-    try:
-        total = 0
-        i = 0
-        romano = romano.upper()
-        while i < len(romano):
-            if i + 1 < len(romano) and valores[romano[i]] < valores[romano[i + 1]]:
-                total += valores[romano[i + 1]] - valores[romano[i]]
-                i += 2
-            else:
-                total += valores[romano[i]]
-                i += 1
-        return total
-    except (KeyError, IndexError):
-        return None
+logger = logging.getLogger(__name__)
 
+@tracing.trazado("analisis_historial")
 def extraer_versos_citados_del_historial(historial_messages, bhagavad_gita, ventana_prohibicion=6):
-    import re
     versos_citados = set()
     textos_prohibidos = []
 
@@ -47,43 +34,59 @@ def extraer_versos_citados_del_historial(historial_messages, bhagavad_gita, vent
             return None
 
     mensajes_recientes = historial_messages[-ventana_prohibicion:] if len(historial_messages) > ventana_prohibicion else historial_messages
-    logger.info(f"Analizando últimos {len(mensajes_recientes)} mensajes para evitar repeticiones")
+    tracing.depurar("Analizando mensajes recientes para evitar repeticiones", mensajes=len(mensajes_recientes))
 
     for message in mensajes_recientes:
         if message["role"] == "assistant":
-            contenido = message["content"]
-            pattern_roman = r"\[C\.\s*([IVXLC]+)\s*-\s*(\d+)\]"
-            matches_roman = re.findall(pattern_roman, contenido)
-            for capitulo_roman, verso in matches_roman:
-                capitulo_arabigo = convertir_romano_a_arabigo(capitulo_roman)
-                if capitulo_arabigo is None:
-                    roman_map = {'I':1,'II':2,'III':3,'IV':4,'V':5,'VI':6,'VII':7,'VIII':8,'IX':9,'X':10,
-                                 'XI':11,'XII':12,'XIII':13,'XIV':14,'XV':15,'XVI':16,'XVII':17,'XVIII':18}
-                    capitulo_arabigo = roman_map.get(capitulo_roman)
-                if capitulo_arabigo:
-                    verso_key = f"{capitulo_arabigo}:{verso}"
-                    versos_citados.add(verso_key)
-                    texto_verso = obtener_texto_verso(capitulo_arabigo, verso)
-                    if texto_verso:
-                        textos_prohibidos.append(texto_verso)
-                        logger.info(f"Detectado verso [C. {capitulo_roman} - {verso}] → {verso_key}")
-
-            pattern_arabigo = r"\[C\.\s*(\d+)\s*-\s*(\d+)\]"
-            matches_arabigo = re.findall(pattern_arabigo, contenido)
-            for capitulo, verso in matches_arabigo:
-                verso_key = f"{capitulo}:{verso}"
+            # Citas estructuradas guardadas con la respuesta; si no las hay, se escanea el texto
+            claves_citadas = message.get("citas")
+            if claves_citadas is None:
+                claves_citadas = citas.claves(citas.extraer_citas(message["content"]))
+            for verso_key in claves_citadas:
                 versos_citados.add(verso_key)
-                texto_verso = obtener_texto_verso(capitulo, verso)
+                texto_verso = obtener_texto_verso(*verso_key.split(':'))
                 if texto_verso:
                     textos_prohibidos.append(texto_verso)
-                    logger.info(f"Detectado verso [C. {capitulo} - {verso}] → {verso_key}")
+                    tracing.depurar("Detectado verso citado", verso=verso_key)
 
-    logger.info(f"Total versos citados: {len(versos_citados)}, textos prohibidos: {len(textos_prohibidos)}")
+    tracing.depurar("Versos citados en la ventana", ventana=ventana_prohibicion,
+                    citados=lambda: sorted(versos_citados), textos_prohibidos=len(textos_prohibidos))
     return versos_citados, textos_prohibidos
 
+@dataclass
+class PromptPreparado:
+    """Partes del prompt que no dependen de la pregunta."""
+    cabecera: str           # instrucciones, versos prohibidos y contexto
+    historial: str          # líneas de los mensajes previos que entran en el historial
+    pie: str                # instrucciones finales
+    nombre_usuario: str
+
+
+def _linea_historial(msg, nombre_usuario):
+    if msg["role"] == "user":
+        return f"{nombre_usuario.upper()}: {msg['content']}\n"
+    return f"KRISHNA: {msg['content']}\n"
+
+
+@tracing.trazado("construccion_prompt")
 def construir_prompt_krishna(pregunta_arjuna, versos_contexto, bhagavad_gita,
                               historial_chat=None, nombre_usuario="Arjuna",
                               genero_usuario=None, api_rotator=None):
+    """El último mensaje de historial_chat es la pregunta en curso (el motor la añade antes)."""
+    historial_chat = historial_chat or []
+    preparado = preparar_prompt_krishna(versos_contexto, bhagavad_gita, historial_chat[:-1],
+                                        nombre_usuario, genero_usuario, api_rotator)
+    return completar_prompt_krishna(preparado, pregunta_arjuna, historial_chat[-1] if historial_chat else None)
+
+
+def preparar_prompt_krishna(versos_contexto, bhagavad_gita, historial_previo=None, nombre_usuario="Arjuna",
+                            genero_usuario=None, api_rotator=None, textos_prohibidos=True) -> PromptPreparado:
+    """
+    Todo el prompt salvo la pregunta, para un historial al que aún se añadirá
+    el mensaje de la pregunta: las ventanas (6 mensajes de historial, 8 de
+    versos prohibidos) se cuentan incluyéndolo. Con textos_prohibidos=False
+    los versos prohibidos se listan solo por referencia (prompt más corto).
+    """
     from gender_detector import obtener_tratamiento_genero
     tratamiento = obtener_tratamiento_genero(nombre_usuario, genero_usuario, api_rotator)
     querido_a = tratamiento["querido"]
@@ -105,7 +108,7 @@ def construir_prompt_krishna(pregunta_arjuna, versos_contexto, bhagavad_gita,
     if versos_krishna:
         contexto_organizado += "=== ENSEÑANZAS DE KRISHNA ===\n"
         contexto_organizado += "\n\n".join(versos_krishna) + "\n\n"
-        logger.info(f"Incluidos {len(versos_krishna)} versos de Krishna en el contexto")
+        tracing.depurar("Versos de Krishna incluidos en el contexto", versos=len(versos_krishna))
     if versos_arjuna:
         contexto_organizado += "=== PREGUNTAS Y DUDAS DE ARJUNA ===\n"
         contexto_organizado += "\n\n".join(versos_arjuna[:5]) + "\n\n"
@@ -113,30 +116,18 @@ def construir_prompt_krishna(pregunta_arjuna, versos_contexto, bhagavad_gita,
         contexto_organizado += "=== CONTEXTO NARRATIVO ===\n"
         contexto_organizado += "\n\n".join(versos_otros[:3])
 
-    historial_conversacion = ""
-    if historial_chat and len(historial_chat) > 0:
-        historial_conversacion = "\n=== CONVERSACIÓN PREVIA ===\n"
-        mensajes_recientes = historial_chat[-6:]
-        for msg in mensajes_recientes:
-            if msg["role"] == "user":
-                historial_conversacion += f"{nombre_usuario.upper()}: {msg['content']}\n"
-            else:
-                historial_conversacion += f"KRISHNA: {msg['content']}\n"
-        historial_conversacion += "=== FIN DE CONVERSACIÓN PREVIA ===\n\n"
+    historial_previo = historial_previo or []
+    historial_conversacion = "".join(_linea_historial(msg, nombre_usuario) for msg in historial_previo[-5:])
 
     versos_prohibidos_info = ""
-    if historial_chat and len(historial_chat) > 0:
+    if historial_previo:
+        # El mensaje de la pregunta ocupa un hueco de la ventana y no tiene citas
         versos_citados_en_conversacion, textos_prohibidos_completos = extraer_versos_citados_del_historial(
-            historial_chat, bhagavad_gita, ventana_prohibicion=8)
+            historial_previo, bhagavad_gita, ventana_prohibicion=7)
         if versos_citados_en_conversacion:
-            def convertir_a_formato_cita(verso_key):
-                cap, ver = verso_key.split(':')
-                cap_romano = NUMEROS_ROMANOS[int(cap)] if int(cap) < len(NUMEROS_ROMANOS) else cap
-                return f"[C. {cap_romano} - {ver}]"
-
-            versos_prohibidos_formateados = [convertir_a_formato_cita(v) for v in versos_citados_en_conversacion]
+            versos_prohibidos_formateados = [tablas_corpus.cita(bhagavad_gita, v) for v in versos_citados_en_conversacion]
             textos_prohibidos_seccion = ""
-            if textos_prohibidos_completos:
+            if textos_prohibidos and textos_prohibidos_completos:
                 textos_prohibidos_seccion = "\n🚫 TEXTOS DE VERSOS ESTRICTAMENTE PROHIBIDOS:\n"
                 for i, texto in enumerate(textos_prohibidos_completos, 1):
                     textos_prohibidos_seccion += f"\n{i}. \"{texto}\"\n"
@@ -152,9 +143,10 @@ def construir_prompt_krishna(pregunta_arjuna, versos_contexto, bhagavad_gita,
 💡 PRIORIZA CAPÍTULOS QUE NO APARECEN EN LA LISTA PROHIBIDA
 
 """
-            logger.info(f"Versos prohibidos: {versos_prohibidos_formateados}")
+            tracing.depurar("Versos prohibidos en el prompt", versos=versos_prohibidos_formateados,
+                            textos=len(textos_prohibidos_completos))
 
-    prompt = f"""
+    cabecera = f"""
 Eres Krishna, la Suprema Personalidad de Dios, respondiendo a {nombre_usuario} en el campo de batalla de Kurukshetra. 
 {nombre_usuario} te está haciendo una pregunta o planteando una duda. Debes responder EXACTAMENTE como Krishna respondería en el Bhagavad Gita.
 
@@ -197,10 +189,9 @@ INSTRUCCIONES IMPORTANTES:
 {contexto_organizado}
 --- FIN DEL CONTEXTO ---
 
-{historial_conversacion}--- PREGUNTA ACTUAL DE {nombre_usuario.upper()} ---
-{pregunta_arjuna}
---- FIN DE LA PREGUNTA ---
+"""
 
+    pie = f"""
 Responde como Krishna, usando ÚNICAMENTE las enseñanzas de los versos anteriores que fueron pronunciadas por Krishna (El Bienaventurado Señor). Tu respuesta debe ser fiel al contenido y estilo del Bhagavad Gita.
 
 ESTRUCTURA DE RESPUESTA SEGÚN TIPO DE PREGUNTA:
@@ -241,9 +232,21 @@ JAMÁS uses: "Además", "Por tanto", "También", "Sin embargo", "Es más", "Asim
 USA SOLO: "Te digo que", "Sabe que", "Escucha", "Mi {querido_a} [nombre]", "Quien", "Aquel que", "Por ello"
 """
 
-    total_chars = len(prompt)
-    logger.info(f"Prompt construido: {total_chars:,} caracteres, {len(versos_contexto)} versos en contexto")
-    return prompt
+    tracing.depurar("Prompt de Krishna preparado", caracteres=len(cabecera) + len(pie),
+                    versos_contexto=len(versos_contexto), anti_repeticion=bool(versos_prohibidos_info))
+    return PromptPreparado(cabecera, historial_conversacion, pie, nombre_usuario)
 
-def calcular_max_tokens_respuesta():
-    return 1200
+
+def completar_prompt_krishna(preparado: PromptPreparado, pregunta_arjuna, ultimo_mensaje=None) -> str:
+    """Prompt final: la parte preparada más la pregunta; ultimo_mensaje cierra el historial."""
+    historial_conversacion = ""
+    if ultimo_mensaje is not None:
+        historial_conversacion = ("\n=== CONVERSACIÓN PREVIA ===\n" + preparado.historial
+                                  + _linea_historial(ultimo_mensaje, preparado.nombre_usuario)
+                                  + "=== FIN DE CONVERSACIÓN PREVIA ===\n\n")
+    prompt = (f"{preparado.cabecera}{historial_conversacion}"
+              f"--- PREGUNTA ACTUAL DE {preparado.nombre_usuario.upper()} ---\n"
+              f"{pregunta_arjuna}\n"
+              f"--- FIN DE LA PREGUNTA ---\n{preparado.pie}")
+    tracing.depurar("Prompt de Krishna construido", caracteres=len(prompt), preview=lambda: prompt[:800])
+    return prompt
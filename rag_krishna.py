@@ -2,6 +2,8 @@
 Módulo RAG (Retrieval-Augmented Generation) para Krishna AI.
 Genera embeddings semánticos de los versos del Bhagavad Gita
 y recupera los más relevantes para cada pregunta del usuario.
+Sin embedding de la pregunta (error o plazo agotado) ordena los versos por
+términos en común con ella.
 """
 
 import json
@@ -10,12 +12,20 @@ import pickle
 import numpy as np
 import google.generativeai as genai
 import logging
+import tablas_corpus
+import tracing
+from degradacion import ordenar_por_afinidad
+from plazo import MIN_INTENTO_S, Plazo
+from vuelo_unico import VueloUnico
 
 logger = logging.getLogger(__name__)
 
 EMBEDDING_CACHE = "embeddings_cache.pkl"
 EMBEDDING_MODEL = "models/embedding-001"
 
+# Embeddings del mismo texto pedidos a la vez (p. ej. una pregunta popular) salen una sola vez
+_vuelos_embedding = VueloUnico("embedding")
+
 class RAGKrishna:
     def __init__(self, bhagavad_gita: dict, api_rotator=None):
         self.bhagavad_gita = bhagavad_gita
@@ -23,15 +33,20 @@ class RAGKrishna:
         self.verse_embeddings: list[dict] = []
         self._load_or_build_embeddings()
 
-    def _get_embedding(self, text: str) -> list[float]:
+    def _get_embedding(self, text: str, plazo: Plazo | None = None) -> list[float]:
         if self.api_rotator:
             key_info = self.api_rotator.api_keys[self.api_rotator.current_key_index]
             genai.configure(api_key=key_info.key)
+        # Con plazo, la llamada y la espera a otra idéntica en vuelo no lo exceden
+        opciones = {"request_options": {"timeout": plazo.restante()}} if plazo is not None else {}
         try:
-            result = genai.embed_content(model=EMBEDDING_MODEL, content=text)
+            result = _vuelos_embedding.ejecutar(
+                f"{EMBEDDING_MODEL}\0{text}",
+                lambda: genai.embed_content(model=EMBEDDING_MODEL, content=text, **opciones),
+                timeout=plazo.restante() if plazo is not None else None)
             return result['embedding']
         except Exception as e:
-            logger.warning(f"Embedding falló, usando fallback: {e}")
+            logger.warning("Embedding falló, usando fallback: %s", e)
             return [0.0] * 768
 
     def _build_all_embeddings(self) -> list[dict]:
@@ -40,33 +55,23 @@ class RAGKrishna:
             capitulo = self.bhagavad_gita['capitulos'][cap_num]
             for verso_num in sorted(capitulo['versos'].keys(), key=int):
                 verso = capitulo['versos'][verso_num]
-                locutor = verso.get('locutor', '')
-                texto = verso.get('texto', '')
-                significado = verso.get('significado', '')
-                texto_completo = f"Capítulo {cap_num}, Verso {verso_num}"
-                if locutor:
-                    texto_completo += f" ({locutor})"
-                if texto:
-                    texto_completo += f": {texto}"
-                if significado:
-                    texto_completo += f" SIGNIFICADO: {significado}"
                 verses.append({
                     'capitulo': int(cap_num),
                     'verso': int(verso_num),
-                    'texto_completo': texto_completo,
-                    'locutor': locutor,
-                    'es_krishna': 'El Bienaventurado Señor' in locutor,
+                    'texto_completo': tablas_corpus.texto_completo(cap_num, verso_num, verso),
+                    'locutor': verso.get('locutor', ''),
+                    'es_krishna': tablas_corpus.es_krishna(verso),
                     'embedding': None
                 })
         total = len(verses)
-        logger.info(f"Generando embeddings para {total} versos...")
+        logger.info("Generando embeddings para %d versos...", total)
         for i, v in enumerate(verses):
             if i % 20 == 0:
-                logger.info(f"  Embedding {i+1}/{total}")
+                logger.info("  Embedding %d/%d", i + 1, total)
             try:
                 v['embedding'] = self._get_embedding(v['texto_completo'])
             except Exception as e:
-                logger.warning(f"  Error en embedding {i+1}: {e}")
+                logger.warning("  Error en embedding %d: %s", i + 1, e)
                 v['embedding'] = [0.0] * 768
         return verses
 
@@ -75,10 +80,10 @@ class RAGKrishna:
             try:
                 with open(EMBEDDING_CACHE, 'rb') as f:
                     self.verse_embeddings = pickle.load(f)
-                logger.info(f"Embeddings cargados desde caché: {len(self.verse_embeddings)} versos")
+                logger.info("Embeddings cargados desde caché: %d versos", len(self.verse_embeddings))
                 return
             except Exception as e:
-                logger.warning(f"No se pudo cargar caché de embeddings: {e}")
+                logger.warning("No se pudo cargar caché de embeddings: %s", e)
         logger.info("Construyendo embeddings desde cero...")
         self.verse_embeddings = self._build_all_embeddings()
         try:
@@ -86,13 +91,17 @@ class RAGKrishna:
                 pickle.dump(self.verse_embeddings, f)
             logger.info("Embeddings guardados en caché")
         except Exception as e:
-            logger.warning(f"No se pudo guardar caché de embeddings: {e}")
+            logger.warning("No se pudo guardar caché de embeddings: %s", e)
 
-    def obtener_versos_relevantes(self, pregunta: str, top_k: int = 25, versos_citados_previos: set | None = None) -> list[dict]:
+    def obtener_versos_relevantes(self, pregunta: str, top_k: int = 25, versos_citados_previos: set | None = None,
+                                  plazo: Plazo | None = None) -> list[dict]:
         if versos_citados_previos is None:
             versos_citados_previos = set()
+        if plazo is not None and not plazo.permite("embedding_pregunta", MIN_INTENTO_S):
+            # Sin tiempo para el embedding de la pregunta: contexto sin ordenar por similitud
+            return self._fallback_versos(versos_citados_previos, pregunta, top_k)
         try:
-            query_emb = self._get_embedding(pregunta)
+            query_emb = self._get_embedding(pregunta, plazo)
             query_vec = np.array(query_emb, dtype=np.float32)
             similarities = []
             for v in self.verse_embeddings:
@@ -115,13 +124,15 @@ class RAGKrishna:
                 sim = similarities[idx]
                 if sim > 0.3:
                     resultados.append(self.verse_embeddings[idx])
-            logger.info(f"RAG: '{pregunta[:50]}...' → {len(resultados)} versos recuperados de {top_k} candidatos")
+            tracing.depurar("RAG: versos recuperados", pregunta=lambda: pregunta[:50],
+                            versos=len(resultados), candidatos=top_k)
             return resultados
         except Exception as e:
-            logger.warning(f"Error en RAG, usando fallback: {e}")
-            return self._fallback_versos(versos_citados_previos)
+            logger.warning("Error en RAG, usando fallback: %s", e)
+            return self._fallback_versos(versos_citados_previos, pregunta, top_k)
 
-    def _fallback_versos(self, versos_citados_previos: set) -> list[dict]:
+    def _fallback_versos(self, versos_citados_previos: set, pregunta: str = "", top_k: int = 25) -> list[dict]:
+        """Versos de Krishna no citados, ordenados por términos en común con la pregunta (sin embeddings)."""
         resultados = []
         for cap_num in sorted(self.bhagavad_gita['capitulos'].keys(), key=int):
             capitulo = self.bhagavad_gita['capitulos'][cap_num]
@@ -130,27 +141,13 @@ class RAGKrishna:
                 verso_key = f"{cap_num}:{verso_num}"
                 if verso_key in versos_citados_previos:
                     continue
-                locutor = verso.get('locutor', '')
-                if 'El Bienaventurado Señor' not in locutor:
+                if not tablas_corpus.es_krishna(verso):
                     continue
-                texto = verso.get('texto', '')
-                significado = verso.get('significado', '')
-                texto_completo = f"Capítulo {cap_num}, Verso {verso_num}"
-                if locutor:
-                    texto_completo += f" ({locutor})"
-                if texto:
-                    texto_completo += f": {texto}"
-                if significado:
-                    texto_completo += f" SIGNIFICADO: {significado}"
                 resultados.append({
                     'capitulo': int(cap_num),
                     'verso': int(verso_num),
-                    'texto_completo': texto_completo,
-                    'locutor': locutor,
+                    'texto_completo': tablas_corpus.texto_completo(cap_num, verso_num, verso),
+                    'locutor': verso.get('locutor', ''),
                     'es_krishna': True,
                 })
-                if len(resultados) >= 25:
-                    break
-            if len(resultados) >= 25:
-                break
-        return resultados
+        return ordenar_por_afinidad(pregunta, resultados)[:top_k]
@@ -1,6 +1,10 @@
 """
 Sistema de rotación de claves API para Gemini
-Maneja múltiples claves API y rota automáticamente cuando se encuentra un error 429
+Maneja múltiples claves API y rota automáticamente cuando se encuentra un error 429.
+Cada llamada empieza con la clave elegida por latencia y tasa de error
+(telemetria_claves.py), de modo que el tráfico se desplaza solo hacia las
+claves rápidas y sanas. Con un Plazo (plazo.py), el timeout de cada intento,
+las pausas y los reintentos se recortan a lo que queda del turno.
 """
 
 import google.generativeai as genai
@@ -13,6 +17,11 @@ import threading
 from concurrent.futures import ThreadPoolExecutor, TimeoutError
 import signal
 import streamlit as st
+import metrics
+import tracing
+from plazo import MIN_INTENTO_S, Plazo, PlazoAgotado
+from telemetria_claves import TelemetriaClaves
+from vuelo_unico import RespuestaCompartida, VueloUnico, clave_peticion
 
 @dataclass
 class APIKeyInfo:
@@ -56,18 +65,31 @@ def load_api_keys_from_secrets():
 class GeminiAPIRotator:
     """Gestor de rotación de claves API para Gemini"""
     
-    def __init__(self):
-        """Inicializa el rotador con las claves disponibles desde secrets.toml"""
+    def __init__(self, api_keys: Optional[List[APIKeyInfo]] = None, generador=None, coalescer: bool = True):
+        """
+        Inicializa el rotador con las claves disponibles desde secrets.toml
+        
+        Args:
+            api_keys: Claves explícitas (benchmarks, tests); por defecto se leen de secrets.toml
+            generador: Función (model_name, prompt, generation_config, stream) que sustituye
+                a genai.GenerativeModel, p. ej. el Gemini falso de benchmarks/
+            coalescer: Si True, las llamadas idénticas simultáneas comparten una sola petición
+        """
         # Cargar las claves desde secrets.toml
-        self.api_keys = load_api_keys_from_secrets()
+        self.api_keys = api_keys if api_keys is not None else load_api_keys_from_secrets()
+        self.generador = generador
+        self.vuelos = VueloUnico("generacion") if coalescer else None
+        self.telemetria = TelemetriaClaves()
+        # La clave configurada en genai es global al proceso: se elige bajo este cerrojo en cada llamada
+        self._lock_clave = threading.Lock()
         
         # Empezar con una clave aleatoria para distribuir la carga
         self.current_key_index = random.randint(0, len(self.api_keys) - 1)
         self.logger = logging.getLogger(__name__)
         
         # Log inicial con información sobre la clave aleatoria seleccionada
-        self.logger.info(f"Iniciando rotador de claves API con {len(self.api_keys)} claves disponibles")
-        self.logger.info(f"Clave inicial seleccionada aleatoriamente: {self.api_keys[self.current_key_index].name}")
+        self.logger.info("Iniciando rotador de claves API con %d claves disponibles", len(self.api_keys))
+        self.logger.info("Clave inicial seleccionada aleatoriamente: %s", self.api_keys[self.current_key_index].name)
         
         # Configurar la primera clave (que ahora es aleatoria)
         self._configure_current_key()
@@ -77,10 +99,11 @@ class GeminiAPIRotator:
         current_key = self.api_keys[self.current_key_index]
         genai.configure(api_key=current_key.key)
         current_key.last_used = time.time()
-        self.logger.info(f"Configurada clave API: {current_key.name} (índice {self.current_key_index})")
+        self.logger.info("Configurada clave API: %s (índice %s)", current_key.name, self.current_key_index)
     
-    def _get_next_available_key(self) -> Optional[int]:
-        """Encuentra la siguiente clave disponible"""
+    @tracing.trazado("seleccion_clave")
+    def _get_next_available_key(self, excluir_actual: bool = False) -> Optional[int]:
+        """Elige una clave disponible por coste (latencia y tasa de error), con dos candidatas al azar"""
         current_time = time.time()
         
         # Primero, desbloquear claves que han pasado su tiempo de bloqueo
@@ -88,7 +111,7 @@ class GeminiAPIRotator:
             if key_info.is_blocked and current_time > key_info.block_until:
                 key_info.is_blocked = False
                 key_info.failed_count = 0
-                self.logger.info(f"Clave {key_info.name} desbloqueada")
+                self.logger.info("Clave %s desbloqueada", key_info.name)
         
         # Buscar una clave no bloqueada
         available_keys = [i for i, key in enumerate(self.api_keys) if not key.is_blocked]
@@ -96,9 +119,20 @@ class GeminiAPIRotator:
         if not available_keys:
             return None
         
-        # Seleccionar la clave que hace más tiempo que no se usa
-        best_key_index = min(available_keys, key=lambda i: self.api_keys[i].last_used)
-        return best_key_index
+        # Tras un fallo se prefiere otra clave si la hay
+        if excluir_actual and len(available_keys) > 1 and self.current_key_index in available_keys:
+            available_keys.remove(self.current_key_index)
+
+        nombres = {self.api_keys[i].name: i for i in available_keys}
+        return nombres[self.telemetria.elegir(list(nombres))]
+
+    def _elegir_clave(self):
+        """Clave para una llamada nueva: la de menor coste de dos al azar (no bloquea ninguna)"""
+        with self._lock_clave:
+            indice = self._get_next_available_key()
+            if indice is not None and indice != self.current_key_index:
+                self.current_key_index = indice
+                self._configure_current_key()
     
     def _block_current_key(self, duration_minutes: int = 60, reason: str = "error 429"):
         """Bloquea la clave actual por un tiempo determinado"""
@@ -107,11 +141,11 @@ class GeminiAPIRotator:
         current_key.block_until = time.time() + (duration_minutes * 60)
         current_key.failed_count += 1
         
-        self.logger.warning(f"Clave {current_key.name} bloqueada por {duration_minutes} minutos debido a {reason}")
+        self.logger.warning("Clave %s bloqueada por %d minutos debido a %s", current_key.name, duration_minutes, reason)
     
     def _rotate_key_silently(self) -> bool:
         """Rota a la siguiente clave disponible sin bloquear la actual (para timeouts)"""
-        next_key_index = self._get_next_available_key()
+        next_key_index = self._get_next_available_key(excluir_actual=True)
         
         if next_key_index is None:
             self.logger.error("No hay claves API disponibles. Todas están bloqueadas.")
@@ -125,68 +159,88 @@ class GeminiAPIRotator:
         
         return False
     
-    def _generate_content_single_attempt(self, model_name: str, prompt: str, generation_config: dict):
-        """Intenta generar contenido una sola vez"""
+    def _generate_content_single_attempt(self, model_name: str, prompt: str, generation_config: dict, stream: bool = False,
+                                         timeout: Optional[float] = None):
+        """Intenta generar contenido una sola vez; timeout es el de la petición HTTP (incluido el stream)"""
+        if self.generador is not None:
+            return self.generador(model_name, prompt, generation_config, stream=stream)
         model = genai.GenerativeModel(model_name)
-        return model.generate_content(prompt, generation_config=generation_config)
+        request_options = {"timeout": timeout} if timeout is not None else None
+        return model.generate_content(prompt, generation_config=generation_config, stream=stream,
+                                      request_options=request_options)
     
     def _timeout_handler(self, signum, frame):
         """Manejador de timeout para signal"""
         raise TimeoutError("Timeout alcanzado")
     
-    def _try_generate_with_signal_timeout(self, model_name: str, prompt: str, generation_config: dict, timeout_seconds: int = 10):
+    def _try_generate_with_signal_timeout(self, model_name: str, prompt: str, generation_config: dict, timeout_seconds: float = 10, stream: bool = False,
+                                          timeout_peticion: Optional[float] = None):
         """Intenta generar contenido con timeout usando signal (más agresivo)"""
+        # Configurar signal timeout (solo funciona en sistemas Unix y en el hilo principal).
+        # setitimer admite fracciones de segundo: alarm() redondeaba hacia abajo los timeouts recortados por el plazo
+        signal.signal(signal.SIGALRM, self._timeout_handler)
+        signal.setitimer(signal.ITIMER_REAL, max(timeout_seconds, 0.01))
         try:
-            # Configurar signal timeout (solo funciona en sistemas Unix)
-            signal.signal(signal.SIGALRM, self._timeout_handler)
-            signal.alarm(timeout_seconds)
-            
             # Generar contenido
-            response = self._generate_content_single_attempt(model_name, prompt, generation_config)
-            
-            # Cancelar alarm si terminó antes
-            signal.alarm(0)
+            response = self._generate_content_single_attempt(model_name, prompt, generation_config, stream,
+                                                             timeout_peticion)
             return response, False  # respuesta, timeout_occurred
             
         except TimeoutError:
-            signal.alarm(0)  # Cancelar alarm
-            self.logger.warning(f"Signal timeout de {timeout_seconds}s alcanzado")
+            self.logger.warning("Signal timeout de %ss alcanzado", timeout_seconds)
             return None, True  # respuesta, timeout_occurred
-    def _try_generate_with_hybrid_timeout(self, model_name: str, prompt: str, generation_config: dict, timeout_seconds: int = 10):
+        finally:
+            # Cancelar el temporizador también si la llamada lanzó otro error (p. ej. 429)
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    def _try_generate_with_hybrid_timeout(self, model_name: str, prompt: str, generation_config: dict, timeout_seconds: float = 10, stream: bool = False,
+                                          timeout_peticion: Optional[float] = None):
         """Intenta timeout híbrido: signal para Unix, ThreadPoolExecutor como fallback"""
         import platform
         
-        # En sistemas Unix/Linux/macOS, intentar con signal primero
-        if platform.system() in ['Darwin', 'Linux']:
-            try:
-                return self._try_generate_with_signal_timeout(model_name, prompt, generation_config, timeout_seconds)
-            except Exception as e:
-                self.logger.warning(f"Signal timeout falló: {e}, usando ThreadPoolExecutor")
+        # En sistemas Unix/Linux/macOS y desde el hilo principal, usar signal.
+        # Los errores de la propia llamada (429, etc.) se propagan sin repetir la llamada.
+        if platform.system() in ['Darwin', 'Linux'] and threading.current_thread() is threading.main_thread():
+            return self._try_generate_with_signal_timeout(model_name, prompt, generation_config, timeout_seconds, stream,
+                                                          timeout_peticion)
         
-        # Fallback o sistemas Windows: usar ThreadPoolExecutor
-        return self._try_generate_with_timeout(model_name, prompt, generation_config, timeout_seconds)
+        # Hilos secundarios (Streamlit, servidores) o Windows: usar ThreadPoolExecutor
+        return self._try_generate_with_timeout(model_name, prompt, generation_config, timeout_seconds, stream,
+                                               timeout_peticion)
     
-    def _try_generate_with_timeout(self, model_name: str, prompt: str, generation_config: dict, timeout_seconds: int = 10):
+    def _try_generate_with_timeout(self, model_name: str, prompt: str, generation_config: dict, timeout_seconds: float = 10, stream: bool = False,
+                                   timeout_peticion: Optional[float] = None):
         """Intenta generar contenido con timeout usando ThreadPoolExecutor"""
-        with ThreadPoolExecutor(max_workers=1) as executor:
-            try:
-                future = executor.submit(self._generate_content_single_attempt, model_name, prompt, generation_config)
-                # Esperar por la respuesta con timeout
-                response = future.result(timeout=timeout_seconds)
-                return response, False  # respuesta, timeout_occurred
-            except TimeoutError:
-                # Cancelar la tarea pendiente
-                future.cancel()
-                self.logger.warning(f"Timeout de {timeout_seconds}s alcanzado, cancelando tarea")
-                return None, True  # respuesta, timeout_occurred
-            except Exception as e:
-                # Para otros errores durante la ejecución
-                future.cancel()
-                raise e
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(self._generate_content_single_attempt, model_name, prompt, generation_config, stream,
+                                 timeout_peticion)
+        try:
+            # Esperar por la respuesta con timeout
+            response = future.result(timeout=timeout_seconds)
+            return response, False  # respuesta, timeout_occurred
+        except TimeoutError:
+            # Cancelar la tarea pendiente
+            future.cancel()
+            self.logger.warning("Timeout de %ss alcanzado, cancelando tarea", timeout_seconds)
+            return None, True  # respuesta, timeout_occurred
+        finally:
+            # No esperar al hilo colgado: con `with` el timeout no devolvía el control
+            # hasta que la llamada terminaba por su cuenta
+            executor.shutdown(wait=False)
+    
+    def _esperar(self, segundos: float, plazo: Optional[Plazo] = None):
+        """Pausa entre intentos, medida como etapa propia; con plazo, deja tiempo para el siguiente intento"""
+        if plazo is not None:
+            segundos = min(segundos, max(0.0, plazo.restante() - MIN_INTENTO_S))
+            if segundos <= 0:
+                return
+        metrics.contar("krishnai_espera_segundos_total", "Segundos de pausa entre reintentos", segundos)
+        with tracing.span("espera_reintento"):
+            time.sleep(segundos)
     
     def rotate_key(self) -> bool:
         """Rota a la siguiente clave disponible"""
-        next_key_index = self._get_next_available_key()
+        next_key_index = self._get_next_available_key(excluir_actual=True)
         
         if next_key_index is None:
             self.logger.error("No hay claves API disponibles. Todas están bloqueadas.")
@@ -202,7 +256,26 @@ class GeminiAPIRotator:
         
         return True
     
-    def generate_content_with_retry(self, model_name: str, prompt: str, generation_config: dict, max_retries: int = 3, timeout_seconds: int = 10):
+    def generate_content_with_retry(self, model_name: str, prompt: str, generation_config: dict, max_retries: int = 3, timeout_seconds: int = 10, stream: bool = False, plazo: Optional[Plazo] = None):
+        """
+        Genera contenido con reintentos automáticos, rotación de claves y timeout.
+
+        Las llamadas idénticas (modelo, prompt, configuración y modo) que llegan
+        mientras otra está en vuelo esperan a esa y reciben su misma respuesta;
+        en streaming, cada una la recorre desde el primer fragmento. Con plazo,
+        la espera a la llamada en vuelo tampoco lo excede.
+        """
+        if self.vuelos is None:
+            return self._generate_content_with_retry(model_name, prompt, generation_config, max_retries, timeout_seconds, stream, plazo)
+
+        def generar():
+            respuesta = self._generate_content_with_retry(model_name, prompt, generation_config, max_retries, timeout_seconds, stream, plazo)
+            return RespuestaCompartida(respuesta) if stream else respuesta
+
+        clave = clave_peticion(model_name, prompt, generation_config, stream)
+        return self.vuelos.ejecutar(clave, generar, timeout=plazo.restante() if plazo is not None else None)
+
+    def _generate_content_with_retry(self, model_name: str, prompt: str, generation_config: dict, max_retries: int = 3, timeout_seconds: int = 10, stream: bool = False, plazo: Optional[Plazo] = None):
         """
         Genera contenido con reintentos automáticos, rotación de claves y timeout
         
@@ -212,28 +285,55 @@ class GeminiAPIRotator:
             generation_config: Configuración de generación
             max_retries: Número máximo de reintentos
             timeout_seconds: Timeout en segundos para cada intento
+            stream: Si True, devuelve la respuesta en streaming (iterable de fragmentos)
+            plazo: Plazo del turno; recorta el timeout de cada intento y no se
+                empieza un reintento con menos de MIN_INTENTO_S restantes
         
         Returns:
             Respuesta del modelo o lanza excepción si fallan todos los intentos
         """
         
+        self._elegir_clave()
+        # Todas bloqueadas: se falla enseguida en vez de gastar intentos que darán 429
+        if self.segundos_hasta_clave() > 0:
+            raise RuntimeError("Se agotaron todos los reintentos y claves API disponibles (todas bloqueadas)")
+
         for attempt in range(max_retries + 1):
+            if plazo is not None:
+                if attempt > 0 and not plazo.permite("reintento", MIN_INTENTO_S):
+                    raise PlazoAgotado("reintentos")
+                plazo.comprobar("llamada_llm")
+                intento_timeout = plazo.recortar(timeout_seconds)
+                # En streaming la petición sigue abierta mientras llegan fragmentos: hasta el fin del plazo
+                timeout_peticion = plazo.restante() if stream else intento_timeout
+            else:
+                intento_timeout = timeout_peticion = timeout_seconds
+                if stream:
+                    timeout_peticion = None
             current_key = self.api_keys[self.current_key_index]
-            self.logger.info(f"Intento {attempt + 1}/{max_retries + 1} con clave {current_key.name}")
+            self.logger.info("Intento %d/%d con clave %s", attempt + 1, max_retries + 1, current_key.name)
+            if attempt > 0:
+                metrics.contar("krishnai_reintentos_total", "Reintentos de generación", modelo=model_name)
             
             try:
                 # Intentar generar contenido con timeout híbrido
-                response, timeout_occurred = self._try_generate_with_hybrid_timeout(
-                    model_name, prompt, generation_config, timeout_seconds
-                )
+                inicio = time.perf_counter()
+                with tracing.span("intento_llm", intento=attempt + 1, clave=current_key.name):
+                    response, timeout_occurred = self._try_generate_with_hybrid_timeout(
+                        model_name, prompt, generation_config, intento_timeout, stream, timeout_peticion
+                    )
+                # Un timeout cuenta como error con la latencia del límite
+                self.telemetria.registrar(current_key.name, time.perf_counter() - inicio, timeout_occurred)
                 
                 if timeout_occurred:
                     # Timeout: rotar clave silenciosamente sin bloquear
-                    self.logger.warning(f"Timeout de {timeout_seconds}s con clave {current_key.name}. Rotando...")
+                    self.logger.warning("Timeout de %.1fs con clave %s. Rotando...", intento_timeout, current_key.name)
+                    metrics.contar("krishnai_intentos_total", "Intentos de generación por resultado",
+                                   resultado="timeout", modelo=model_name)
                     
                     if attempt < max_retries:
                         if self._rotate_key_silently():
-                            time.sleep(0.5)  # Pequeña pausa antes del siguiente intento
+                            self._esperar(0.5, plazo)  # Pequeña pausa antes del siguiente intento
                             continue  # Probar con la siguiente clave
                         else:
                             self.logger.error("No hay más claves disponibles después del timeout")
@@ -245,36 +345,61 @@ class GeminiAPIRotator:
                 
                 else:
                     # Generación exitosa
-                    self.logger.info(f"Contenido generado exitosamente con clave: {current_key.name}")
+                    self.logger.info("Contenido generado exitosamente con clave: %s", current_key.name)
+                    metrics.contar("krishnai_intentos_total", "Intentos de generación por resultado",
+                                   resultado="ok", modelo=model_name)
                     return response
                 
             except Exception as e:
                 error_str = str(e).lower()
+                self.telemetria.registrar(current_key.name, None, True)
                 
                 # Verificar si es un error 429 (rate limit)
                 if "429" in error_str or "quota" in error_str or "rate limit" in error_str:
-                    self.logger.warning(f"Error 429 con clave {current_key.name}. Intento {attempt + 1}/{max_retries + 1}")
+                    self.logger.warning("Error 429 con clave %s. Intento %d/%d", current_key.name, attempt + 1, max_retries + 1)
+                    metrics.contar("krishnai_intentos_total", "Intentos de generación por resultado",
+                                   resultado="429", modelo=model_name)
                     
                     if attempt < max_retries:
                         # Intentar rotar clave (bloqueando la actual)
                         if self.rotate_key():
-                            time.sleep(random.uniform(1, 3))  # Pausa antes del siguiente intento
+                            self._esperar(random.uniform(1, 3), plazo)  # Pausa antes del siguiente intento
                             continue
                         else:
                             self.logger.error("No se pudo rotar a otra clave API")
                             break
                     else:
-                        self.logger.error(f"Agotados todos los reintentos. Último error: {e}")
+                        self.logger.error("Agotados todos los reintentos. Último error: %s", e)
                         raise e
                 
                 else:
                     # Para otros errores, no rotar clave, solo propagar el error
-                    self.logger.error(f"Error no relacionado con límites: {e}")
+                    self.logger.error("Error no relacionado con límites: %s", e)
+                    metrics.contar("krishnai_intentos_total", "Intentos de generación por resultado",
+                                   resultado="error", modelo=model_name)
                     raise e
         
         # Si llegamos aquí, significa que agotamos todos los reintentos
         raise RuntimeError("Se agotaron todos los reintentos y claves API disponibles")
     
+    def preparar_clave(self) -> Optional[str]:
+        """
+        Adelanta fuera del camino crítico el desbloqueo de las claves que ya
+        cumplieron su bloqueo. No reserva ninguna: cada llamada vuelve a elegir
+        la suya. Retorna el nombre de la clave que se elegiría ahora o None si
+        todas están bloqueadas.
+        """
+        with self._lock_clave:
+            indice = self._get_next_available_key()
+        return None if indice is None else self.api_keys[indice].name
+
+    def segundos_hasta_clave(self) -> float:
+        """0 si hay alguna clave disponible; si no, segundos hasta que se desbloquee la primera"""
+        ahora = time.time()
+        if any(not key.is_blocked or key.block_until <= ahora for key in self.api_keys):
+            return 0.0
+        return min(key.block_until for key in self.api_keys) - ahora
+
     def get_current_key_info(self) -> APIKeyInfo:
         """Retorna información sobre la clave actual"""
         return self.api_keys[self.current_key_index]
@@ -287,6 +412,7 @@ class GeminiAPIRotator:
             "total_keys": len(self.api_keys),
             "blocked_keys": sum(1 for key in self.api_keys if key.is_blocked),
             "available_keys": sum(1 for key in self.api_keys if not key.is_blocked),
+            "selection": "power_of_two_choices",
             "keys_status": []
         }
         
@@ -295,15 +421,23 @@ class GeminiAPIRotator:
                 "name": key.name,
                 "is_blocked": key.is_blocked,
                 "failed_count": key.failed_count,
-                "minutes_until_unblock": max(0, int((key.block_until - current_time) / 60)) if key.is_blocked else 0
+                "minutes_until_unblock": max(0, int((key.block_until - current_time) / 60)) if key.is_blocked else 0,
+                **self.telemetria.resumen(key.name),
             }
             summary["keys_status"].append(key_status)
         
         return summary
 
-# Instancia global del rotador
-api_rotator = GeminiAPIRotator()
+# Instancia global del rotador (se crea en el primer uso para poder importar
+# el módulo fuera de Streamlit, p. ej. desde benchmarks/)
+api_rotator: Optional[GeminiAPIRotator] = None
+_api_rotator_lock = threading.Lock()
 
 def get_api_rotator() -> GeminiAPIRotator:
     """Retorna la instancia global del rotador de APIs"""
+    global api_rotator
+    if api_rotator is None:
+        with _api_rotator_lock:
+            if api_rotator is None:
+                api_rotator = GeminiAPIRotator()
     return api_rotator
@@ -0,0 +1,390 @@
+"""
+API HTTP de Krishna AI para la app móvil y otros clientes.
+
+Servidor asíncrono ligero (asyncio, sin dependencias) sobre KrishnaEngine:
+    GET    /salud                     estado del proceso y de las claves
+    POST   /v1/chat                   un turno; JSON o Server-Sent Events
+    DELETE /v1/sesiones/<id>          olvida una sesión
+    GET    /metrics                   métricas en formato Prometheus
+
+POST /v1/chat recibe {"pregunta", "sesion"?, "nombre"?, "genero"?,
+"temperatura"?, "historial"?}. Con "Accept: text/event-stream" (o ?stream=1)
+responde con eventos:
+    event: sesion     {"sesion": id}
+    event: fragmento  {"texto": delta}
+    event: fin        {"texto", "citas", "tramos", "sesion", "truncada"?, "degradada"?, "cola"?}
+    event: error      {"nivel", "mensaje"}
+y si no, con un único JSON igual que el evento "fin". El plazo del turno
+(KrishnaEngine.plazo_turno) empieza a contar al recibir la petición, así que
+incluye la espera en cola detrás de otros turnos.
+
+Sin claves disponibles la respuesta es degradada ("degradada": "cache" o
+"local") y el turno queda en la cola de reintentos del motor ("cola":
+posición). En streaming la conexión sigue abierta tras "fin":
+    event: cola       {"posicion"}                cada vez que avanza
+    event: reintento  {"texto", "citas", ...}     respuesta del modelo
+La respuesta del reintento sustituye a la degradada en la sesión, bajo el
+mismo lock que serializa sus turnos.
+
+Las sesiones viven en un AlmacenSesiones: LRU en memoria en cada réplica y,
+con --sesiones, un SQLite en disco donde se escribe cada turno; las réplicas
+que comparten el fichero recuperan las sesiones de las demás. Si ninguna
+conoce la sesión, se reconstruye con el "historial" que envía el cliente, así
+que varias réplicas detrás de un balanceador no necesitan afinidad. Todas
+comparten el corpus binario mapeado en memoria.
+
+Uso (desde la raíz del repositorio):
+    python servidor_api.py --puerto 8080
+    python servidor_api.py --sesiones sesiones_api.sqlite3
+    python servidor_api.py --falso            # con el Gemini falso de benchmarks/
+"""
+
+import argparse
+import asyncio
+import json
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import citas
+import metrics
+import tracing
+from almacen_sesiones import MENSAJES_RETENIDOS, AlmacenSesiones
+from krishna_engine import KrishnaEngine, Sesion, mensaje_error
+from plazo import Plazo
+
+MAX_CUERPO = 64 * 1024
+MAX_TURNOS_CONCURRENTES = 32
+MENSAJES_HISTORIAL = MENSAJES_RETENIDOS     # mensajes del historial del cliente que se aceptan al reconstruir
+# Streaming de un turno degradado: cada cuánto se informa de la posición en cola y espera máxima al reintento
+SONDEO_COLA_S = 2.0
+MAX_ESPERA_REINTENTO_S = 15 * 60
+
+_ESTADOS = {200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 502: "Bad Gateway", 503: "Service Unavailable"}
+
+
+class ErrorPeticion(Exception):
+    def __init__(self, estado: int, mensaje: str):
+        super().__init__(mensaje)
+        self.estado = estado
+
+
+def historial_de_cliente(historial, bhagavad_gita: dict | None = None) -> list[dict]:
+    """Normaliza el historial enviado por el cliente a mensajes del motor."""
+    mensajes = []
+    for mensaje in (historial or [])[-MENSAJES_HISTORIAL:]:
+        rol = mensaje.get("role")
+        contenido = mensaje.get("content")
+        if rol not in ("user", "assistant") or not isinstance(contenido, str):
+            raise ErrorPeticion(400, "historial: cada mensaje necesita role user/assistant y content")
+        entrada = {"role": rol, "content": contenido}
+        if rol == "assistant":
+            entrada["citas"] = citas.claves(citas.extraer_citas(contenido, bhagavad_gita))
+        mensajes.append(entrada)
+    return mensajes
+
+
+class ServidorKrishna:
+    def __init__(self, motor: KrishnaEngine, almacen: AlmacenSesiones | None = None,
+                 max_turnos: int = MAX_TURNOS_CONCURRENTES):
+        self.motor = motor
+        self.almacen = almacen or AlmacenSesiones()
+        self.max_turnos = max_turnos
+        self._pool = ThreadPoolExecutor(max_workers=max_turnos, thread_name_prefix="krishnai-turno")
+        self._locks_sesion = weakref.WeakValueDictionary()   # se liberan al acabar el último turno
+        self._turnos = None
+
+    # --- HTTP mínimo sobre asyncio -----------------------------------------
+
+    async def _leer_peticion(self, lector: asyncio.StreamReader):
+        linea = await lector.readline()
+        if not linea:
+            return None
+        try:
+            metodo, objetivo, _ = linea.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise ErrorPeticion(400, "línea de petición inválida")
+        cabeceras = {}
+        while True:
+            linea = await lector.readline()
+            if linea in (b"\r\n", b"\n", b""):
+                break
+            nombre, _, valor = linea.decode("latin-1").partition(":")
+            cabeceras[nombre.strip().lower()] = valor.strip()
+        longitud = int(cabeceras.get("content-length", "0") or 0)
+        if longitud > MAX_CUERPO:
+            raise ErrorPeticion(413, "cuerpo demasiado grande")
+        cuerpo = await lector.readexactly(longitud) if longitud else b""
+        return metodo.upper(), objetivo, cabeceras, cuerpo
+
+    @staticmethod
+    async def _responder(escritor: asyncio.StreamWriter, estado: int, cuerpo: bytes,
+                         tipo: str = "application/json; charset=utf-8"):
+        escritor.write(
+            f"HTTP/1.1 {estado} {_ESTADOS.get(estado, '')}\r\n"
+            f"Content-Type: {tipo}\r\n"
+            f"Content-Length: {len(cuerpo)}\r\n"
+            "Access-Control-Allow-Origin: *\r\n"
+            "Access-Control-Allow-Headers: Content-Type, Accept\r\n"
+            "Access-Control-Allow-Methods: GET, POST, DELETE, OPTIONS\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + cuerpo
+        )
+        await escritor.drain()
+
+    async def _json(self, escritor, estado: int, datos: dict):
+        await self._responder(escritor, estado, json.dumps(datos, ensure_ascii=False).encode("utf-8"))
+
+    async def manejar(self, lector: asyncio.StreamReader, escritor: asyncio.StreamWriter):
+        try:
+            peticion = await self._leer_peticion(lector)
+            if peticion is not None:
+                await self._despachar(escritor, *peticion)
+        except ErrorPeticion as e:
+            await self._json(escritor, e.estado, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            escritor.close()
+
+    async def _despachar(self, escritor, metodo: str, objetivo: str, cabeceras: dict, cuerpo: bytes):
+        url = urlsplit(objetivo)
+        ruta = url.path.rstrip("/") or "/"
+        metrics.contar("krishnai_api_peticiones_total", "Peticiones a la API HTTP", metodo=metodo,
+                       ruta=ruta if not ruta.startswith("/v1/sesiones/") else "/v1/sesiones/<id>")
+        if metodo == "OPTIONS":
+            await self._responder(escritor, 204, b"")
+        elif ruta == "/salud" and metodo == "GET":
+            resumen = self.motor.api_rotator.get_status_summary()
+            await self._json(escritor, 200, {
+                "estado": "ok", "sesiones": len(self.almacen),
+                "claves_disponibles": resumen["available_keys"], "claves_totales": resumen["total_keys"],
+            })
+        elif ruta == "/metrics" and metodo == "GET":
+            metrics.actualizar_desde_rotador(self.motor.api_rotator)
+            await self._responder(escritor, 200, metrics.REGISTRO.exportar_prometheus().encode("utf-8"),
+                                  "text/plain; version=0.0.4; charset=utf-8")
+        elif ruta == "/v1/chat":
+            if metodo != "POST":
+                raise ErrorPeticion(405, "usa POST")
+            stream = ("text/event-stream" in cabeceras.get("accept", "")
+                      or parse_qs(url.query).get("stream", ["0"])[0] in ("1", "true"))
+            await self._chat(escritor, self._leer_json(cuerpo), stream)
+        elif ruta.startswith("/v1/sesiones/") and metodo == "DELETE":
+            eliminada = self.almacen.eliminar(ruta.rsplit("/", 1)[1])
+            await self._json(escritor, 200 if eliminada else 404, {"eliminada": eliminada})
+        else:
+            raise ErrorPeticion(404, f"ruta desconocida {ruta}")
+
+    @staticmethod
+    def _leer_json(cuerpo: bytes) -> dict:
+        try:
+            datos = json.loads(cuerpo or b"{}")
+        except json.JSONDecodeError:
+            raise ErrorPeticion(400, "el cuerpo no es JSON válido")
+        if not isinstance(datos, dict):
+            raise ErrorPeticion(400, "el cuerpo debe ser un objeto JSON")
+        return datos
+
+    # --- Turnos ------------------------------------------------------------
+
+    def _sesion_de(self, datos: dict) -> tuple[str, Sesion]:
+        pregunta = datos.get("pregunta")
+        if not isinstance(pregunta, str) or not pregunta.strip():
+            raise ErrorPeticion(400, "falta la pregunta")
+        sesion_id, sesion = self.almacen.obtener(datos.get("sesion"))
+        if sesion is None:
+            sesion = Sesion(mensajes=historial_de_cliente(datos.get("historial"), self.motor.bhagavad_gita))
+            metrics.contar("krishnai_api_sesiones_creadas_total", "Sesiones creadas o reconstruidas en esta réplica",
+                           reconstruida=str(bool(sesion.mensajes)).lower())
+        nombre = str(datos.get("nombre") or "")[:60]
+        if nombre and nombre != sesion.nombre_usuario:
+            sesion.nombre_usuario = nombre
+            sesion.genero_usuario = None    # se resuelve con el nombre nuevo
+        if datos.get("genero") in ("Masculino", "Femenino"):
+            sesion.genero_usuario = datos["genero"]
+        if isinstance(datos.get("temperatura"), (int, float)):
+            sesion.temperatura = min(max(float(datos["temperatura"]), 0.0), 0.8)
+        return sesion_id, sesion
+
+    async def _turno(self, sesion_id: str, sesion: Sesion, pregunta: str, plazo: Plazo, al_fragmento=None):
+        """Ejecuta respond() en el pool de hilos; los turnos de una misma sesión se serializan."""
+        if self._turnos is None:
+            self._turnos = asyncio.Semaphore(self.max_turnos)
+        loop = asyncio.get_running_loop()
+        async with self._turnos, self._lock_sesion(sesion_id):
+            try:
+                respuesta = await loop.run_in_executor(
+                    self._pool, lambda: self.motor.respond(sesion, pregunta, al_fragmento=al_fragmento, plazo=plazo))
+            finally:
+                self.almacen.guardar(sesion_id, sesion)
+        if respuesta.reintento is not None:
+            # La respuesta del reintento sustituye a la degradada bajo el lock de la sesión, no en el hilo de la cola
+            respuesta.reintento.futuro.add_done_callback(
+                lambda _: asyncio.run_coroutine_threadsafe(self._aplicar_reintentos(sesion_id, sesion), loop))
+        return respuesta
+
+    def _lock_sesion(self, sesion_id: str) -> asyncio.Lock:
+        lock = self._locks_sesion.get(sesion_id)
+        if lock is None:
+            lock = self._locks_sesion[sesion_id] = asyncio.Lock()
+        return lock
+
+    async def _aplicar_reintentos(self, sesion_id: str, sesion: Sesion):
+        """Sustituye en la sesión las respuestas de reintentos terminados y la vuelve a guardar."""
+        async with self._lock_sesion(sesion_id):
+            if self.motor.aplicar_reintentos(sesion):
+                self.almacen.guardar(sesion_id, sesion)
+
+    def _fin(self, sesion_id: str, respuesta) -> dict:
+        fin = {"sesion": sesion_id, "texto": respuesta.texto, "citas": citas.claves(respuesta.citas),
+               "tramos": respuesta.analisis.tramos}
+        if respuesta.truncada:
+            fin["truncada"] = True
+        if respuesta.degradacion is not None:
+            fin["degradada"] = respuesta.degradacion
+            if respuesta.reintento is not None:
+                fin["cola"] = self.motor.reintentos.posicion(respuesta.reintento)
+        return fin
+
+    async def _chat(self, escritor, datos: dict, stream: bool):
+        plazo = Plazo(self.motor.plazo_turno)
+        sesion_id, sesion = self._sesion_de(datos)
+        pregunta = datos["pregunta"].strip()
+        if not stream:
+            try:
+                respuesta = await self._turno(sesion_id, sesion, pregunta, plazo)
+            except Exception as e:
+                nivel, mensaje = mensaje_error(e)
+                await self._json(escritor, 503 if nivel == "warning" else 502,
+                                 {"sesion": sesion_id, "nivel": nivel, "mensaje": mensaje})
+                return
+            await self._json(escritor, 200, self._fin(sesion_id, respuesta))
+            return
+
+        escritor.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream; charset=utf-8\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Access-Control-Allow-Origin: *\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+
+        def evento(nombre: str, datos_evento: dict):
+            escritor.write(f"event: {nombre}\ndata: {json.dumps(datos_evento, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        evento("sesion", {"sesion": sesion_id})
+        await escritor.drain()
+
+        # Los fragmentos llegan en el hilo del turno; se pasan al bucle de eventos por una cola
+        loop = asyncio.get_running_loop()
+        cola = asyncio.Queue()
+        enviados = 0
+
+        def al_fragmento(texto: str):
+            loop.call_soon_threadsafe(cola.put_nowait, texto)
+
+        tarea = asyncio.ensure_future(self._turno(sesion_id, sesion, pregunta, plazo, al_fragmento))
+        tarea.add_done_callback(lambda _: loop.call_soon_threadsafe(cola.put_nowait, None))
+        while (texto := await cola.get()) is not None:
+            # Tras una reemisión el texto acumulado vuelve a empezar
+            if len(texto) < enviados:
+                evento("reinicio", {})
+                enviados = 0
+            evento("fragmento", {"texto": texto[enviados:]})
+            enviados = len(texto)
+            await escritor.drain()
+
+        try:
+            respuesta = tarea.result()
+            evento("fin", self._fin(sesion_id, respuesta))
+        except Exception as e:
+            nivel, mensaje = mensaje_error(e)
+            tracing.aviso("Turno de la API fallido", sesion=sesion_id, error=e)
+            evento("error", {"nivel": nivel, "mensaje": mensaje})
+            respuesta = None
+        await escritor.drain()
+        if respuesta is not None and respuesta.reintento is not None:
+            await self._esperar_reintento(escritor, evento, sesion_id, respuesta.reintento)
+
+    async def _esperar_reintento(self, escritor, evento, sesion_id: str, turno):
+        """Informa de la posición en la cola y envía la respuesta del modelo cuando llega."""
+        futuro = asyncio.wrap_future(turno.futuro)
+        posicion = self.motor.reintentos.posicion(turno)
+        loop = asyncio.get_running_loop()
+        limite = loop.time() + MAX_ESPERA_REINTENTO_S
+        while not futuro.done() and loop.time() < limite:
+            await asyncio.wait([futuro], timeout=SONDEO_COLA_S)
+            nueva = self.motor.reintentos.posicion(turno)
+            if nueva is not None and nueva != posicion:
+                posicion = nueva
+                evento("cola", {"posicion": posicion})
+                await escritor.drain()
+        if not futuro.done():
+            return
+        try:
+            respuesta = futuro.result()
+            if respuesta is None:   # el turno ya no está en la sesión
+                return
+            evento("reintento", self._fin(sesion_id, respuesta))
+        except Exception as e:
+            nivel, mensaje = mensaje_error(e)
+            evento("error", {"nivel": nivel, "mensaje": mensaje})
+        await escritor.drain()
+
+    async def servir(self, host: str = "0.0.0.0", puerto: int = 8080) -> asyncio.AbstractServer:
+        servidor = await asyncio.start_server(self.manejar, host, puerto)
+        tracing.info("API de Krishna AI escuchando", direccion=servidor.sockets[0].getsockname())
+        return servidor
+
+
+def arrancar_en_hilo(servidor: ServidorKrishna, host: str = "127.0.0.1", puerto: int = 0) -> int:
+    """Arranca el servidor en un bucle de eventos en un hilo daemon (tests y benchmarks). Devuelve el puerto."""
+    listo = threading.Event()
+    resultado = {}
+
+    def ejecutar():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        servidor_asyncio = loop.run_until_complete(servidor.servir(host, puerto))
+        resultado["puerto"] = servidor_asyncio.sockets[0].getsockname()[1]
+        listo.set()
+        loop.run_forever()
+
+    threading.Thread(target=ejecutar, name="krishnai-api", daemon=True).start()
+    listo.wait()
+    return resultado["puerto"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="API HTTP/SSE de Krishna AI")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--puerto", type=int, default=8080)
+    parser.add_argument("--turnos", type=int, default=MAX_TURNOS_CONCURRENTES, help="turnos concurrentes máximos")
+    parser.add_argument("--sesiones", default=None, metavar="PATH",
+                        help="SQLite para el nivel frío de sesiones (compartible entre réplicas)")
+    parser.add_argument("--falso", action="store_true", help="usar el Gemini falso de benchmarks/ (sin red ni claves)")
+    args = parser.parse_args(argv)
+
+    rotador = None
+    if args.falso:
+        from benchmarks.e2e import crear_rotador
+        from benchmarks.fake_gemini import ConfigFalsa, GeminiFalso
+        rotador = crear_rotador(GeminiFalso(ConfigFalsa(latencia_media=0.2)), 3)
+    servidor = ServidorKrishna(KrishnaEngine(api_rotator=rotador), AlmacenSesiones(path=args.sesiones),
+                               max_turnos=args.turnos)
+
+    async def ejecutar():
+        servidor_asyncio = await servidor.servir(args.host, args.puerto)
+        async with servidor_asyncio:
+            await servidor_asyncio.serve_forever()
+
+    try:
+        asyncio.run(ejecutar())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
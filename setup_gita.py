@@ -12,6 +12,7 @@ def setup_bhagavad_gita():
     
     # Verificar si ya existe el archivo JSON
     json_files = [
+        "corpus_gita.json",
         "bhagavad_gita_txt_corregido.json",
         "bhagavad_gita_txt.json", 
         "bhagavad_gita.json"
@@ -22,13 +23,14 @@ def setup_bhagavad_gita():
             print(f"✅ Archivo del Gita encontrado: {json_file}")
             return True
     
-    # Si no existe ningún JSON, intentar procesar el TXT
+    # Si no existe ningún JSON, construir el corpus desde las fuentes del manifiesto
     if os.path.exists("Bhagavad-Gita-Anonimo.txt"):
         print("📖 Procesando Bhagavad-Gita-Anonimo.txt...")
         try:
-            # Importar y ejecutar el procesador
-            from procesado_bhagavad_gita_txt_corregido import main
-            main()
+            # Importar y ejecutar el pipeline de construcción del corpus
+            from construir_corpus import main
+            if main() != 0:
+                return False
             print("✅ Bhagavad Gita procesado correctamente")
             return True
         except Exception as e:
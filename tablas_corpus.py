@@ -0,0 +1,95 @@
+"""
+Tablas derivadas del corpus, precalculadas al construirlo.
+
+construir_corpus.py (y el procesador del TXT) anotan cada verso con su
+'texto_completo' y 'es_krishna', y guardan junto a cada traducción una tabla
+'tablas' con los números romanos, el número de versos de Krishna por capítulo
+y la cita formateada de cada verso. En tiempo de ejecución son búsquedas
+directas; las funciones de este módulo solo formatean como respaldo para los
+JSON antiguos que no traen las tablas.
+"""
+
+LOCUTOR_KRISHNA = "El Bienaventurado Señor"
+
+NUMEROS_ROMANOS = ('', 'I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X',
+                   'XI', 'XII', 'XIII', 'XIV', 'XV', 'XVI', 'XVII', 'XVIII')
+ROMANO_A_ARABIGO = {romano: i for i, romano in enumerate(NUMEROS_ROMANOS) if romano}
+
+
+def romano(capitulo) -> str:
+    cap = int(capitulo)
+    return NUMEROS_ROMANOS[cap] if cap < len(NUMEROS_ROMANOS) else str(capitulo)
+
+
+def formatear_texto_completo(capitulo, verso, datos: dict) -> str:
+    """'Capítulo C, Verso V (locutor): texto SIGNIFICADO: significado'."""
+    texto_completo = f"Capítulo {capitulo}, Verso {verso}"
+    locutor = datos.get('locutor', '')
+    if locutor:
+        texto_completo += f" ({locutor})"
+    if datos.get('texto'):
+        texto_completo += f": {datos['texto']}"
+    if datos.get('significado'):
+        texto_completo += f" SIGNIFICADO: {datos['significado']}"
+    return texto_completo
+
+
+def formatear_cita(capitulo, verso) -> str:
+    return f"[C. {romano(capitulo)} - {verso}]"
+
+
+def anotar_capitulos(capitulos: dict) -> dict:
+    """Anota los versos en el sitio y devuelve las tablas de la traducción."""
+    versos_krishna = {}
+    citas = {}
+    for cap, datos_cap in capitulos.items():
+        n_krishna = 0
+        for verso, datos in datos_cap['versos'].items():
+            datos['es_krishna'] = LOCUTOR_KRISHNA in datos.get('locutor', '')
+            datos['texto_completo'] = formatear_texto_completo(cap, verso, datos)
+            citas[f"{cap}:{verso}"] = formatear_cita(cap, verso)
+            n_krishna += datos['es_krishna']
+        versos_krishna[cap] = n_krishna
+    return {
+        "romanos": list(NUMEROS_ROMANOS),
+        "romano_a_arabigo": dict(ROMANO_A_ARABIGO),
+        "versos_krishna": versos_krishna,
+        "citas": citas,
+    }
+
+
+def tablas(bhagavad_gita: dict) -> dict:
+    """Tablas precalculadas del corpus cargado (vacías en los JSON antiguos)."""
+    return bhagavad_gita.get('tablas') or {}
+
+
+def texto_completo(capitulo, verso, datos: dict) -> str:
+    return datos.get('texto_completo') or formatear_texto_completo(capitulo, verso, datos)
+
+
+def es_krishna(datos: dict) -> bool:
+    valor = datos.get('es_krishna')
+    return LOCUTOR_KRISHNA in datos.get('locutor', '') if valor is None else valor
+
+
+def cita(bhagavad_gita: dict, verso_key: str) -> str:
+    """Cita '[C. XII - 45]' de una clave 'capítulo:verso'."""
+    precalculada = tablas(bhagavad_gita).get('citas', {}).get(verso_key)
+    if precalculada:
+        return precalculada
+    cap, ver = verso_key.split(':')
+    return formatear_cita(cap, ver)
+
+
+def capitulo_arabigo(bhagavad_gita: dict, capitulo_romano: str):
+    return tablas(bhagavad_gita).get('romano_a_arabigo', ROMANO_A_ARABIGO).get(capitulo_romano.upper())
+
+
+def versos_krishna_por_capitulo(bhagavad_gita: dict) -> dict:
+    conteo = tablas(bhagavad_gita).get('versos_krishna')
+    if conteo is not None:
+        return conteo
+    return {
+        cap: sum(1 for v in datos['versos'].values() if es_krishna(v))
+        for cap, datos in bhagavad_gita['capitulos'].items()
+    }
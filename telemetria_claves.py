@@ -0,0 +1,94 @@
+"""
+Telemetría por clave API y selección ponderada de claves.
+
+Cada clave acumula una latencia y una tasa de error con media móvil
+exponencial (EWMA), de modo que pesan más las últimas llamadas. El coste de
+una clave es el tiempo esperado hasta una respuesta correcta,
+latencia / (1 - tasa_error): una clave lenta o cerca de su cuota (429
+frecuentes) sale cara. Una clave que solo ha fallado (sin ninguna latencia
+medida) usa como latencia la media de las demás, para que su tasa de error
+cuente igual.
+
+elegir() aplica "power of two choices": toma dos claves al azar y se queda
+con la de menor coste. Reparte la carga casi como elegir siempre la mejor,
+pero sin que todas las réplicas y turnos se amontonen en la misma clave, y
+las claves sin observaciones (coste 0) se exploran enseguida. Una pequeña
+fracción de elecciones (EXPLORACION) es uniforme, para que la peor clave,
+que perdería todos los duelos, se vuelva a medir si se recupera.
+"""
+
+import random
+import threading
+from dataclasses import dataclass
+
+# Peso de la última observación en las medias móviles
+ALFA = 0.2
+# Tope de la tasa de error en el coste (evita dividir por cero)
+MAX_TASA_ERROR = 0.95
+# Fracción de elecciones al azar, sin mirar el coste
+EXPLORACION = 0.02
+# Latencia supuesta de una clave que solo ha fallado si ninguna otra tiene latencia medida
+LATENCIA_PREVIA_S = 1.0
+
+
+@dataclass
+class EstadisticasClave:
+    latencia: float | None = None       # EWMA en segundos de las llamadas que respondieron
+    tasa_error: float = 0.0             # EWMA de 0 (correcta) / 1 (429, timeout u otro error)
+    llamadas: int = 0
+    errores: int = 0
+
+    def coste(self, latencia_previa: float = LATENCIA_PREVIA_S) -> float:
+        """0 sin llamadas (se explora); latencia_previa si todas sus llamadas fallaron sin respuesta."""
+        if self.llamadas == 0:
+            return 0.0
+        latencia = self.latencia if self.latencia is not None else latencia_previa
+        return latencia / (1.0 - min(self.tasa_error, MAX_TASA_ERROR))
+
+
+class TelemetriaClaves:
+    def __init__(self, alfa: float = ALFA, rng: random.Random | None = None, exploracion: float = EXPLORACION):
+        self.alfa = alfa
+        self.exploracion = exploracion
+        self.rng = rng or random.Random()
+        self._estadisticas: dict[str, EstadisticasClave] = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, nombre: str, latencia: float | None, error: bool):
+        """Una llamada con la clave; latencia None si no hubo respuesta que medir."""
+        with self._lock:
+            e = self._estadisticas.setdefault(nombre, EstadisticasClave())
+            e.llamadas += 1
+            e.errores += int(error)
+            e.tasa_error += self.alfa * (float(error) - e.tasa_error)
+            if latencia is not None:
+                e.latencia = latencia if e.latencia is None else e.latencia + self.alfa * (latencia - e.latencia)
+
+    def _latencia_previa(self) -> float:
+        """Media de las latencias medidas; LATENCIA_PREVIA_S si no hay ninguna."""
+        latencias = [e.latencia for e in self._estadisticas.values() if e.latencia is not None]
+        return sum(latencias) / len(latencias) if latencias else LATENCIA_PREVIA_S
+
+    def coste(self, nombre: str) -> float:
+        with self._lock:
+            return self._estadisticas.get(nombre, EstadisticasClave()).coste(self._latencia_previa())
+
+    def elegir(self, nombres: list[str]) -> str:
+        """Power of two choices sobre los nombres dados (no vacío)."""
+        if len(nombres) == 1:
+            return nombres[0]
+        if self.rng.random() < self.exploracion:
+            return self.rng.choice(nombres)
+        a, b = self.rng.sample(nombres, 2)
+        return a if self.coste(a) <= self.coste(b) else b
+
+    def resumen(self, nombre: str) -> dict:
+        with self._lock:
+            e = self._estadisticas.get(nombre, EstadisticasClave())
+            return {
+                "latency_ewma_ms": round(e.latencia * 1000, 1) if e.latencia is not None else None,
+                "error_rate": round(e.tasa_error, 3),
+                "calls": e.llamadas,
+                "errors": e.errores,
+                "cost": round(e.coste(self._latencia_previa()), 3),
+            }
@@ -67,6 +67,71 @@ class TestObtenerTratamientoGenero:
         assert res["querido"] == "querido"
 
 
+class TestResolvedorGenero:
+    def test_lexico_y_sufijos(self, tmp_path):
+        from gender_detector import ResolvedorGenero
+        resolvedor = ResolvedorGenero(path_cache=str(tmp_path / "genero.json"))
+        assert resolvedor.resolver("Mikel") == ("Masculino", "lexico")
+        assert resolvedor.resolver("  amaia  ") == ("Femenino", "lexico")
+        assert resolvedor.resolver("Begoña") == ("Femenino", "lexico")
+        assert resolvedor.resolver("María José") == ("Femenino", "lexico")
+        assert resolvedor.resolver("Xiomara") == ("Femenino", "sufijo")
+        assert resolvedor.resolver("Gumersindo") == ("Masculino", "sufijo")
+
+    def test_masculinos_terminados_en_a(self):
+        from gender_detector import ResolvedorGenero
+        resolvedor = ResolvedorGenero(path_cache=None)
+        # Nombres vascos, italianos y sánscritos que la regla de -a marcaría como femeninos
+        for nombre in ("Kepa", "Gorka", "Aritza", "Txema", "Luca", "Nicola", "Mattia", "Elia", "Borja", "Arjuna"):
+            assert resolvedor.resolver(nombre) == ("Masculino", "lexico"), nombre
+        assert len(resolvedor.femeninos) + len(resolvedor.masculinos) > 3000
+
+    def test_llm_en_segundo_plano_y_cache_persistente(self, tmp_path):
+        import threading
+        from benchmarks.fake_gemini import RespuestaFalsa
+        from gender_detector import ResolvedorGenero
+        liberar = threading.Event()
+        llamadas = []
+
+        class RotadorLento:
+            def generate_content_with_retry(self, **kwargs):
+                llamadas.append(kwargs["prompt"])
+                liberar.wait(5)
+                return RespuestaFalsa(["FEMENINO"])
+
+        path_cache = str(tmp_path / "genero.json")
+        resolvedor = ResolvedorGenero(path_cache=path_cache)
+        # No espera al LLM: devuelve la estimación y lanza una sola consulta
+        assert resolvedor.resolver("Yuki", RotadorLento()) == ("Masculino", "defecto")
+        assert resolvedor.resolver("yuki", RotadorLento())[1] == "defecto"
+        liberar.set()
+        resolvedor._pool.shutdown(wait=True)
+        assert len(llamadas) == 1
+        assert resolvedor.resolver("Yuki") == ("Femenino", "cache")
+        assert ResolvedorGenero(path_cache=path_cache).resolver("Yuki") == ("Femenino", "cache")
+
+    def test_debounce_por_canal(self, tmp_path):
+        import time
+        from benchmarks.fake_gemini import RespuestaFalsa
+        from gender_detector import ResolvedorGenero
+        llamadas = []
+
+        class Rotador:
+            def generate_content_with_retry(self, **kwargs):
+                llamadas.append(kwargs["prompt"])
+                return RespuestaFalsa(["FEMENINO"])
+
+        resolvedor = ResolvedorGenero(path_cache=str(tmp_path / "genero.json"), retardo_llm=0.05)
+        # Nombre escrito letra a letra en la misma sesión: solo se consulta el último
+        for parcial in ("Xy", "Xyl", "Xylk", "Xylkan"):
+            resolvedor.resolver(parcial, Rotador(), canal="sesion-1")
+        assert llamadas == []
+        time.sleep(0.3)
+        resolvedor._pool.shutdown(wait=True)
+        assert len(llamadas) == 1 and '"Xylkan"' in llamadas[0]
+        assert resolvedor.resolver("Xylkan") == ("Femenino", "cache")
+
+
 class TestPromptBuilder:
     def test_extraer_versos_citados_romanos(self):
         from prompt_builder import extraer_versos_citados_del_historial
@@ -175,6 +240,144 @@ class TestRotacionClaves:
         assert next_idx == 1
 
 
+class TestTelemetriaClaves:
+    def test_ewma_y_coste(self):
+        from telemetria_claves import TelemetriaClaves
+        telemetria = TelemetriaClaves(alfa=0.5)
+        telemetria.registrar("a", 1.0, False)
+        telemetria.registrar("a", 2.0, False)
+        telemetria.registrar("a", None, True)
+        resumen = telemetria.resumen("a")
+        assert resumen["latency_ewma_ms"] == 1500.0 and resumen["error_rate"] == 0.5
+        assert resumen["calls"] == 3 and resumen["errors"] == 1
+        assert telemetria.coste("a") == 3.0
+        # Sin observaciones el coste es 0: las claves nuevas se exploran primero
+        assert telemetria.coste("nueva") == 0.0
+
+    def test_el_trafico_se_desplaza_a_las_claves_sanas(self):
+        import random
+        from collections import Counter
+        from telemetria_claves import TelemetriaClaves
+        telemetria = TelemetriaClaves(rng=random.Random(7))
+        latencias = {"rapida": 0.3, "lenta": 2.0, "cuota": 0.3, "normal": 0.8}
+        for nombre, latencia in latencias.items():
+            telemetria.registrar(nombre, latencia, False)
+        for _ in range(5):
+            telemetria.registrar("cuota", None, True)
+        elecciones = Counter(telemetria.elegir(list(latencias)) for _ in range(2000))
+        assert elecciones["rapida"] > elecciones["normal"] > elecciones["lenta"]
+        assert elecciones["cuota"] < elecciones["normal"]
+        # La clave más cara pierde todos los duelos; solo la elige la exploración
+        assert 0 < elecciones["lenta"] < 2000 * 0.02
+
+    def test_clave_que_solo_falla_no_sale_gratis(self):
+        from telemetria_claves import LATENCIA_PREVIA_S, TelemetriaClaves
+        telemetria = TelemetriaClaves(alfa=0.5)
+        telemetria.registrar("invalida", None, True)
+        # Sin otras latencias se usa la previa fija; con ellas, su media
+        assert telemetria.coste("invalida") == LATENCIA_PREVIA_S / 0.5
+        telemetria.registrar("sana", 0.4, False)
+        assert telemetria.coste("invalida") == 0.4 / 0.5 > telemetria.coste("sana")
+
+
+class TestRotadorClaves:
+    """GeminiAPIRotator real con google.generativeai y streamlit sustituidos en sys.modules."""
+
+    @staticmethod
+    def rotador(monkeypatch, nombres, generador):
+        import sys
+        import types
+        configuradas = []
+        genai = types.ModuleType("google.generativeai")
+        genai.configure = lambda api_key: configuradas.append(api_key)
+        google = types.ModuleType("google")
+        google.generativeai = genai
+        monkeypatch.setitem(sys.modules, "google", google)
+        monkeypatch.setitem(sys.modules, "google.generativeai", genai)
+        monkeypatch.setitem(sys.modules, "streamlit", types.ModuleType("streamlit"))
+        monkeypatch.delitem(sys.modules, "rotacion_claves", raising=False)
+        import rotacion_claves
+        monkeypatch.delitem(sys.modules, "rotacion_claves")
+
+        def generar(model_name, prompt, generation_config, stream=False):
+            return generador(configuradas[-1], prompt)
+
+        claves = [rotacion_claves.APIKeyInfo(nombre, nombre) for nombre in nombres]
+        return rotacion_claves.GeminiAPIRotator(claves, generador=generar, coalescer=False)
+
+    def test_clave_invalida_pierde_los_duelos(self, monkeypatch):
+        import random
+        from benchmarks.fake_gemini import RespuestaFalsa
+
+        def generador(clave, prompt):
+            if clave == "invalida":
+                raise ValueError("400 API key not valid. Please pass a valid API key.")
+            return RespuestaFalsa(["ok"])
+
+        rotador = self.rotador(monkeypatch, ["invalida", "sana"], generador)
+        rotador.telemetria.rng = random.Random(3)
+        fallos = 0
+        for _ in range(200):
+            try:
+                rotador.generate_content_with_retry("modelo", "p", {}, max_retries=0)
+            except ValueError:
+                fallos += 1
+        # Tras fallar, la clave inválida solo vuelve por la exploración
+        assert fallos < 200 * 0.05
+        assert rotador.telemetria.coste("invalida") > rotador.telemetria.coste("sana")
+        assert rotador.api_keys[rotador._get_next_available_key()].name == "sana"
+
+    def test_timeout_con_fracciones_de_segundo(self, monkeypatch):
+        import time
+
+        def generador(clave, prompt):
+            time.sleep(1.5)
+
+        rotador = self.rotador(monkeypatch, ["lenta"], generador)
+        inicio = time.monotonic()
+        # Un timeout recortado por el plazo no se redondea a segundos enteros
+        assert rotador._try_generate_with_signal_timeout("modelo", "p", {}, 0.2) == (None, True)
+        assert time.monotonic() - inicio < 0.9
+
+    def test_preparar_clave_no_reserva_la_siguiente_llamada(self, monkeypatch):
+        from benchmarks.fake_gemini import RespuestaFalsa
+        rotador = self.rotador(monkeypatch, ["a", "b"], lambda clave, prompt: RespuestaFalsa([clave]))
+        rotador.current_key_index = 0
+        rotador._configure_current_key()
+        monkeypatch.setattr(rotador.telemetria, "elegir", lambda nombres: nombres[-1])
+        # La preparación no cambia la clave configurada ni la deja marcada para otra sesión
+        assert rotador.preparar_clave() == "b" and rotador.current_key_index == 0
+        monkeypatch.setattr(rotador.telemetria, "elegir", lambda nombres: nombres[0])
+        assert rotador.generate_content_with_retry("modelo", "p", {}).text == "a"
+
+    def test_429_bloquea_y_rota_y_sin_claves_falla_enseguida(self, monkeypatch):
+        import pytest
+        from benchmarks.fake_gemini import RespuestaFalsa
+        llamadas = []
+
+        def generador(clave, prompt):
+            llamadas.append(clave)
+            if clave == "agotada":
+                raise RuntimeError("429 Resource has been exhausted (quota)")
+            return RespuestaFalsa(["ok"])
+
+        rotador = self.rotador(monkeypatch, ["agotada", "sana"], generador)
+        monkeypatch.setattr(rotador, "_esperar", lambda segundos, plazo=None: None)
+        # Cada llamada elige su clave: la agotada sale primero mientras no esté bloqueada
+        monkeypatch.setattr(rotador.telemetria, "elegir", lambda nombres: nombres[0])
+        assert rotador.generate_content_with_retry("modelo", "p", {}, max_retries=1).text == "ok"
+        assert llamadas == ["agotada", "sana"]
+        assert rotador.api_keys[0].is_blocked and rotador.segundos_hasta_clave() == 0.0
+        # La clave bloqueada ya no se elige
+        assert all(rotador._get_next_available_key() == 1 for _ in range(20))
+        rotador.api_keys[1].is_blocked = True
+        rotador.api_keys[1].block_until = rotador.api_keys[0].block_until
+        assert rotador.segundos_hasta_clave() > 0
+        with pytest.raises(RuntimeError, match="todas bloqueadas"):
+            rotador.generate_content_with_retry("modelo", "p", {})
+        assert len(llamadas) == 2
+
+
 class TestPromptBuilderModule:
     def test_construir_prompt_krishna_basico(self):
         from prompt_builder import construir_prompt_krishna
@@ -233,3 +436,1039 @@ class TestRAG:
         result = rag._fallback_versos(set())
         assert len(result) == 1
         assert result[0]['capitulo'] == 2
+
+
+class TestTracing:
+    def test_no_formatea_con_modo_detallado_desactivado(self):
+        import tracing
+        tracing.configurar(verbose=False)
+        llamadas = []
+
+        def costoso():
+            llamadas.append(1)
+            return "x"
+
+        tracing.depurar("mensaje %s", costoso, campo=costoso)
+        assert llamadas == []
+        assert not tracing.activo()
+
+    def test_emite_en_modo_detallado(self, caplog):
+        import logging
+        import tracing
+        tracing.configurar(verbose=True)
+        try:
+            with caplog.at_level(logging.DEBUG, logger="krishnai"):
+                with tracing.span("turno"):
+                    with tracing.span("recuperacion") as s:
+                        s.set(versos=lambda: 3)
+                        tracing.depurar("evento %s", lambda: "diferido", verso="2:47")
+            mensajes = [r.getMessage() for r in caplog.records]
+            assert any("evento diferido" in m and "turno/recuperacion" in m for m in mensajes)
+            assert any(m.startswith("span turno/recuperacion") and "versos=3" in m for m in mensajes)
+        finally:
+            tracing.configurar(verbose=False)
+
+    def test_span_mide_duracion(self):
+        import tracing
+        with tracing.span("etapa") as s:
+            pass
+        assert s.duracion >= 0.0
+        assert s.ruta == "etapa"
+
+
+class TestMetrics:
+    def test_span_alimenta_histograma(self):
+        import metrics
+        import tracing
+        with tracing.span("etapa_test_metricas"):
+            pass
+        filas = {f["etapa"]: f for f in metrics.REGISTRO.resumen_etapas()}
+        assert filas["etapa_test_metricas"]["n"] >= 1
+
+    def test_cuantiles(self):
+        from metrics import Histograma
+        h = Histograma()
+        for i in range(1, 101):
+            h.observe(i)
+        q = h.cuantiles()
+        assert q[0.5] in (50, 51)
+        assert q[0.99] >= 98
+        assert h.cuenta == 100
+
+    def test_observar_y_exportar_a_la_vez(self):
+        import sys
+        import threading
+        from metrics import RegistroMetricas
+        registro = RegistroMetricas()
+        errores = []
+
+        def observar():
+            for i in range(20_000):
+                registro.histograma("h_concurrente").observe(i)
+                registro.contador("c_concurrente").inc()
+
+        def exportar():
+            try:
+                while any(h.is_alive() for h in hilos):
+                    registro.exportar_prometheus()
+            except RuntimeError as e:   # "deque mutated during iteration"
+                errores.append(e)
+
+        hilos = [threading.Thread(target=observar) for _ in range(4)]
+        lector = threading.Thread(target=exportar)
+        # Cambios de hilo muy frecuentes para que las carreras aparezcan
+        intervalo = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for hilo in hilos:
+                hilo.start()
+            lector.start()
+            for hilo in hilos + [lector]:
+                hilo.join()
+        finally:
+            sys.setswitchinterval(intervalo)
+        assert errores == []
+        assert registro.contador("c_concurrente").valor == 80_000
+        assert registro.histograma("h_concurrente").cuenta == 80_000
+
+    def test_exportar_prometheus(self):
+        from metrics import RegistroMetricas
+        registro = RegistroMetricas()
+        registro.contador("krishnai_test_total", "ayuda", resultado="ok").inc(2)
+        registro.histograma("krishnai_test_segundos", etapa="x").observe(0.25)
+        texto = registro.exportar_prometheus()
+        assert '# TYPE krishnai_test_total counter' in texto
+        assert 'krishnai_test_total{resultado="ok"} 2' in texto
+        assert 'krishnai_test_segundos{etapa="x",quantile="0.5"} 0.250000' in texto
+        assert 'krishnai_test_segundos_count{etapa="x"} 1' in texto
+
+    def test_indicadores_desde_rotador(self):
+        import metrics
+
+        class FakeRotator:
+            def get_status_summary(self):
+                return {"current_key": "a", "total_keys": 2, "blocked_keys": 1, "available_keys": 1,
+                        "keys_status": [{"name": "a", "is_blocked": False, "failed_count": 0},
+                                        {"name": "b", "is_blocked": True, "failed_count": 3}]}
+
+        metrics.actualizar_desde_rotador(FakeRotator())
+        assert metrics.REGISTRO.indicador("krishnai_claves_disponibles").valor == 1
+        assert metrics.REGISTRO.indicador("krishnai_clave_fallos", clave="b").valor == 3
+
+    def test_servidor_metricas(self):
+        import urllib.request
+        import metrics
+        servidor = metrics.iniciar_servidor_metricas(puerto=0)
+        puerto = servidor.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{puerto}/metrics", timeout=5) as r:
+            assert r.status == 200
+            assert "krishnai_" in r.read().decode("utf-8")
+
+
+class TestGeminiFalso:
+    def test_respuesta_cita_versos_del_contexto(self):
+        from benchmarks.fake_gemini import ConfigFalsa, GeminiFalso
+        falso = GeminiFalso(ConfigFalsa(latencia_media=0, jitter=0, semilla=1))
+        prompt = "Capítulo 2, Verso 47 (El Bienaventurado Señor): ... Capítulo 3, Verso 8 (...)"
+        texto = falso("gemini-2.0-flash", prompt, {}).text
+        assert "[C. II - 47]" in texto or "[C. III - 8]" in texto
+        assert falso.estadisticas.llamadas == 1
+
+    def test_inyeccion_429(self):
+        import pytest
+        from benchmarks.fake_gemini import ConfigFalsa, GeminiFalso
+        falso = GeminiFalso(ConfigFalsa(latencia_media=0, jitter=0, prob_429=1.0))
+        with pytest.raises(Exception, match="429"):
+            falso("gemini-2.0-flash", "prompt", {})
+        assert falso.estadisticas.errores_429 == 1
+
+    def test_streaming_por_fragmentos(self):
+        from benchmarks.fake_gemini import ConfigFalsa, GeminiFalso
+        falso = GeminiFalso(ConfigFalsa(latencia_media=0, jitter=0, fragmentos=4, retardo_fragmento=0))
+        respuesta = falso("gemini-2.0-flash", "prompt", {}, stream=True)
+        fragmentos = [f.text for f in respuesta]
+        assert len(fragmentos) > 1
+        assert "".join(fragmentos) == respuesta.text
+
+    def test_servidor_http(self):
+        import pytest
+        from benchmarks.fake_gemini import ClienteGeminiHTTP, ConfigFalsa, GeminiFalso, servir_http
+        falso = GeminiFalso(ConfigFalsa(latencia_media=0, jitter=0, fragmentos=3, retardo_fragmento=0))
+        servidor = servir_http(falso)
+        try:
+            cliente = ClienteGeminiHTTP(f"http://127.0.0.1:{servidor.server_address[1]}")
+            assert "Arjuna" in cliente("gemini-2.0-flash", "hola", {}).text
+            assert "Arjuna" in "".join(f.text for f in cliente("gemini-2.0-flash", "hola", {}, stream=True))
+            falso.config.prob_429 = 1.0
+            with pytest.raises(Exception, match="429"):
+                cliente("gemini-2.0-flash", "hola", {})
+        finally:
+            servidor.shutdown()
+
+    def test_comparar_detecta_regresion(self):
+        from benchmarks.e2e import comparar
+        base = {"throughput_turnos_s": 10.0, "latencia_ms": {"p50": 100.0, "p95": 200.0}}
+        actual = {"throughput_turnos_s": 7.0, "latencia_ms": {"p50": 105.0, "p95": 300.0}}
+        regresiones = comparar(actual, base, tolerancia=0.2)
+        assert any(r.startswith("throughput_turnos_s") for r in regresiones)
+        assert any(r.startswith("latencia_ms.p95") for r in regresiones)
+        assert not any(r.startswith("latencia_ms.p50") for r in regresiones)
+
+
+class TestMicrobenchmarks:
+    def test_medir_reporta_ops_y_asignaciones(self):
+        from benchmarks.micro import medir
+        r = medir(lambda: [0] * 1000, tiempo_minimo=0.01, repeticiones=1)
+        assert r["ops_s"] > 0
+        assert r["pico_kb"] > 0
+
+    def test_historial_sintetico_cita_versos(self):
+        import random
+        from benchmarks.micro import historial_sintetico
+        from prompt_builder import extraer_versos_citados_del_historial
+        bhagavad_gita = {"capitulos": {"2": {"versos": {
+            "47": {"texto": "a", "locutor": "El Bienaventurado Señor"},
+            "48": {"texto": "b", "locutor": "El Bienaventurado Señor"},
+        }}}}
+        historial = historial_sintetico(bhagavad_gita, 4, random.Random(0))
+        versos, _ = extraer_versos_citados_del_historial(historial, bhagavad_gita, ventana_prohibicion=4)
+        assert versos == {"2:47", "2:48"}
+
+    def test_comparar_detecta_regresion(self):
+        from benchmarks.micro import comparar
+        base = {"x": {"ops_s": 100.0, "pico_kb": 10.0}}
+        assert comparar({"x": {"ops_s": 70.0, "pico_kb": 10.0}}, base, 0.2)
+        assert not comparar({"x": {"ops_s": 95.0, "pico_kb": 11.0}}, base, 0.2)
+
+
+class TestCarga:
+    def test_guion_alterna_preguntas_y_barra_lateral(self):
+        from benchmarks.carga import guion
+        pasos = guion(0, 3)
+        assert pasos[0][0] == "nombre"
+        assert [t for t, _ in pasos].count("pregunta") == 3
+        assert ("temperatura", 0.3) in pasos
+
+
+class TestParserCorpus:
+    TEXTO = "\n".join([
+        "Prólogo sin capítulo",
+        "Capítulo II",
+        "El yoga por el Samkhya",
+        "El Bienaventurado Señor dijo:",
+        "1. Primera línea del verso",
+        "continuación del verso uno",
+        "y otra más",
+        "2-3. primera parte; segunda parte",
+        "cola del compuesto",
+        "Arjuna dijo:",
+        "4. Pregunta de Arjuna",
+    ])
+
+    def test_extrae_versos_y_continuaciones(self):
+        from procesado_bhagavad_gita_txt_corregido import extraer_capitulos_versos
+        capitulos = extraer_capitulos_versos(self.TEXTO)
+        versos = capitulos["2"]["versos"]
+        assert capitulos["2"]["titulo"] == "El yoga por el Samkhya"
+        assert versos["1"]["texto"] == "Primera línea del verso continuación del verso uno y otra más"
+        assert versos["1"]["locutor"] == "El Bienaventurado Señor"
+        assert versos["2"]["texto"] == "primera parte"
+        assert versos["3"]["texto"] == "segunda parte cola del compuesto"
+        assert versos["4"]["locutor"] == "Arjuna"
+
+    def test_acepta_iterable_de_lineas(self):
+        import io
+        from procesado_bhagavad_gita_txt_corregido import extraer_capitulos_versos
+        assert extraer_capitulos_versos(io.StringIO(self.TEXTO)) == extraer_capitulos_versos(self.TEXTO)
+
+
+class TestConstruirCorpus:
+    TEXTO = "\n".join([
+        "Capítulo primero",
+        "El desaliento de Arjuna",
+        "Dhritarashtra dijo:",
+        "1. En el campo del dharma",
+        "Capítulo II",
+        "El yoga por el Samkhya",
+        "El Bienaventurado Señor dijo:",
+        "1. Verso uno",
+        "2. Verso dos",
+    ]) + "\n"
+
+    def test_capitulo_ordinal(self):
+        from procesado_bhagavad_gita_txt_corregido import extraer_capitulos_versos
+        capitulos = extraer_capitulos_versos(self.TEXTO)
+        assert sorted(capitulos) == ["1", "2"]
+        assert capitulos["1"]["versos"]["1"]["locutor"] == "Dhritarashtra"
+
+    def test_prescan_localiza_capitulos(self, tmp_path):
+        from construir_corpus import prescan_capitulos
+        fuente = tmp_path / "gita.txt"
+        fuente.write_text(self.TEXTO, encoding="utf-8")
+        limites = prescan_capitulos(str(fuente))
+        assert [c for c, _, _ in limites] == [1, 2]
+        datos = fuente.read_bytes()
+        assert datos[limites[1][1]:limites[1][2]].decode("utf-8").startswith("Capítulo II")
+        assert limites[-1][2] == len(datos)
+
+    def test_validacion_y_alineacion(self):
+        from construir_corpus import construir_alineacion, validar_capitulos
+
+        def versos(n):
+            return {"versos": {str(v): {"texto": "t"} for v in range(1, n + 1)}}
+
+        capitulos = {"1": versos(46), "13": versos(35)}
+        informe = validar_capitulos(capitulos)
+        assert informe["1"]["faltan"] == [47] and not informe["1"]["ok"]
+        assert informe["13"]["ok"]
+        alineacion = construir_alineacion({"es": {"capitulos": capitulos}})
+        assert alineacion["13:1"] == {"es": "13:2"}
+        assert alineacion["1:46"] == {"es": "1:46"}
+        assert "1:47" not in alineacion
+
+    def test_construye_y_carga_corpus(self, tmp_path):
+        from construir_corpus import construir_corpus
+        from gita_loader import leer_corpus
+        fuente = tmp_path / "gita.txt"
+        fuente.write_text(self.TEXTO, encoding="utf-8")
+        salida = tmp_path / "corpus_gita.json"
+        fuentes = [{"id": "es-prueba", "traductor": "Prueba", "fuente": str(fuente),
+                    "formato": "txt_corregido", "tipo": "traduccion", "principal": True}]
+        corpus = construir_corpus(fuentes, str(salida), max_workers=2)
+        assert corpus["principal"] == "es-prueba"
+        assert corpus["alineacion"]["2:2"] == {"es-prueba": "2:2"}
+        assert construir_corpus(fuentes, str(tmp_path / "otro.json"), max_workers=1, estricto=True) is None
+        import json
+        gita = leer_corpus(json.loads(salida.read_text(encoding="utf-8")))
+        assert gita["traductor"] == "Prueba"
+        assert gita["capitulos"]["2"]["versos"]["2"]["texto"] == "Verso dos"
+
+
+class TestCorpusBinario:
+    CORPUS = {
+        "formato": "krishnai-corpus", "version": "abc", "principal": "es",
+        "traducciones": {"es": {"titulo": "Bhagavad Gita", "traductor": "Prueba", "capitulos": {
+            "2": {"titulo": "Samkhya", "versos": {
+                "1": {"texto": "Sanjaya habló", "significado": "", "locutor": "Sanjaya"},
+                "47": {"texto": "Tienes derecho a la acción", "significado": "ñ", "locutor": "El Bienaventurado Señor"},
+            }},
+        }}},
+    }
+
+    def test_ida_y_vuelta(self, tmp_path):
+        import copy
+        import corpus_binario
+        import tablas_corpus
+        corpus = copy.deepcopy(self.CORPUS)
+        trad = corpus["traducciones"]["es"]
+        trad["tablas"] = tablas_corpus.anotar_capitulos(trad["capitulos"])
+        path = tmp_path / "corpus.bin"
+        corpus_binario.escribir_binario(corpus, str(path))
+        gita = corpus_binario.abrir(str(path)).traduccion()
+        versos = gita["capitulos"]["2"]["versos"]
+        original = trad["capitulos"]["2"]["versos"]
+        assert gita["traductor"] == "Prueba"
+        assert gita["capitulos"]["2"]["titulo"] == "Samkhya"
+        assert list(versos) == ["1", "47"] and "47" in versos and "3" not in versos
+        assert {k: dict(v) for k, v in versos.items()} == original
+        assert corpus_binario.abrir(str(path)) is corpus_binario.abrir(str(path))
+        assert versos["47"]["es_krishna"] and not versos["1"]["es_krishna"]
+        assert gita["tablas"]["citas"]["2:47"] == "[C. II - 47]"
+        # texto_completo se guarda tal cual y el texto del verso es una subcadena suya
+        assert path.read_bytes().count("Tienes derecho".encode("utf-8")) == 1
+        assert versos["47"]["texto_completo"] == original["47"]["texto_completo"]
+
+    def test_rechaza_archivo_ajeno(self, tmp_path):
+        import pytest
+        import corpus_binario
+        path = tmp_path / "otro.bin"
+        path.write_bytes(b"x" * 64)
+        with pytest.raises(ValueError):
+            corpus_binario.CorpusBinario(str(path))
+
+
+class TestTablasCorpus:
+    def test_anotar_capitulos(self):
+        import tablas_corpus
+        capitulos = {"12": {"titulo": "", "versos": {
+            "13": {"texto": "Quien no odia", "significado": "", "locutor": "El Bienaventurado Señor"},
+            "1": {"texto": "Pregunta", "significado": "", "locutor": "Arjuna"},
+        }}}
+        tablas = tablas_corpus.anotar_capitulos(capitulos)
+        verso = capitulos["12"]["versos"]["13"]
+        assert verso["texto_completo"] == "Capítulo 12, Verso 13 (El Bienaventurado Señor): Quien no odia"
+        assert tablas["versos_krishna"] == {"12": 1}
+        assert tablas["citas"]["12:13"] == "[C. XII - 13]"
+        assert tablas["romano_a_arabigo"]["XVIII"] == 18
+
+    def test_respaldo_sin_tablas(self):
+        import tablas_corpus
+        gita = {"capitulos": {"2": {"versos": {"47": {"texto": "t", "locutor": "El Bienaventurado Señor"}}}}}
+        assert tablas_corpus.cita(gita, "2:47") == "[C. II - 47]"
+        assert tablas_corpus.capitulo_arabigo(gita, "xii") == 12
+        assert tablas_corpus.versos_krishna_por_capitulo(gita) == {"2": 1}
+        assert tablas_corpus.texto_completo("2", "47", gita["capitulos"]["2"]["versos"]["47"]).endswith(": t")
+
+
+class TestCitas:
+    TEXTO = ("Escucha [C. XII - 13] y [C. 2 - 47-48]. Recuerda (Capítulo 2, verso 14), "
+             "BG 3.19 y [Cap. II, v. 20]; [C. XX - 1] no existe.")
+    GITA = {"capitulos": {"2": {"versos": {
+        "47": {"texto": "Tienes derecho a la acción", "locutor": "El Bienaventurado Señor"},
+        "48": {"texto": "Establecido en el yoga", "locutor": "El Bienaventurado Señor"},
+        "14": {"texto": "Los contactos de los sentidos", "locutor": "El Bienaventurado Señor"},
+        "20": {"texto": "No nace ni muere", "locutor": "El Bienaventurado Señor"},
+    }}, "12": {"versos": {"13": {"texto": "Quien no odia", "locutor": "El Bienaventurado Señor"}}},
+        "3": {"versos": {"19": {"texto": "Sanjaya", "locutor": "Sanjaya"}}}}}
+
+    def test_normaliza_todas_las_formas(self):
+        from citas import claves, extraer_citas
+        assert claves(extraer_citas(self.TEXTO)) == ["12:13", "2:47", "2:48", "2:14", "3:19", "2:20"]
+
+    def test_streaming_equivale_a_texto_completo(self):
+        from citas import EscanerCitas, extraer_citas
+        escaner = EscanerCitas()
+        for i in range(0, len(self.TEXTO), 3):
+            escaner.alimentar(self.TEXTO[i:i + 3])
+        escaner.cerrar()
+        assert escaner.citas == extraer_citas(self.TEXTO)
+
+    def test_valida_contra_el_corpus(self):
+        from citas import extraer_citas
+        por_clave = {c.clave: c for c in extraer_citas(self.TEXTO + " [C. II - 99]", self.GITA)}
+        assert por_clave["2:47"].es_krishna
+        assert por_clave["3:19"].existe and not por_clave["3:19"].es_krishna
+        assert not por_clave["2:99"].existe
+
+    def test_historial_usa_citas_estructuradas(self):
+        from prompt_builder import extraer_versos_citados_del_historial
+        historial = [{"role": "assistant", "content": "sin marcas", "citas": ["2:47"]},
+                     {"role": "assistant", "content": "Sabe que... (Capítulo 2, verso 20)"}]
+        versos, textos = extraer_versos_citados_del_historial(historial, self.GITA)
+        assert versos == {"2:47", "2:20"}
+        assert textos == ["Tienes derecho a la acción", "No nace ni muere"]
+
+
+class TestGuardiaRepeticion:
+    GITA = {"capitulos": {"2": {"versos": {
+        "47": {"texto": "Tienes derecho a la acción, pero nunca a sus frutos; que el fruto de la acción no sea tu motivo",
+               "locutor": "El Bienaventurado Señor"},
+        "48": {"texto": "Establecido en el yoga, realiza tus acciones abandonando el apego",
+               "locutor": "El Bienaventurado Señor"},
+    }}}}
+
+    @staticmethod
+    def _trocear(texto, n=7):
+        from benchmarks.fake_gemini import FragmentoFalso
+        return [FragmentoFalso(texto[i:i + n]) for i in range(0, len(texto), n)]
+
+    def test_escaner_shingles_equivale_a_texto_completo(self):
+        from indice_shingles import EscanerShingles, hashes_shingles, palabras
+        texto = "Tienes derecho a la acción, pero nunca a sus frutos"
+        escaner = EscanerShingles(3)
+        hashes = [h for f in self._trocear(texto, 4) for h in escaner.alimentar(f.text)] + escaner.cerrar()
+        assert hashes == hashes_shingles(palabras(texto), 3)
+
+    def test_detecta_cita_bloqueada(self):
+        from guardia_repeticion import GuardiaRepeticion
+        guardia = GuardiaRepeticion(self.GITA, {"2:47"})
+        detecciones = [guardia.alimentar(f.text) for f in self._trocear("Mi querido Arjuna [C. II - 47] y más texto" + " " * 60)]
+        repeticion = next(d for d in detecciones if d)
+        assert (repeticion.motivo, repeticion.verso) == ("cita", "2:47")
+
+    def test_detecta_texto_parafraseado_de_verso_bloqueado(self):
+        from guardia_repeticion import GuardiaRepeticion
+        guardia = GuardiaRepeticion(self.GITA, {"2:47"})
+        texto = "Escucha: tienes derecho a la accion, pero nunca a sus frutos, Arjuna."
+        detecciones = [guardia.alimentar(f.text) for f in self._trocear(texto)] + [guardia.cerrar()]
+        assert any(d and d.motivo == "texto" and d.verso == "2:47" for d in detecciones)
+        assert GuardiaRepeticion(self.GITA, {"2:48"}).alimentar(texto) is None
+
+    def test_reemite_una_sola_vez(self):
+        from guardia_repeticion import generar_con_guardia
+        prompts = []
+        respuestas = iter(["Sabe que [C. II - 47] lo dice todo.", "Por ello, actúa [C. II - 48]."])
+
+        def generar(prompt):
+            prompts.append(prompt)
+            return self._trocear(next(respuestas))
+
+        texto, citas, repeticion, truncada = generar_con_guardia(generar, "P", self.GITA, {"2:47"})
+        assert texto == "Por ello, actúa [C. II - 48]."
+        assert [c.clave for c in citas] == ["2:48"] and repeticion is None and not truncada
+        assert len(prompts) == 2 and "[C. II - 47]" in prompts[1]
+
+
+class TestPlazo:
+    GITA = TestGuardiaRepeticion.GITA
+
+    def test_recorta_timeouts_y_se_agota(self):
+        import pytest
+        from krishna_engine import mensaje_error
+        from plazo import Plazo, PlazoAgotado
+        ahora = [100.0]
+        plazo = Plazo(20, reloj=lambda: ahora[0])
+        assert plazo.recortar(10) == 10 and plazo.permite("reemision")
+        ahora[0] += 15
+        assert plazo.recortar(10) == 5 and not plazo.permite("reemision")
+        plazo.comprobar("llamada_llm")
+        ahora[0] += 6
+        assert plazo.agotado() and plazo.restante() == 0
+        with pytest.raises(PlazoAgotado) as error:
+            plazo.comprobar("llamada_llm")
+        assert mensaje_error(error.value)[0] == "warning"
+
+    def test_sin_holgura_no_reemite_y_sin_plazo_corta(self):
+        from guardia_repeticion import generar_con_guardia
+        from plazo import Plazo
+        prompts = []
+
+        def generar(prompt):
+            prompts.append(prompt)
+            return TestGuardiaRepeticion._trocear("Sabe que [C. II - 47] lo dice todo.")
+
+        texto, _, repeticion, truncada = generar_con_guardia(generar, "P", self.GITA, {"2:47"}, plazo=Plazo(3))
+        # Sin tiempo para otra generación se entrega la respuesta entera, sin cortarla
+        assert texto == "Sabe que [C. II - 47] lo dice todo." and repeticion.verso == "2:47" and not truncada
+        assert len(prompts) == 1
+        assert generar_con_guardia(generar, "P", self.GITA, set(), plazo=Plazo(0))[::3] == ("", True)
+
+    def test_el_motor_propaga_el_plazo_del_turno(self):
+        import pytest
+        from krishna_engine import KrishnaEngine, Sesion
+        from plazo import Plazo, PlazoAgotado
+        rotador = TestKrishnaEngine.RotadorFalso(["Sabe que [C. II - 47] lo dice todo."])
+        motor = KrishnaEngine(self.GITA, rotador, precalcular=False)
+        sesion = Sesion(nombre_usuario="Arjuna", genero_usuario="Masculino")
+        plazo = Plazo(15)
+        motor.respond(sesion, "¿Cuál es mi dharma?", plazo=plazo)
+        assert rotador.plazo is plazo
+        with pytest.raises(PlazoAgotado):
+            motor.respond(sesion, "¿Y cómo actúo?", plazo=Plazo(0))
+        assert len(sesion.mensajes) == 2
+
+    def test_stream_colgado_no_excede_el_plazo(self):
+        import threading
+        import time
+        from benchmarks.fake_gemini import RespuestaFalsa
+        from krishna_engine import KrishnaEngine, Sesion
+        from plazo import Plazo
+        liberar = threading.Event()
+
+        class RotadorColgado(TestKrishnaEngine.RotadorFalso):
+            def generate_content_with_retry(self, *args, **kwargs):
+                def fragmentos():
+                    yield RespuestaFalsa(["Sabe que "])
+                    liberar.wait(5)
+                    yield RespuestaFalsa(["[C. II - 47] lo dice todo."])
+                return fragmentos()
+
+        motor = KrishnaEngine(self.GITA, RotadorColgado([]), precalcular=False)
+        observadas = []
+        motor.presupuesto.observar = lambda *args: observadas.append(args)
+        sesion = Sesion(nombre_usuario="Arjuna", genero_usuario="Masculino")
+        inicio = time.monotonic()
+        try:
+            respuesta = motor.respond(sesion, "¿Cuál es mi dharma?", plazo=Plazo(0.3))
+        finally:
+            liberar.set()
+        # El stream colgado se abandona al agotarse el plazo y lo recibido se marca truncado
+        assert time.monotonic() - inicio < 2
+        assert respuesta.texto == "Sabe que " and respuesta.truncada
+        assert not observadas and len(motor.respuestas) == 0
+
+
+class TestIndiceShingles:
+    GITA = TestGuardiaRepeticion.GITA
+
+    def test_analiza_citas_textuales_y_concordancia(self):
+        from indice_shingles import IndiceShingles
+        indice = IndiceShingles(self.GITA)
+        verso = self.GITA["capitulos"]["2"]["versos"]["47"]["texto"]
+        texto = f"Escucha, Arjuna: «{verso}» [C. II - 48]."
+        analisis = indice.analizar(texto, bhagavad_gita=self.GITA)
+        assert analisis.cobertura == {"2:47": 1.0}
+        assert analisis.citas_sin_texto == ["2:48"] and analisis.texto_sin_cita == ["2:47"]
+        (inicio, fin, clave), = analisis.tramos
+        assert clave == "2:47" and texto[inicio:fin] == verso
+        assert 0 < analisis.fundamentacion < 1
+
+    def test_respuesta_sin_texto_del_gita(self):
+        from indice_shingles import IndiceShingles
+        analisis = IndiceShingles(self.GITA).analizar("Hola, querido amigo, ¿en qué puedo ayudarte hoy?")
+        assert analisis.cobertura == {} and analisis.tramos == [] and analisis.fundamentacion == 0.0
+
+
+class TestKrishnaEngine:
+    GITA = TestGuardiaRepeticion.GITA
+
+    class RotadorFalso:
+        def __init__(self, respuestas):
+            self.respuestas = iter(respuestas)
+            self.prompts = []
+            self.llamadas = []
+
+        def generate_content_with_retry(self, model_name, prompt, generation_config, max_retries=3,
+                                        timeout_seconds=10, stream=False, plazo=None):
+            from benchmarks.fake_gemini import RespuestaFalsa
+            self.prompts.append(prompt)
+            self.llamadas.append((model_name, generation_config))
+            self.plazo = plazo
+            texto = next(self.respuestas)
+            if isinstance(texto, Exception):
+                raise texto
+            return TestGuardiaRepeticion._trocear(texto) if stream else RespuestaFalsa([texto])
+
+    def test_turno_completo_actualiza_la_sesion(self):
+        from krishna_engine import KrishnaEngine, Sesion
+        rotador = self.RotadorFalso(["Sabe que [C. II - 47] lo dice todo.", "Por ello, actúa [C. II - 48]."])
+        motor = KrishnaEngine(self.GITA, rotador)
+        sesion = Sesion(nombre_usuario="Arjuna", genero_usuario="Masculino")
+        fragmentos = []
+
+        respuesta = motor.respond(sesion, "¿Cuál es mi dharma?", al_fragmento=fragmentos.append)
+        assert respuesta.texto == "Sabe que [C. II - 47] lo dice todo."
+        assert fragmentos[-1] == respuesta.texto
+        assert [m["role"] for m in sesion.mensajes] == ["user", "assistant"]
+        assert sesion.mensajes[1]["citas"] == ["2:47"]
+
+        motor.respond(sesion, "¿Y cómo actúo?", stream=False)
+        assert motor.versos_bloqueados(sesion) == {"2:47", "2:48"}
+        assert "Capítulo 2, Verso 47" not in rotador.prompts[1].split("--- FIN DEL CONTEXTO ---")[0]
+
+    def test_contexto_compartido_por_versos_bloqueados(self):
+        from krishna_engine import KrishnaEngine
+        motor = KrishnaEngine(self.GITA, self.RotadorFalso([]), precalcular=False)
+        assert motor.contexto(set()) is motor.contexto(set())
+        sin_47 = motor.contexto({"2:47"})
+        assert sin_47 is motor.contexto({"2:47"}) and sin_47 is not motor.contexto(set())
+        assert "2:47" not in {f"{v['capitulo']}:{v['verso']}" for v in sin_47}
+
+    def test_precalculo_del_siguiente_turno(self):
+        from krishna_engine import KrishnaEngine, Sesion
+        respuestas = ["Sabe que [C. II - 47] lo dice todo.", "Por ello, actúa [C. II - 48]."]
+        prompts = []
+        for precalcular in (True, False):
+            rotador = self.RotadorFalso(respuestas)
+            motor = KrishnaEngine(self.GITA, rotador, precalcular=precalcular)
+            sesion = Sesion(nombre_usuario="Arjuna", genero_usuario="Masculino")
+            motor.respond(sesion, "¿Cuál es mi dharma?")
+            assert (sesion.precalculo is not None) == precalcular
+            if precalcular:
+                precalculo = sesion.precalculo.result()
+                assert precalculo.versos_bloqueados == {"2:47"}
+                assert precalculo.firma == motor._firma(sesion.mensajes, "Arjuna", "Masculino")
+            motor.respond(sesion, "¿Y cómo actúo?")
+            prompts.append(rotador.prompts[1])
+        # El prompt armado con el precálculo es idéntico al calculado en el momento
+        assert prompts[0] == prompts[1]
+
+    def test_precalculo_de_perfiles_cortos(self, monkeypatch):
+        import threading
+        from krishna_engine import KrishnaEngine, Sesion
+        import krishna_engine
+        original = krishna_engine.preparar_prompt_krishna
+        preparados = []
+
+        def preparar_contando(*args, **kwargs):
+            # Solo cuenta el turno; el precálculo del siguiente corre en otro hilo
+            if threading.current_thread() is threading.main_thread():
+                preparados.append(args)
+            return original(*args, **kwargs)
+
+        prompts = []
+        for precalcular in (True, False):
+            rotador = self.RotadorFalso(["Sabe que [C. II - 47] lo dice todo.", "Hola, Arjuna."])
+            motor = KrishnaEngine(self.GITA, rotador, precalcular=precalcular)
+            sesion = Sesion(nombre_usuario="Arjuna", genero_usuario="Masculino")
+            motor.respond(sesion, "¿Cuál es mi dharma?")
+            if precalcular:
+                assert set(sesion.precalculo.result().reducidos) == {6000}
+            preparados.clear()
+            with monkeypatch.context() as m:
+                m.setattr(krishna_engine, "preparar_prompt_krishna", preparar_contando)
+                assert motor.respond(sesion, "Hola").perfil.tipo == "saludo"
+            # Con el precálculo el saludo no arma ningún prompt en el turno
+            assert bool(preparados) != precalcular
+            prompts.append(rotador.prompts[1])
+        assert prompts[0] == prompts[1]
+
+    def test_precalculo_obsoleto_se_descarta(self):
+        from krishna_engine import KrishnaEngine, Sesion
+        rotador = self.RotadorFalso(["Sabe que [C. II - 47] lo dice todo.", "Por ello, actúa [C. II - 48]."])
+        motor = KrishnaEngine(self.GITA, rotador)
+        sesion = Sesion(nombre_usuario="Arjuna", genero_usuario="Masculino")
+        motor.respond(sesion, "¿Cuál es mi dharma?")
+        sesion.precalculo.result()
+        sesion.nombre_usuario = "Lucía"
+        motor.respond(sesion, "¿Y cómo actúo?")
+        assert "LUCÍA: ¿Y cómo actúo?" in rotador.prompts[1]
+
+    def test_perfil_segun_tipo_de_pregunta(self):
+        from clasificador import MODELO_LIGERO, PERFILES
+        from krishna_engine import KrishnaEngine, Sesion
+        import metrics
+        from presupuesto_salida import PresupuestoSalida
+        rotador = self.RotadorFalso(["Hola Arjuna", "Sabe que [C. II - 47] lo dice todo."])
+        motor = KrishnaEngine(self.GITA, rotador, presupuesto=PresupuestoSalida(metrics.RegistroMetricas()))
+        sesion = Sesion(nombre_usuario="Arjuna", genero_usuario="Masculino")
+        assert motor.respond(sesion, "Hola").perfil.tipo == "saludo"
+        assert motor.respond(sesion, "¿Cuál es mi dharma?").perfil.tipo == "filosofica"
+        (modelo_saludo, config_saludo), (modelo_dharma, config_dharma) = rotador.llamadas
+        # Sin respuestas observadas: techo del perfil, algo menor porque el usuario escribe breve
+        assert modelo_saludo == MODELO_LIGERO and config_saludo["max_output_tokens"] == int(200 * 0.85)
+        assert modelo_dharma == PERFILES["filosofica"].modelo and config_dharma["max_output_tokens"] == int(1200 * 0.85)
+        assert "\nARJUNA:" in config_dharma["stop_sequences"]
+
+    def test_mensaje_error(self):
+        from krishna_engine import mensaje_error
+        assert mensaje_error(Exception("429 quota exceeded"))[0] == "warning"
+        assert mensaje_error(Exception("invalid api key"))[0] == "error"
+
+
+class TestDegradacion:
+    GITA = TestGuardiaRepeticion.GITA
+
+    class RotadorAgotable(TestKrishnaEngine.RotadorFalso):
+        espera = 0.0
+
+        def segundos_hasta_clave(self):
+            return self.espera
+
+    def test_respuesta_local_cita_los_versos_afines(self):
+        import citas
+        from degradacion import componer_respuesta_local
+        from gita_loader import obtener_versos_contexto
+        contexto = obtener_versos_contexto(self.GITA)
+        texto = componer_respuesta_local("¿Cómo abandono el apego a mis acciones?", "espiritual", contexto,
+                                         self.GITA, "Lucía", "Femenino")
+        assert texto.startswith("Mi querida Lucía")
+        encontradas = citas.extraer_citas(texto, self.GITA)
+        assert [c.clave for c in encontradas][0] == "2:48" and all(c.es_krishna for c in encontradas)
+        assert "realiza tus acciones abandonando el apego" in texto
+        saludo = componer_respuesta_local("Hola", "saludo", contexto, self.GITA, "Lucía", "Femenino")
+        assert "Bienvenida" in saludo and not citas.extraer_citas(saludo)
+
+    def test_cache_de_respuestas_equivalentes(self):
+        from degradacion import CacheRespuestas
+        cache = CacheRespuestas()
+        cache.guardar("¿Cuál es mi dharma?", "filosofica", "{NOMBRE}, tu dharma es actuar [C. II - 47].",
+                      "Masculino", ["2:47"])
+        assert cache.buscar("cual es mi dharma", "filosofica", "Mikel", "Masculino") == \
+            "Mikel, tu dharma es actuar [C. II - 47]."
+        assert cache.buscar("¿Cuál es mi dharma?", "filosofica", "Mikel", "Masculino", {"2:47"}) is None
+        assert cache.buscar("¿Qué es la meditación?", "filosofica", "Mikel", "Masculino") is None
+
+    def test_cache_no_sirve_detalles_personales(self):
+        from degradacion import CacheRespuestas
+        cache = CacheRespuestas()
+        cache.guardar("¿Cómo supero mi divorcio con Laura?", "espiritual",
+                      "{NOMBRE}, tu divorcio con Laura pasará [C. II - 14].", "Masculino", ["2:14"])
+        # La pregunta guardada tiene términos que la nueva no trae
+        assert cache.buscar("¿Cómo supero mi divorcio?", "espiritual", "Pedro", "Masculino") is None
+        assert cache.buscar("¿Cómo supero mi divorcio con Laura?", "espiritual", "Mikel", "Masculino") == \
+            "Mikel, tu divorcio con Laura pasará [C. II - 14]."
+
+    def test_plantilla_con_marca_de_nombre(self):
+        from degradacion import plantilla_nombre
+        instrucciones = ["Respondes a {nombre} en Kurukshetra. Usa SOLO las palabras de Krishna, no las de Arjuna."]
+        assert plantilla_nombre("Lucía, actúa como Arjuna [C. II - 47].", "Lucía", instrucciones) == \
+            "{NOMBRE}, actúa como Arjuna [C. II - 47]."
+        # El nombre también sale en lo que vio el modelo: no se sabe qué menciones son del usuario
+        assert plantilla_nombre("Arjuna, como le enseñé a Arjuna [C. II - 47].", "Arjuna", instrucciones) is None
+        assert plantilla_nombre("{NOMBRE}, actúa.", "Lucía", instrucciones) is None
+
+    def test_solo_se_guardan_primeros_turnos_con_marca_de_nombre(self):
+        from krishna_engine import KrishnaEngine, Sesion
+        rotador = self.RotadorAgotable(["Mikel, como le enseñé a Arjuna en Kurukshetra [C. II - 47].",
+                                        "Sabe que [C. II - 48] lo dice todo.",
+                                        "Mikel, tu divorcio con Laura pasará [C. II - 14].",
+                                        "Arjuna, como le enseñé a Arjuna, medita [C. II - 48]."])
+        motor = KrishnaEngine(self.GITA, rotador, precalcular=False)
+        mikel = Sesion(nombre_usuario="Mikel", genero_usuario="Masculino")
+        fragmentos = []
+        respuesta = motor.respond(mikel, "¿Cuál es mi dharma?", al_fragmento=fragmentos.append)
+        # El prompt y las secuencias de parada llevan el nombre real
+        assert "MIKEL" in rotador.prompts[0] and "{NOMBRE}" not in rotador.prompts[0]
+        assert "\nMIKEL:" in rotador.llamadas[0][1]["stop_sequences"]
+        assert respuesta.texto == fragmentos[-1] == "Mikel, como le enseñé a Arjuna en Kurukshetra [C. II - 47]."
+
+        # Los turnos siguientes dependen del historial: no se guardan
+        motor.respond(mikel, "¿Qué es la meditación?")
+        motor.respond(mikel, "¿Cómo supero mi divorcio con Laura?")
+        # Un nombre que también sale en el prompt («Arjuna») no se puede separar del texto: no se guarda
+        motor.respond(Sesion(nombre_usuario="Arjuna", genero_usuario="Masculino"), "¿Cómo medito?")
+
+        rotador.espera = 60.0
+        pedro = Sesion(nombre_usuario="Pedro", genero_usuario="Masculino")
+        respuesta = motor.respond(pedro, "¿Cuál es mi dharma?")
+        assert (respuesta.degradacion, respuesta.texto) == \
+            ("cache", "Pedro, como le enseñé a Arjuna en Kurukshetra [C. II - 47].")
+        respuesta = motor.respond(Sesion(nombre_usuario="Pedro"), "¿Cómo supero mi divorcio con Laura?")
+        assert respuesta.degradacion == "local" and "Laura" not in respuesta.texto
+        respuesta = motor.respond(Sesion(nombre_usuario="Pedro"), "¿Cómo medito?")
+        assert respuesta.degradacion == "local"
+
+    def test_degrada_sin_claves_y_reintenta_en_cola(self):
+        from krishna_engine import KrishnaEngine, Sesion
+        rotador = self.RotadorAgotable(["Sabe que [C. II - 47] lo dice todo.",
+                                        Exception("429 quota exceeded"), "Por ello, actúa [C. II - 48]."])
+        motor = KrishnaEngine(self.GITA, rotador, precalcular=False)
+        sesion = Sesion(nombre_usuario="Mikel", genero_usuario="Masculino")
+
+        # Todas las claves bloqueadas: respuesta local sin llamar al modelo y turno en cola
+        rotador.espera = 60.0
+        respuesta = motor.respond(sesion, "¿Cuál es mi dharma?")
+        assert respuesta.degradacion == "local" and rotador.prompts == []
+        assert respuesta.citas and motor.reintentos.posicion(respuesta.reintento) == 1
+        assert sesion.mensajes[-1]["content"] == respuesta.texto
+        assert sesion.reintentos == [respuesta.reintento]
+
+        # Al desbloquearse una clave el reintento rearma el prompt, pero no toca la sesión:
+        # la respuesta del modelo sustituye a la degradada desde el camino de la propia sesión
+        rotador.espera = 0.0
+        motor.reintentos.despertar()
+        assert respuesta.reintento.futuro.result(timeout=5).texto == "Sabe que [C. II - 47] lo dice todo."
+        assert "¿Cuál es mi dharma?" in rotador.prompts[0] and "MIKEL" in rotador.prompts[0]
+        assert sesion.mensajes[-1]["content"] == respuesta.texto
+        assert motor.aplicar_reintentos(sesion) == 1
+        assert sesion.mensajes[-1]["content"] == "Sabe que [C. II - 47] lo dice todo."
+        assert sesion.mensajes[-1]["citas"] == ["2:47"] and sesion.reintentos == []
+
+        # 429 en otra sesión: se reutiliza la respuesta guardada a la misma pregunta
+        otra = Sesion(nombre_usuario="Pedro", genero_usuario="Masculino")
+        respuesta = motor.respond(otra, "¿Cuál es mi dharma?")
+        assert (respuesta.degradacion, respuesta.texto) == ("cache", "Sabe que [C. II - 47] lo dice todo.")
+        assert respuesta.reintento.futuro.result(timeout=5).texto == "Por ello, actúa [C. II - 48]."
+        # El siguiente turno de la sesión aplica primero el reintento terminado
+        rotador.respuestas = iter(["Actúa sin apego."])
+        motor.respond(otra, "¿Y cómo actúo?")
+        assert otra.mensajes[1]["content"] == "Por ello, actúa [C. II - 48]." and otra.reintentos == []
+
+    def test_reintento_descartado_si_el_turno_ya_no_esta(self):
+        from krishna_engine import KrishnaEngine, Sesion
+        rotador = self.RotadorAgotable(["Sabe que [C. II - 47] lo dice todo."])
+        motor = KrishnaEngine(self.GITA, rotador, precalcular=False)
+        sesion = Sesion(nombre_usuario="Arjuna", genero_usuario="Masculino")
+        rotador.espera = 60.0
+        respuesta = motor.respond(sesion, "¿Cuál es mi dharma?")
+        sesion.mensajes.clear()   # nueva conversación
+        rotador.espera = 0.0
+        motor.reintentos.despertar()
+        assert respuesta.reintento.futuro.result(timeout=5) is None and rotador.prompts == []
+        assert motor.aplicar_reintentos(sesion) == 0 and sesion.reintentos == []
+
+
+class TestClasificador:
+    def test_tipos_de_pregunta(self):
+        from clasificador import clasificar_pregunta
+        assert clasificar_pregunta("Hola") == "saludo"
+        assert clasificar_pregunta("Buenos días, Señor") == "saludo"
+        assert clasificar_pregunta("¿Te gusta el fútbol?") == "casual"
+        assert clasificar_pregunta("¿Cuál es mi dharma?") == "filosofica"
+        assert clasificar_pregunta("¿Qué hago con mis deseos?") == "filosofica"
+        assert clasificar_pregunta("hola, ¿qué es el yoga?") == "filosofica"
+        assert clasificar_pregunta("¿Es la meditación importante en el camino espiritual?") == "espiritual"
+        # Sin señales claras se conserva el perfil completo
+        assert clasificar_pregunta("Tengo un problema en el trabajo") == "espiritual"
+        assert clasificar_pregunta("jaja") == "espiritual"
+
+    def test_palabras_corrientes_no_deciden_el_perfil(self):
+        from clasificador import clasificar_pregunta
+        assert clasificar_pregunta("¿Qué debo ser?") == "espiritual"
+        assert clasificar_pregunta("¿Tiene sentido seguir así?") == "espiritual"
+        assert clasificar_pregunta("¿Es verdad lo que me dijeron?") == "espiritual"
+        assert clasificar_pregunta("¿Qué hago con el tiempo que me queda?") == "espiritual"
+        assert clasificar_pregunta("No sé qué partido tomar") == "espiritual"
+
+    def test_saludos_con_palabras_espirituales(self):
+        from clasificador import clasificar_pregunta
+        assert clasificar_pregunta("Muy bien, gracias") == "saludo"
+        assert clasificar_pregunta("Hola, muy bien") == "saludo"
+        assert clasificar_pregunta("¿Qué es el bien y el mal?") == "espiritual"
+
+    def test_recortar_contexto(self):
+        from gita_loader import recortar_contexto
+        versos = [{"capitulo": 2, "verso": v, "texto_completo": "x" * 400} for v in range(10)]
+        assert len(recortar_contexto(versos, 1000)) == 9
+        assert recortar_contexto(versos, 100_000) == versos
+        # Un contexto corto reparte los versos entre capítulos y conserva el orden
+        versos = [{"capitulo": c, "verso": v, "texto_completo": "x" * 400} for c in (2, 3, 4) for v in range(5)]
+        recortado = recortar_contexto(versos, 700)
+        assert [(v["capitulo"], v["verso"]) for v in recortado] == \
+            [(2, 0), (2, 1), (3, 0), (3, 1), (4, 0), (4, 1)]
+
+
+class TestPresupuestoSalida:
+    def test_se_ajusta_a_las_respuestas_observadas(self):
+        import metrics
+        from clasificador import PERFILES
+        from presupuesto_salida import PresupuestoSalida
+        presupuesto = PresupuestoSalida(metrics.RegistroMetricas(), min_observaciones=5)
+        perfil = PERFILES["espiritual"]
+        pregunta = [{"role": "user", "content": "¿Cómo puedo actuar sin apegarme a los frutos de mis acciones?"}]
+        assert presupuesto.max_tokens(perfil, pregunta) == 1200
+        for _ in range(5):
+            presupuesto.observar(perfil, "x" * 2400, 1200)    # ~600 tokens
+        assert presupuesto.max_tokens(perfil, pregunta) == int(600 * 1.25)
+        # Las respuestas cortadas por el límite hacen crecer de nuevo el presupuesto
+        for _ in range(5):
+            presupuesto.observar(perfil, "x" * 3000, 750)
+        assert presupuesto.max_tokens(perfil, pregunta) == 937
+        # Nunca por debajo del mínimo del tipo
+        presupuesto_breve = PresupuestoSalida(metrics.RegistroMetricas(), min_observaciones=1)
+        presupuesto_breve.observar(perfil, "Sabe.", 1200)
+        assert presupuesto_breve.max_tokens(perfil, pregunta) == 500
+
+
+class TestServidorApi:
+    GITA = TestGuardiaRepeticion.GITA
+
+    def _servidor(self, respuestas):
+        from krishna_engine import KrishnaEngine
+        from servidor_api import ServidorKrishna, arrancar_en_hilo
+        servidor = ServidorKrishna(KrishnaEngine(self.GITA, TestKrishnaEngine.RotadorFalso(respuestas)))
+        return servidor, f"http://127.0.0.1:{arrancar_en_hilo(servidor)}"
+
+    @staticmethod
+    def _post(url, datos, cabeceras=None):
+        import json
+        import urllib.request
+        peticion = urllib.request.Request(url, data=json.dumps(datos).encode("utf-8"), method="POST",
+                                          headers={"Content-Type": "application/json", **(cabeceras or {})})
+        with urllib.request.urlopen(peticion, timeout=5) as respuesta:
+            return respuesta.read().decode("utf-8")
+
+    def test_chat_sse_y_sesion(self):
+        import json
+        servidor, url = self._servidor(["Sabe que [C. II - 47] lo dice todo.", "Por ello, actúa [C. II - 48]."])
+        cuerpo = self._post(f"{url}/v1/chat", {"pregunta": "¿Cuál es mi dharma?", "nombre": "Lucía",
+                                                  "genero": "Femenino"},
+                            {"Accept": "text/event-stream"})
+        eventos = [(b.split("\n")[0][7:], json.loads(b.split("\n")[1][6:])) for b in cuerpo.strip().split("\n\n")]
+        assert eventos[0][0] == "sesion" and eventos[-1][0] == "fin"
+        texto = "".join(d["texto"] for nombre, d in eventos if nombre == "fragmento")
+        assert texto == eventos[-1][1]["texto"] == "Sabe que [C. II - 47] lo dice todo."
+        sesion_id = eventos[0][1]["sesion"]
+
+        fin = json.loads(self._post(f"{url}/v1/chat", {"pregunta": "¿Y ahora?", "sesion": sesion_id}))
+        assert fin["citas"] == ["2:48"]
+        _, sesion = servidor.almacen.obtener(sesion_id)
+        assert sesion.nombre_usuario == "Lucía" and len(sesion.mensajes) == 4
+
+    def test_reconstruye_sesion_desde_historial(self):
+        import json
+        servidor, url = self._servidor(["Por ello, actúa [C. II - 48]."])
+        historial = [{"role": "user", "content": "Hola"},
+                     {"role": "assistant", "content": "Sabe que [C. II - 47] lo dice todo."}]
+        fin = json.loads(self._post(f"{url}/v1/chat", {"pregunta": "¿Y ahora?", "sesion": "otra-replica",
+                                                         "genero": "Masculino", "historial": historial}))
+        _, sesion = servidor.almacen.obtener(fin["sesion"])
+        assert fin["sesion"] == "otra-replica" and sesion.mensajes[1]["citas"] == ["2:47"]
+
+    def test_rechaza_peticion_sin_pregunta(self):
+        import urllib.error
+        import pytest
+        _, url = self._servidor([])
+        with pytest.raises(urllib.error.HTTPError) as error:
+            self._post(f"{url}/v1/chat", {"sesion": "x"})
+        assert error.value.code == 400
+
+
+class TestAlmacenSesiones:
+    @staticmethod
+    def _sesion(turnos):
+        from krishna_engine import Sesion
+        mensajes = []
+        for i in range(turnos):
+            mensajes.append({"role": "user", "content": f"Pregunta {i}"})
+            mensajes.append({"role": "assistant", "content": f"Respuesta {i} [C. II - {i + 1}]",
+                             "citas": [f"2:{i + 1}"], "tramos": [(0, 9, "2:1")]})
+        return Sesion(mensajes=mensajes, nombre_usuario="Lucía", genero_usuario="Femenino")
+
+    def test_retencion_y_registros_compactos(self):
+        from almacen_sesiones import retener
+        sesion = self._sesion(10)
+        assert retener(sesion.mensajes, retencion=8, con_texto=4) == 12
+        assert len(sesion.mensajes) == 8
+        assert sesion.mensajes[0] == {"role": "user", "content": ""}
+        assert sesion.mensajes[1] == {"role": "assistant", "content": "", "citas": ["2:7"]}
+        assert sesion.mensajes[-1]["content"] == "Respuesta 9 [C. II - 10]"
+        assert sesion.mensajes[-1]["tramos"] == [(0, 9, "2:1")]
+
+    def test_nivel_frio_entre_procesos(self, tmp_path):
+        from almacen_sesiones import AlmacenSesiones
+        path = str(tmp_path / "sesiones.sqlite3")
+        almacen = AlmacenSesiones(max_sesiones=1, path=path)
+        almacen.guardar("a", self._sesion(2))
+        almacen.guardar("b", self._sesion(1))
+        assert len(almacen) == 1
+        # "a" salió del LRU pero se rehidrata desde disco, también en otro proceso
+        for otro in (almacen, AlmacenSesiones(path=path)):
+            sesion_id, sesion = otro.obtener("a")
+            assert sesion_id == "a" and sesion.nombre_usuario == "Lucía"
+            assert sesion.mensajes == self._sesion(2).mensajes
+        assert almacen.eliminar("a")
+        assert AlmacenSesiones(path=path).obtener("a")[1] is None
+
+    def test_sesiones_caducadas(self, tmp_path):
+        from almacen_sesiones import AlmacenSesiones
+        almacen = AlmacenSesiones(ttl=-1, path=str(tmp_path / "sesiones.sqlite3"))
+        almacen.guardar("a", self._sesion(1))
+        assert almacen.obtener("a")[1] is None
+        assert almacen.purgar() == 1
+
+
+class TestVueloUnico:
+    def test_coalesce_llamadas_identicas_en_vuelo(self):
+        import threading
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from vuelo_unico import VueloUnico, clave_peticion
+        vuelos = VueloUnico("test")
+        liberar = threading.Event()
+        llamadas = []
+
+        def llamada():
+            llamadas.append(1)
+            liberar.wait(5)
+            return "respuesta"
+
+        clave = clave_peticion("modelo", "prompt", {"temperature": 0.1, "max_output_tokens": 10})
+        assert clave == clave_peticion("modelo", "prompt", {"max_output_tokens": 10, "temperature": 0.1})
+        entradas = []
+
+        def llamante():
+            entradas.append(1)
+            return vuelos.ejecutar(clave, llamada)
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            futuros = [pool.submit(llamante) for _ in range(6)]
+            while len(entradas) < 6:
+                time.sleep(0.001)
+            time.sleep(0.05)
+            liberar.set()
+            resultados = [f.result() for f in futuros]
+        assert resultados == ["respuesta"] * 6
+        assert len(llamadas) == 1 and vuelos.en_vuelo() == 0
+        assert vuelos.ejecutar(clave, lambda: "nueva") == "nueva"
+
+    def test_errores_llegan_a_todos(self):
+        import pytest
+        from vuelo_unico import VueloUnico
+
+        def falla():
+            raise RuntimeError("429 quota")
+
+        with pytest.raises(RuntimeError):
+            VueloUnico("test").ejecutar("k", falla)
+
+    def test_respuesta_compartida_se_recorre_desde_el_principio(self):
+        from benchmarks.fake_gemini import RespuestaFalsa
+        from vuelo_unico import RespuestaCompartida
+        compartida = RespuestaCompartida(RespuestaFalsa(["Sabe ", "que ", "Yo soy."], stream=True))
+        primero = iter(compartida)
+        assert next(primero).text == "Sabe "
+        assert [f.text for f in compartida] == ["Sabe ", "que ", "Yo soy."]
+        assert "".join(f.text for f in primero) == "que Yo soy."
+        assert compartida.text == "Sabe que Yo soy."
@@ -0,0 +1,175 @@
+"""
+Capa de trazas estructuradas para Krishna AI.
+
+Sustituye los print de diagnóstico por eventos con nivel, formateo diferido,
+muestreo y spans alrededor de las etapas de cada turno (recuperación,
+construcción del prompt, llamada al LLM).
+
+El modo detallado está desactivado por defecto. Se activa con la variable de
+entorno KRISHNAI_VERBOSE=1 (y opcionalmente KRISHNAI_TRACE_SAMPLE=0.1 para
+muestrear solo una fracción de los turnos). Con el modo desactivado ningún
+mensaje de diagnóstico llega a formatearse.
+"""
+
+import contextvars
+import functools
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("krishnai")
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+_span_actual = contextvars.ContextVar("krishnai_span_actual", default=None)
+_muestreado = contextvars.ContextVar("krishnai_muestreado", default=True)
+
+_config = {"tasa_muestreo": 1.0}
+_observadores = []
+
+
+def _env_verbose() -> bool:
+    return os.environ.get("KRISHNAI_VERBOSE", "").strip().lower() in ("1", "true", "si", "sí", "yes", "on")
+
+
+def configurar(verbose: bool | None = None, tasa_muestreo: float | None = None):
+    """Configura el nivel de trazas y la tasa de muestreo por turno."""
+    if verbose is None:
+        verbose = _env_verbose()
+    if tasa_muestreo is None:
+        try:
+            tasa_muestreo = float(os.environ.get("KRISHNAI_TRACE_SAMPLE", "1.0"))
+        except ValueError:
+            tasa_muestreo = 1.0
+    _config["tasa_muestreo"] = min(1.0, max(0.0, tasa_muestreo))
+
+    logger.setLevel(DEBUG if verbose else WARNING)
+    if verbose and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+        logger.addHandler(handler)
+
+
+def activo(nivel: int = DEBUG) -> bool:
+    """Indica si un evento de ese nivel se emitiría en el contexto actual."""
+    return logger.isEnabledFor(nivel) and (nivel >= WARNING or _muestreado.get())
+
+
+class Span:
+    """Tramo temporal de una etapa del turno."""
+
+    __slots__ = ("nombre", "atributos", "padre", "inicio", "duracion")
+
+    def __init__(self, nombre: str, atributos: dict, padre: "Span | None"):
+        self.nombre = nombre
+        self.atributos = atributos
+        self.padre = padre
+        self.inicio = 0.0
+        self.duracion = 0.0
+
+    def set(self, **atributos):
+        """Añade atributos al span. Los valores invocables se evalúan solo al emitir."""
+        self.atributos.update(atributos)
+
+    @property
+    def ruta(self) -> str:
+        if self.padre is None:
+            return self.nombre
+        return f"{self.padre.ruta}/{self.nombre}"
+
+
+def registrar_observador(funcion):
+    """Registra una función que recibe cada span al cerrarse (p. ej. métricas)."""
+    if funcion not in _observadores:
+        _observadores.append(funcion)
+
+
+def _resolver(valor):
+    return valor() if callable(valor) else valor
+
+
+def _formatear_campos(campos: dict) -> str:
+    return " ".join(f"{k}={_resolver(v)!r}" for k, v in campos.items())
+
+
+def traza(nivel: int, mensaje: str, *args, **campos):
+    """
+    Emite un evento estructurado.
+
+    El mensaje usa formato % diferido; los argumentos y campos invocables
+    (p. ej. lambda: sorted(conjunto)) solo se evalúan si el evento se emite.
+    """
+    if not activo(nivel):
+        return
+    if args:
+        mensaje = mensaje % tuple(_resolver(a) for a in args)
+    span_actual = _span_actual.get()
+    if span_actual is not None:
+        campos.setdefault("span", span_actual.ruta)
+    if campos:
+        mensaje = f"{mensaje} | {_formatear_campos(campos)}"
+    logger.log(nivel, mensaje)
+
+
+def depurar(mensaje: str, *args, **campos):
+    traza(DEBUG, mensaje, *args, **campos)
+
+
+def info(mensaje: str, *args, **campos):
+    traza(INFO, mensaje, *args, **campos)
+
+
+def aviso(mensaje: str, *args, **campos):
+    traza(WARNING, mensaje, *args, **campos)
+
+
+def error(mensaje: str, *args, **campos):
+    traza(ERROR, mensaje, *args, **campos)
+
+
+@contextmanager
+def span(nombre: str, **atributos):
+    """
+    Mide una etapa del turno. El span raíz decide el muestreo de todo el turno;
+    los spans anidados heredan la decisión.
+    """
+    padre = _span_actual.get()
+    token_muestreo = None
+    if padre is None and _config["tasa_muestreo"] < 1.0:
+        token_muestreo = _muestreado.set(random.random() < _config["tasa_muestreo"])
+
+    s = Span(nombre, atributos, padre)
+    token = _span_actual.set(s)
+    s.inicio = time.perf_counter()
+    try:
+        yield s
+    finally:
+        s.duracion = time.perf_counter() - s.inicio
+        _span_actual.reset(token)
+        for observador in _observadores:
+            observador(s)
+        if activo(DEBUG):
+            campos = dict(s.atributos)
+            campos["ms"] = round(s.duracion * 1000, 2)
+            logger.debug("span %s | %s", s.ruta, _formatear_campos(campos))
+        if token_muestreo is not None:
+            _muestreado.reset(token_muestreo)
+
+
+def trazado(nombre: str):
+    """Decorador que envuelve la función en un span con el nombre dado."""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            with span(nombre):
+                return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+configurar()
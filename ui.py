@@ -3,85 +3,219 @@ Componentes de UI para Krishna AI.
 """
 
 import os
+import uuid
 import streamlit as st
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Mensajes que conserva cada pestaña (la memoria por sesión no crece sin límite)
+MAX_MENSAJES_VISIBLES = 40
+# Segundos entre comprobaciones de la cola mientras hay respuestas degradadas pendientes
+INTERVALO_REINTENTOS = 5
+
+@st.cache_data(show_spinner=False)
+def leer_css(css_file=".streamlit/_style.css"):
+    if not os.path.exists(css_file):
+        return ""
+    with open(css_file) as f:
+        return f.read()
+
 def load_css():
-    css_file = ".streamlit/_style.css"
-    if os.path.exists(css_file):
-        with open(css_file) as f:
-            st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+    css = leer_css()
+    if css:
+        st.markdown(f"<style>{css}</style>", unsafe_allow_html=True)
+
+def resaltar_citas(texto, tramos):
+    """Resalta en el markdown los tramos que citan textualmente un verso del Gita."""
+    partes = []
+    anterior = 0
+    for inicio, fin, _verso in tramos or []:
+        tramo = texto[inicio:fin]
+        # La directiva de color de Streamlit no admite corchetes ni saltos de línea dentro
+        if inicio < anterior or any(c in tramo for c in "[]\n"):
+            continue
+        partes.append(texto[anterior:inicio])
+        partes.append(f":orange-background[{tramo}]")
+        anterior = fin
+    partes.append(texto[anterior:])
+    return "".join(partes)
+
+@st.cache_data(show_spinner=False)
+def resumen_corpus(_bhagavad_gita):
+    """Capítulos, versos y traductor; el corpus no cambia en la vida del proceso."""
+    return {
+        "capitulos": len(_bhagavad_gita['capitulos']),
+        "versos": sum(len(cap['versos']) for cap in _bhagavad_gita['capitulos'].values()),
+        "traductor": _bhagavad_gita['traductor'],
+    }
+
+@st.cache_data(ttl=10, show_spinner=False)
+def estado_claves(_api_rotator):
+    """(disponibles, total) de las claves API, refrescado como mucho cada 10 s."""
+    resumen = _api_rotator.get_status_summary()
+    return resumen['available_keys'], resumen['total_keys']
 
 def render_sidebar(bhagavad_gita, api_rotator):
+    """
+    Barra lateral como fragmento: escribir el nombre o mover el slider solo
+    re-ejecuta la barra, no el historial ni el resto de la app.
+    """
     with st.sidebar:
-        col1, col2, col3 = st.columns([1, 2, 1])
-        with col2:
-            st.image(".streamlit/krishna.png", use_container_width=False)
-
-        st.markdown('###')
-
-        st.markdown("### Nombre")
-        nombre_usuario = st.text_input(
-            "",
-            value=st.session_state.get('nombre_usuario', 'Mikel'),
-            help="Krishna se dirigirá a ti por este nombre",
-            label_visibility="collapsed",
-            key="nombre_input"
-        )
-
-        if nombre_usuario and nombre_usuario != st.session_state.get('ultimo_nombre_procesado', ''):
-            from gender_detector import obtener_tratamiento_genero
-            tratamiento_temp = obtener_tratamiento_genero(nombre_usuario, None, api_rotator)
-            genero_detectado = "Femenino" if tratamiento_temp["querido"] == "querida" else "Masculino"
-            st.session_state.genero_detectado = genero_detectado
-            st.session_state.ultimo_nombre_procesado = nombre_usuario
-        elif 'genero_detectado' not in st.session_state:
-            st.session_state.genero_detectado = "Masculino"
-
-        if nombre_usuario:
-            st.session_state.nombre_usuario = nombre_usuario
+        _contenido_sidebar(bhagavad_gita, api_rotator)
+    return st.session_state.get('temperatura', 0.1)
+
+@st.fragment
+def _contenido_sidebar(bhagavad_gita, api_rotator):
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col2:
+        st.image(".streamlit/krishna.png", use_container_width=False)
+
+    st.markdown('###')
+
+    st.markdown("### Nombre")
+    nombre_usuario = st.text_input(
+        "",
+        value=st.session_state.get('nombre_usuario', 'Mikel'),
+        help="Krishna se dirigirá a ti por este nombre",
+        label_visibility="collapsed",
+        key="nombre_input"
+    )
+
+    # Léxico, caché y sufijos en memoria: no bloquea; los nombres desconocidos se
+    # consultan al LLM en segundo plano, con debounce por sesión, y se aplican
+    # en un render posterior
+    if nombre_usuario:
+        from gender_detector import resolver_genero
+        canal = st.session_state.setdefault('id_sesion', uuid.uuid4().hex)
+        st.session_state.genero_detectado = resolver_genero(nombre_usuario, api_rotator, canal=canal)
+    elif 'genero_detectado' not in st.session_state:
+        st.session_state.genero_detectado = "Masculino"
+
+    if nombre_usuario:
+        st.session_state.nombre_usuario = nombre_usuario
+    else:
+        st.session_state.nombre_usuario = "Mikel"
+
+    st.session_state.genero_usuario = st.session_state.get('genero_detectado', 'Masculino')
+
+    st.markdown("### Creatividad")
+    temperature = st.slider(
+        "",
+        min_value=0.0,
+        max_value=0.8,
+        value=0.1,
+        step=0.05,
+        help="Controla la creatividad. Valores bajos mantienen mayor fidelidad al texto original.",
+        label_visibility="collapsed",
+        key="temperatura_input"
+    )
+    st.session_state.temperatura = temperature
+
+    if st.button("🔄 Nueva conversación", help="Limpia el historial para empezar una nueva conversación con Krishna", use_container_width=True):
+        st.session_state.messages = []
+        if 'sesion' in st.session_state:
+            st.session_state.sesion.reintentos.clear()
+        st.rerun(scope="app")
+
+    st.markdown("#\n" * 7)
+
+    with st.expander("ℹ️ Información", expanded=False):
+        nombre_mostrar = st.session_state.get('nombre_usuario', 'Mikel')
+        corpus = resumen_corpus(bhagavad_gita)
+        disponibles, total = estado_claves(api_rotator)
+        st.markdown(f"""
+        **Krishna AI** te permite dialogar directamente con Krishna del Bhagavad Gita.
+        
+        Eres **{nombre_mostrar}** en Kurukshetra, y Krishna responderá con las enseñanzas exactas del Gita.
+        
+        **Uso:**
+        - Haz preguntas profundas sobre dharma, karma, moksha
+        - Krishna recuerda los últimos intercambios
+        - Todas las respuestas incluyen referencias exactas
+        
+        **Datos del Gita:**
+        - Capítulos: {corpus['capitulos']}
+        - Versos: {corpus['versos']}
+        - Traductor: {corpus['traductor']}
+        
+        **API:** {disponibles}/{total} claves disponibles
+        """)
+
+    # Panel de métricas por etapa, solo para administradores
+    if es_admin():
+        render_panel_metricas(api_rotator)
+
+
+def burbujas(mensajes):
+    """
+    (rol, avatar, markdown) de cada mensaje, ya resaltado. Se guarda en la
+    sesión y solo se procesan los mensajes nuevos, así que pintar el historial
+    no vuelve a resaltar citas de turnos anteriores.
+    """
+    cache = st.session_state.setdefault('burbujas', [])
+    if len(cache) > len(mensajes):
+        cache.clear()   # historial reiniciado
+    for message in mensajes[len(cache):]:
+        if message["role"] == "assistant":
+            cache.append(("assistant", ".streamlit/krishna.png",
+                          resaltar_citas(message["content"], message.get("tramos"))))
+        else:
+            cache.append((message["role"], ".streamlit/arjuna.png", message["content"]))
+    return cache
+
+def recortar_historial(retencion=MAX_MENSAJES_VISIBLES):
+    """Aplica la retención al historial de la sesión y a sus burbujas cacheadas."""
+    from almacen_sesiones import retener
+    burbujas(st.session_state.messages)   # alinea la caché con el historial antes de recortar
+    sobran = retener(st.session_state.messages, retencion, con_texto=None)
+    if sobran:
+        del st.session_state.burbujas[:sobran]
+        st.session_state.burbujas_fijas = max(0, st.session_state.get('burbujas_fijas', 0) - sobran)
+
+def pintar_burbujas(filas):
+    for rol, avatar, markdown in filas:
+        with st.chat_message(rol, avatar=avatar):
+            st.markdown(markdown)
+
+def aviso_degradacion(posicion):
+    """Aviso bajo una respuesta compuesta sin el modelo; posicion en la cola de reintentos o None."""
+    texto = ("🪷 **Respuesta desde las enseñanzas guardadas**\n\nLas claves API están agotadas en este momento, "
+             "así que Krishna responde con versos afines a tu pregunta.")
+    if posicion:
+        texto += (f" Tu pregunta está en la cola (posición {posicion}): la respuesta completa sustituirá "
+                  "a esta en cuanto haya una clave disponible.")
+    return texto
+
+def render_reintentos(sesion, cola):
+    """Mientras la sesión tenga turnos degradados en la cola, un fragmento los vigila cada INTERVALO_REINTENTOS."""
+    if sesion.reintentos:
+        st.fragment(_estado_reintentos, run_every=INTERVALO_REINTENTOS)(sesion, cola)
+
+def _estado_reintentos(sesion, cola):
+    pendientes = list(sesion.reintentos)
+    if any(turno.futuro.done() for turno in pendientes):
+        st.rerun(scope="app")   # la ejecución completa aplica la respuesta del modelo al historial
+    posiciones = [p for p in map(cola.posicion, pendientes) if p is not None]
+    if posiciones:
+        st.caption(f"⏳ Esperando una clave para la respuesta completa (posición {min(posiciones)} en la cola)")
+
+def es_admin():
+    """Modo administrador: ?admin=<token> coincide con [admin] token en secrets.toml"""
+    try:
+        token = st.secrets.get("admin", {}).get("token")
+    except Exception:
+        token = None
+    return bool(token) and st.query_params.get("admin") == token
+
+def render_panel_metricas(api_rotator):
+    import metrics
+    metrics.actualizar_desde_rotador(api_rotator)
+    # Se llama dentro de la barra lateral (un fragmento no puede usar st.sidebar)
+    with st.expander("📈 Métricas (admin)", expanded=False):
+        filas = metrics.REGISTRO.resumen_etapas()
+        if filas:
+            st.dataframe(filas, hide_index=True, use_container_width=True)
         else:
-            st.session_state.nombre_usuario = "Mikel"
-
-        st.session_state.genero_usuario = st.session_state.get('genero_detectado', 'Masculino')
-
-        st.markdown("### Creatividad")
-        temperature = st.slider(
-            "",
-            min_value=0.0,
-            max_value=0.8,
-            value=0.1,
-            step=0.05,
-            help="Controla la creatividad. Valores bajos mantienen mayor fidelidad al texto original.",
-            label_visibility="collapsed"
-        )
-
-        if st.button("🔄 Nueva conversación", help="Limpia el historial para empezar una nueva conversación con Krishna", use_container_width=True):
-            st.session_state.messages = []
-            st.rerun()
-
-        st.markdown("#\n" * 7)
-
-        with st.expander("ℹ️ Información", expanded=False):
-            nombre_mostrar = st.session_state.get('nombre_usuario', 'Mikel')
-            st.markdown(f"""
-            **Krishna AI** te permite dialogar directamente con Krishna del Bhagavad Gita.
-            
-            Eres **{nombre_mostrar}** en Kurukshetra, y Krishna responderá con las enseñanzas exactas del Gita.
-            
-            **Uso:**
-            - Haz preguntas profundas sobre dharma, karma, moksha
-            - Krishna recuerda los últimos intercambios
-            - Todas las respuestas incluyen referencias exactas
-            
-            **Datos del Gita:**
-            - Capítulos: {len(bhagavad_gita['capitulos'])}
-            - Versos: {sum(len(cap['versos']) for cap in bhagavad_gita['capitulos'].values())}
-            - Traductor: {bhagavad_gita['traductor']}
-            
-            **API:** {api_rotator.get_status_summary()['available_keys']}/{api_rotator.get_status_summary()['total_keys']} claves disponibles
-            """)
-
-    return temperature
+            st.caption("Aún no hay turnos medidos en este proceso.")
+        st.code(metrics.REGISTRO.exportar_prometheus(), language="text")
@@ -0,0 +1,113 @@
+"""
+Coalescencia de peticiones idénticas en vuelo ("single-flight").
+
+Si llegan a la vez varias llamadas iguales al modelo (mismo modelo, prompt y
+configuración) o varios embeddings del mismo texto, solo la primera sale al
+proveedor; las demás se enganchan a su Future y reciben el mismo resultado o
+la misma excepción. La entrada se retira al terminar la llamada, así que no
+es una caché: solo colapsa las ráfagas simultáneas (tras un despliegue, un
+enlace compartido, una pregunta de moda).
+
+Las respuestas en streaming se envuelven en RespuestaCompartida, que guarda
+los fragmentos recibidos para que cada llamante los recorra desde el
+principio a su ritmo.
+"""
+
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+
+import metrics
+import tracing
+
+
+def clave_peticion(*partes) -> str:
+    """Hash estable de los parámetros de una petición (dicts con claves ordenadas)."""
+    datos = json.dumps(partes, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(datos.encode("utf-8")).hexdigest()
+
+
+class VueloUnico:
+    def __init__(self, operacion: str):
+        self.operacion = operacion
+        self._en_vuelo: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def ejecutar(self, clave: str, funcion, timeout: float | None = None):
+        """
+        Ejecuta funcion() salvo que ya haya una llamada con la misma clave en vuelo.
+        timeout acota solo la espera a la llamada ajena (lanza TimeoutError).
+        """
+        with self._lock:
+            futuro = self._en_vuelo.get(clave)
+            lider = futuro is None
+            if lider:
+                futuro = self._en_vuelo[clave] = Future()
+
+        if not lider:
+            metrics.contar("krishnai_coalescidas_total", "Llamadas resueltas con otra idéntica en vuelo",
+                           operacion=self.operacion)
+            tracing.depurar("Petición coalescida", operacion=self.operacion, clave=clave[:12])
+            return futuro.result(timeout)
+
+        try:
+            resultado = funcion()
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        else:
+            futuro.set_result(resultado)
+            return resultado
+        finally:
+            with self._lock:
+                self._en_vuelo.pop(clave, None)
+
+    def en_vuelo(self) -> int:
+        with self._lock:
+            return len(self._en_vuelo)
+
+
+class RespuestaCompartida:
+    """Respuesta en streaming que varios llamantes pueden recorrer desde el principio."""
+
+    def __init__(self, respuesta):
+        self._respuesta = respuesta
+        self._origen = iter(respuesta)
+        self._fragmentos = []
+        self._terminada = False
+        self._error = None
+        self._lock = threading.Lock()
+
+    def _fragmento(self, i: int):
+        """Fragmento i; si aún no ha llegado lo pide al origen (un solo hilo a la vez)."""
+        with self._lock:
+            while i >= len(self._fragmentos) and not self._terminada:
+                try:
+                    self._fragmentos.append(next(self._origen))
+                except StopIteration:
+                    self._terminada = True
+                except Exception as e:
+                    self._error = e
+                    self._terminada = True
+            if i < len(self._fragmentos):
+                return True, self._fragmentos[i]
+            if self._error is not None:
+                raise self._error
+            return False, None
+
+    def __iter__(self):
+        i = 0
+        while True:
+            hay, fragmento = self._fragmento(i)
+            if not hay:
+                return
+            yield fragmento
+            i += 1
+
+    @property
+    def text(self) -> str:
+        return "".join(f.text for f in self)
+
+    def __getattr__(self, nombre):
+        return getattr(self._respuesta, nombre)